@@ -0,0 +1,166 @@
+"""准入控制：限制耗 CPU 端點的同時執行數與排隊長度。
+
+所有計算都在同一個行程裡搶 GIL，同時跑好幾個生成只會讓每個請求都變慢，
+連帶拖累便宜的端點。這裡把昂貴端點分成幾類，每類各有：
+- concurrency：同時執行的上限（以 asyncio.Semaphore 在事件迴圈上排隊，不佔用執行緒池）
+- queue：額外允許排隊的請求數；再多就直接回 429 並附 Retry-After
+
+設定以環境變數調整，例如 WAA_GENERATE_CONCURRENCY=1、WAA_GENERATE_QUEUE=4。
+
+AdmissionMiddleware 是純 ASGI 中介層：執行權一直持有到回應主體送完（串流回應也一樣），
+而且不像 BaseHTTPMiddleware 會在回應開始後和端點搶讀請求主體，/api/import 才能邊讀邊回。
+"""
+
+import asyncio
+import math
+import os
+import time
+
+from starlette.datastructures import MutableHeaders
+from starlette.responses import JSONResponse
+
+
+def _env_int(name, default):
+    try:
+        return max(0, int(os.getenv(name, default)))
+    except ValueError:
+        return default
+
+
+class AdmissionGate:
+    """單一端點類別的閘門；只在事件迴圈執行緒上操作，不需要額外的鎖。"""
+
+    def __init__(self, name, concurrency, queue):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.queue = queue
+        self._sem = None  # 延遲到第一個請求才建立，確保綁定到伺服器的事件迴圈
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.avg_service_ms = 0.0  # 指數移動平均，用來估算 Retry-After
+
+    def saturated(self):
+        return self.in_flight + self.waiting >= self.concurrency + self.queue
+
+    def retry_after(self):
+        """估計排到的秒數：前面還有幾輪 × 平均處理時間，至少 1 秒。"""
+        rounds = (self.waiting + 1) / self.concurrency
+        return max(1, math.ceil(rounds * self.avg_service_ms / 1000))
+
+    async def acquire(self):
+        """排隊取得執行權，回傳排隊毫秒；取得後必須以 release(開始時間) 歸還。"""
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.concurrency)
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        wait_ms = (time.perf_counter() - queued_at) * 1000
+        self.in_flight += 1
+        self.admitted += 1
+        self.total_wait_ms += wait_ms
+        return wait_ms
+
+    def release(self, started):
+        """歸還執行權；started 為取得後開始處理的 time.perf_counter()，用來更新平均處理時間。"""
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.avg_service_ms = elapsed_ms if self.admitted == 1 else 0.8 * self.avg_service_ms + 0.2 * elapsed_ms
+        self.in_flight -= 1
+        self._sem.release()
+
+    async def run(self, call):
+        """排隊取得執行權後呼叫 call()，回傳 (結果, 排隊毫秒)。"""
+        wait_ms = await self.acquire()
+        started = time.perf_counter()
+        try:
+            return await call(), wait_ms
+        finally:
+            self.release(started)
+
+    def stats(self):
+        return {
+            "concurrency": self.concurrency,
+            "queue": self.queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_ms / self.admitted, 1) if self.admitted else 0.0,
+            "avg_service_ms": round(self.avg_service_ms, 1),
+        }
+
+
+def _gate(name, concurrency, queue):
+    prefix = f"WAA_{name.upper()}_"
+    return AdmissionGate(
+        name,
+        _env_int(prefix + "CONCURRENCY", concurrency),
+        _env_int(prefix + "QUEUE", queue),
+    )
+
+
+# 端點類別與預設值；未列出的端點不受限制
+GATES = {
+    "generate": _gate("generate", 1, 4),
+    "cut": _gate("cut", 2, 8),
+    "export": _gate("export", 1, 4),
+    "import": _gate("import", 1, 2),
+}
+
+# (方法, 路徑前綴) -> 類別；牌靴庫載入可能要以種子重建，歸在生成類
+ROUTES = (
+    ("POST", "/api/generate_shoe", "generate"),
+    ("POST", "/api/library/", "generate"),
+    ("POST", "/api/simulate_cut", "cut"),
+    ("GET", "/api/export/cut_hits.csv", "export"),
+    ("GET", "/api/cut_hits", "export"),
+    ("POST", "/api/import", "import"),
+)
+
+
+def gate_for(method, path):
+    for route_method, prefix, name in ROUTES:
+        if method == route_method and path.startswith(prefix):
+            return GATES[name]
+    return None
+
+
+class AdmissionMiddleware:
+    """昂貴端點先經過准入閘門：滿載時回 429 與 Retry-After，否則排隊並以 X-Queue-Wait-Ms 回報等待時間。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        gate = gate_for(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if gate is None:
+            await self.app(scope, receive, send)
+            return
+        if gate.saturated():
+            gate.rejected += 1
+            response = JSONResponse(
+                {"error": "busy", "detail": f"{gate.name} queue full"},
+                status_code=429,
+                headers={"Retry-After": str(gate.retry_after())},
+            )
+            await response(scope, receive, send)
+            return
+        wait_ms = await gate.acquire()
+        started = time.perf_counter()
+
+        async def send_with_wait(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-Queue-Wait-Ms"] = f"{wait_ms:.1f}"
+                headers["Server-Timing"] = f"queue;dur={wait_ms:.1f}"
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_wait)
+        finally:
+            gate.release(started)
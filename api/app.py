@@ -2,18 +2,31 @@
 
 主要功能：
 1. 產生敏感鞋（/api/generate_shoe），同時可設定訊號花色與生成張數。
-2. 切牌模擬（/api/simulate_cut），以目前儲存的鞋子為基礎計算新的 rounds。
-3. 匯出直式牌序與切牌命中統計（/api/export/*），提供下載檔案。
+2. 切牌模擬（/api/simulate_cut），以目前儲存的鞋子為基礎計算新的 rounds；
+   生成後會在背景預先算好所有切點，切牌時只需查表再序列化；
+   帶 base_version 時只回傳與前端手上版本不同的局（差量模式）。
+3. 匯出直式牌序與切牌命中統計（/api/export/*），提供下載檔案；
+   /api/rounds 與 /api/cut_hits 分頁讀取目前版面的回合與切牌命中，取自快取，不重算。
+4. 牌靴庫（/api/library*）：生成結果會寫入 SQLite，可依條件查詢並重新載入。
+5. 准入控制：生成、切牌、切牌統計匯出各有同時執行上限與排隊長度，滿載回 429（見 admission.py）。
+6. 多 worker 部署：設定 WAA_POOL_ADDRESS 時生成交給共用工作池（見 workers.py），
+   WAA_SHARED_STATE=1 時目前牌靴經由牌靴庫在各 worker 間同步。
+7. 生成進度串流（/ws/generate）：逐次回報嘗試、規則重試與階段耗時，回合分批送出。
+8. 啟動暖機：lifespan 在背景預先備好排列表、牌靴庫與第一副牌；/healthz 回報存活，
+   /readyz 在暖機完成前回 503，讓編排器等到暖好才導入流量。
 
-模組也會在檔案尾端掛載 /web 下的靜態檔案，讓同一個伺服器能提供 UI。
+模組也會在檔案尾端掛載 /web 下的靜態檔案（預先壓縮並加上指紋網址，見 api/static.py），讓同一個伺服器能提供 UI。
 """
 
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from typing import Optional
-import io, csv, time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import io, os, csv, gzip, json, time, asyncio, hashlib, threading
 
 try:
     import waa  # type: ignore
@@ -22,34 +35,192 @@ except Exception:
     waa = None  # type: ignore
     WAA_OK = False
 
-app = FastAPI()
+from .library import get_library
+from .admission import GATES, AdmissionMiddleware
+from .coalesce import BATCHES, COALESCE_ENABLED, IDEMPOTENCY, CoalesceMiddleware
+from .static import accepts_encoding, static_app
+from .workers import get_pool, load_shared_shoe
+
+@asynccontextmanager
+async def lifespan(app):
+    """啟動時在背景執行暖機（不阻塞伺服器開始監聽，/healthz 可立即回應）。"""
+    if WARMUP_ENABLED and WAA_OK:
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=_warm_up, args=(loop,), name="warm-up", daemon=True).start()
+    else:
+        WARMUP["state"] = "ready" if WAA_OK else "failed"
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 # 啟用 CORS，允許任何來源呼叫 API（方便本地網頁測試）。
 app.add_middleware(
-    CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
+    CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["Retry-After", "X-Queue-Wait-Ms", "ETag", "X-Coalesced"],
 )
 
 # 注意：靜態掛載要放在 API 路由之後，避免攔截 /api/*
 
 
+# 昂貴端點先經過准入閘門（見 admission.py）；純 ASGI 中介層，執行權持有到回應送完
+app.add_middleware(AdmissionMiddleware)
+
+
+def _batchable(body):
+    """未帶 Idempotency-Key 的生成請求能否併成一批：本機生成、不取牌靴庫、不做多候選。"""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return False
+    return (isinstance(data, dict) and not data.get("reuse_library")
+            and (data.get("candidates") or 1) <= 1 and get_pool() is None)
+
+
+async def coalesce_generate(request: Request, call_next):
+    """相同的 /api/generate_shoe 請求合併執行（見 coalesce.py）：帶 Idempotency-Key 共用結果，否則併成一批各拿一副。"""
+    if not COALESCE_ENABLED:
+        return await call_next(request)
+    body = await request.body()
+    key = request.headers.get("idempotency-key")
+    if key:
+        return await IDEMPOTENCY.run(key, body, lambda: call_next(request))
+    if _batchable(body):
+        return await BATCHES.run(request, body, call_next)
+    return await call_next(request)
+
+
+# 在准入控制之後註冊，成為外層：合併的跟隨請求不進生成閘門排隊
+app.add_middleware(CoalesceMiddleware, dispatch=coalesce_generate)
+
+
 # --- 請求模型 ---
 class GenReq(BaseModel):
     num_shoes: int
     signal_suit: str
     tie_signal_suit: Optional[str] = None
+    reuse_library: bool = False  # True 時優先從牌靴庫挑一副符合花色設定的既有牌靴
+    deadline_ms: Optional[int] = None  # 時間預算；用盡時回傳標記為 partial 的最佳部分結果
+    candidates: int = 1  # 大於 1 時平行產生多副候選，回傳切牌分析最佳的一副（上限 MAX_CANDIDATES）
+    objective: Optional[str] = None  # 候選排序目標（waa.CANDIDATE_OBJECTIVES），預設 waa.CANDIDATE_OBJECTIVE
+    num_decks: Optional[int] = None  # 牌靴副數（1..waa.MAX_NUM_DECKS）；省略時用伺服器預設（WAA_NUM_DECKS）
+    rounds_limit: Optional[int] = None  # 只回傳前幾局（其餘以 /api/rounds 分頁取得）；省略時回傳全部
 
 
 class CutReq(BaseModel):
     cut_pos: int
+    base_version: Optional[str] = None  # 前端目前持有的回應 version；有帶時改回差量格式
+    rounds_limit: Optional[int] = None  # 同 GenReq.rounds_limit；差量回應不受影響
 
 
 class ScanReq(BaseModel):
     banker_point: int
     player_point: int
-    used_cards: int
+    used_cards: int  # 0 表示不限張數
+    include_library: bool = False  # True 時一併查詢牌靴庫中符合條件的牌靴
+
+
+MAX_CANDIDATES = int(os.getenv("WAA_MAX_CANDIDATES", "8"))
+IMPORT_BATCH = int(os.getenv("WAA_IMPORT_BATCH", "256"))  # /api/import 每批驗證的牌靴數
+DEFAULT_NUM_DECKS = waa.NUM_DECKS if WAA_OK else 8
 
 
 # --- 內部狀態 ---
-STATE = {"rounds": [], "tail": [], "deck": []}  # 暫存最近一次生成的鞋子資訊，供後續 API 使用
+STATE = {"rounds": [], "tail": [], "deck": [], "scan": ([], [], {}), "version": 0, "layout": 0}  # 暫存最近一次生成的鞋子資訊，供後續 API 使用
+# 目前牌靴的生成設定（waa.current_settings()：副數、花色與調參值）；換牌靴時記下，切牌與序列化都依這副牌的設定，
+# 不讀 waa 的模組設定（請求各自在 waa.generation_settings 區塊內生成，不改寫模組全域變數）
+STATE["settings"] = None
+
+# 多 worker 時以牌靴庫的 current_shoe 同步 STATE；seq 為本 worker 已套用的序號
+SHARED_STATE = os.getenv("WAA_SHARED_STATE", "0") == "1"
+_SYNC = {"seq": 0}
+_SYNC_LOCK = threading.Lock()
+
+# 最近回應過的序列化回合：{version token: rows}，差量模式用來比對前端手上的資料
+RECENT_ROWS = OrderedDict()
+RECENT_ROWS_MAX = 32
+
+# 切牌結果快取：{切點: 結果}（LRU，最多 CUT_CACHE_MAX 個切點），只對 version 相符的牌靴有效；
+# rules 為換牌靴當下的規則設定快照（waa.rule_config()），之後其他花色的生成請求不會影響這副牌的切牌結果。
+# 切點在第一次被點到時才計算（單一切點約 1.5 毫秒）；來回拖曳時常用的切點留在快取裡
+CUT_CACHE = {"version": -1, "rules": None, "outcomes": OrderedDict()}
+CUT_CACHE_MAX = max(1, int(os.getenv("WAA_CUT_CACHE_SIZE", "64")))
+_CUT_LOCK = threading.Lock()
+
+# 目前版面的讀取快取（/api/rounds、/api/cut_hits 分頁與 /api/export/* 用）：只對 layout 相符的版面有效，
+# 每次生成 / 切牌都會換 layout；token 為回應中的 version，版面來自其他 worker 時為 None；
+# exports 保存各匯出檔編碼後的內容、gzip 版本與 ETag
+VIEW_CACHE = {"layout": -1, "token": None, "rows": None, "cut_hits": None, "exports": {}}
+_VIEW_LOCK = threading.Lock()
+MAX_PAGE_ROWS = 500
+
+
+def _update_state(*, _version=None, **fields):
+    """更新目前牌靴並重建掃描索引（每次生成 / 切牌只建一次）。
+    換了新牌靴（帶 deck）時版本號加一、記下目前生效的生成設定（呼叫端位於該牌靴的 waa.generation_settings 區塊內），
+    並重設切牌快取。
+    共享狀態模式下同時發布到牌靴庫，版本號改用庫中的 deck_seq，各 worker 一致；
+    _version 由 _sync_state 帶入，表示資料來自其他 worker、不再發布。
+    掃描索引先建好，再與回合一起以 STATE["scan"] = (rounds, tail, index) 一次換上，
+    在執行緒池中執行的 /api/scan 不會拿舊索引去查新回合。"""
+    rounds = fields.get("rounds", STATE["rounds"])
+    tail = fields.get("tail", STATE["tail"])
+    try:
+        index = waa.build_scan_index(rounds, tail)
+    except Exception:
+        index = {}
+    STATE.update(fields, scan=(rounds, tail, index))
+    STATE["layout"] += 1
+    deck_changed = "deck" in fields
+    if deck_changed:
+        STATE["settings"] = waa.current_settings()
+    if _version is None:
+        _version = _publish_state(deck_changed)
+    if deck_changed:
+        STATE["version"] = _version if _version is not None else STATE["version"] + 1
+        _reset_cut_cache(STATE["version"])
+
+
+def _publish_state(deck_changed):
+    """把目前牌靴寫入牌靴庫的 current_shoe，回傳 deck_seq；未啟用共享狀態時回傳 None。"""
+    lib = get_library() if SHARED_STATE and WAA_OK else None
+    if lib is None or not STATE["deck"]:
+        return None
+    try:
+        seq, deck_seq = lib.publish_current(
+            waa.encode_shoe(STATE["rounds"], STATE["tail"], STATE["deck"]),
+            signal_suit=_state_settings()["SIGNAL_SUIT"], tie_suit=_state_settings()["TIE_SIGNAL_SUIT"],
+            deck_changed=deck_changed,
+        )
+    except Exception as exc:
+        print(f"[API] publish state failed: {exc}")
+        return None
+    _SYNC["seq"] = seq
+    return deck_seq
+
+
+def _sync_state():
+    """其他 worker 更新過目前牌靴時，載入最新版本（只在共享狀態模式下作用）。"""
+    lib = get_library() if SHARED_STATE and WAA_OK else None
+    if lib is None:
+        return
+    with _SYNC_LOCK:
+        row = lib.current_if_newer(_SYNC["seq"])
+        if row is None:
+            return
+        rounds, tail, deck = waa.decode_shoe(row["cards"])
+        _SYNC["seq"] = row["seq"]
+        if row["deck_seq"] != STATE["version"]:
+            settings = waa.settings_for(row["signal_suit"], row["tie_suit"] or None, len(deck) // 52)
+            with waa.generation_settings(settings):
+                _update_state(rounds=rounds, tail=tail, deck=deck, _version=row["deck_seq"])
+        else:
+            # 同一副牌只是切點不同：沿用本 worker 的 deck 與設定，切點快取仍然有效
+            _update_state(rounds=rounds, tail=tail, _version=row["deck_seq"])
+
+
+def _state_settings():
+    """目前牌靴的生成設定；還沒有牌靴時為 waa 的模組設定。"""
+    return STATE["settings"] or waa.current_settings()
 
 
 # --- 花色對應 ---
@@ -201,7 +372,8 @@ def _serialize_rounds(rounds):
     return out
 
 
-def _serialize_rounds_with_flags(rounds, tail):
+def _serialize_rounds_with_flags(rounds, tail, signal_suit=None):
+    """序列化回合並標記 S_idx 旗標；signal_suit 省略時取目前生效的訊號花色（waa.setting）。"""
     ordered = sorted(rounds, key=lambda x: x.start_index)
     views = [waa.RoundView(cards=r.cards, result=r.result) for r in ordered]
     if tail:
@@ -213,7 +385,7 @@ def _serialize_rounds_with_flags(rounds, tail):
         s_idx_positions = set()
     serialized = _serialize_rounds(ordered)
     signal_enabled = bool(getattr(waa, "HEART_SIGNAL_ENABLED", False))
-    signal_suit = getattr(waa, "SIGNAL_SUIT", None)
+    signal_suit = signal_suit or waa.setting("SIGNAL_SUIT")
     for idx, row in enumerate(serialized):
         is_idx = idx in s_idx_positions
         row["is_sidx"] = bool(is_idx)
@@ -251,6 +423,235 @@ def _serialize_rounds_with_flags(rounds, tail):
     return serialized, ordered
 
 
+def _shoe_payload(serialized_rounds, ordered_rounds, tail, token):
+    """組出 generate_shoe / simulate_cut 共用的回應主體，並記下 token 對應的回合供差量比對。
+    token 格式為「牌靴版本:切點」，未切牌的版面以 g 表示。"""
+    RECENT_ROWS[token] = serialized_rounds
+    RECENT_ROWS.move_to_end(token)
+    while len(RECENT_ROWS) > RECENT_ROWS_MAX:
+        RECENT_ROWS.popitem(last=False)
+    with _VIEW_LOCK:
+        VIEW_CACHE.update(layout=STATE["layout"], token=token, rows=serialized_rounds, cut_hits=None, exports={})
+    return _shoe_body(serialized_rounds, ordered_rounds, tail, token)
+
+
+def _shoe_body(serialized_rounds, ordered_rounds, tail, token):
+    """只組回應主體、不記錄任何狀態；token 為 None 表示這副牌不是目前牌靴（合併批次的跟隨者）。"""
+    return {
+        "version": token,
+        "rounds": serialized_rounds,
+        "suit_counts": _suit_counts(ordered_rounds, tail),
+        "vertical": "\n".join(
+            [c.short() for r in ordered_rounds for c in r.cards]
+            + [c.short() for c in (tail or [])]
+        ),
+    }
+
+
+def _cut_hits(rounds, tail, deck):
+    """以 B 順序模擬所有切點，回傳 (rows, avg_hit, avg_rounds)。"""
+    marked = {r.cards[0].pos for r in rounds}
+    if tail:
+        marked.add(tail[0].pos)
+    return waa.simulate_all_cuts(deck, marked, use_b_order=True, rounds=rounds, tail=tail)
+
+
+def _current_view():
+    """回傳目前版面的讀取快取；版面已換（例如由 _sync_state 載入）時重新序列化一次。"""
+    with _VIEW_LOCK:
+        if VIEW_CACHE["layout"] != STATE["layout"]:
+            rows, _ = _serialize_rounds_with_flags(STATE["rounds"], STATE["tail"], _state_settings()["SIGNAL_SUIT"])
+            VIEW_CACHE.update(layout=STATE["layout"], token=None, rows=rows, cut_hits=None, exports={})
+        return VIEW_CACHE
+
+
+def _current_cut_hits():
+    """目前版面的切牌命中統計 (rows, avg_hit, avg_rounds)，同一版面只計算一次。"""
+    view = _current_view()
+    layout = view["layout"]
+    hits = view["cut_hits"]
+    if hits is None:
+        hits = _cut_hits(STATE["rounds"], STATE["tail"], STATE["deck"])
+        with _VIEW_LOCK:
+            if VIEW_CACHE["layout"] == layout:
+                VIEW_CACHE["cut_hits"] = hits
+    return hits
+
+
+def _etag_matches(header, etags):
+    """If-None-Match 是否命中任一 ETag；弱比較（忽略 W/ 前綴），* 一律命中。"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") in etags for tag in header.split(","))
+
+
+def _export_response(request, name, build, *, media_type, headers=None):
+    """以目前版面快取匯出內容：同一版面只呼叫一次 build() 產生文字，編碼與 gzip 後連同 ETag 保存。
+    ETag 取內容雜湊（各 worker 一致），gzip 版本另加 -gz；If-None-Match 命中回 304。"""
+    view = _current_view()
+    layout = view["layout"]
+    entry = view["exports"].get(name)
+    if entry is None:
+        body = build().encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        entry = {"body": body, "gzip": gzip.compress(body, 6),
+                 "etag": f'"{digest}"', "etag_gzip": f'"{digest}-gz"'}
+        with _VIEW_LOCK:
+            if VIEW_CACHE["layout"] == layout:
+                VIEW_CACHE["exports"][name] = entry
+    use_gzip = accepts_encoding(request.headers.get("accept-encoding"), "gzip")
+    headers = {
+        **(headers or {}),
+        "ETag": entry["etag_gzip"] if use_gzip else entry["etag"],
+        "Cache-Control": "no-cache",  # 可以存，但每次都要帶 If-None-Match 重新驗證
+        "Vary": "Accept-Encoding",
+    }
+    if _etag_matches(request.headers.get("if-none-match"), (entry["etag"], entry["etag_gzip"])):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        return Response(entry["gzip"], media_type=media_type, headers={**headers, "Content-Encoding": "gzip"})
+    return Response(entry["body"], media_type=media_type, headers=headers)
+
+
+def _window_rounds(payload, limit):
+    """rounds_limit 有設定時只回傳前 limit 局並附上 rounds_total，其餘由 /api/rounds 分頁取得。"""
+    if limit is not None and "rounds" in payload:
+        payload["rounds_total"] = len(payload["rounds"])
+        payload["rounds"] = payload["rounds"][:max(0, limit)]
+    return payload
+
+
+def _store_shoe(ordered_rounds, tail, deck, *, gen_key=None):
+    """把套用規則後的牌靴寫入牌靴庫，回傳 shoe_id；失敗時回傳 None。
+    gen_key 表示規則緊接在生成後套用，可由 (種子, 嘗試序號) 重建，精簡模式下只存種子。"""
+    lib = get_library()
+    if lib is None:
+        return None
+    key = gen_key or {}
+    try:
+        _, avg_hit, avg_rounds = _cut_hits(ordered_rounds, tail, deck)
+        return lib.save(
+            waa.encode_shoe(ordered_rounds, tail, deck),
+            signal_suit=waa.setting("SIGNAL_SUIT"),
+            tie_suit=waa.setting("TIE_SIGNAL_SUIT"),
+            rounds_len=len(ordered_rounds),
+            tail_len=len(tail or []),
+            avg_hit=avg_hit,
+            avg_rounds=avg_rounds,
+            num_decks=len(deck) // 52,
+            **key,
+        )
+    except Exception as exc:
+        # 牌靴庫只是快取，寫入失敗不影響生成結果
+        print(f"[API] store shoe failed: {exc}")
+        return None
+
+
+def _load_library_shoe(row):
+    """把牌靴庫紀錄還原成目前牌靴，回傳與 generate_shoe 相同格式的資料。
+    精簡紀錄（cards 為空）以種子重建。旗標計算與重建都依該牌靴生成時的花色與副數。"""
+    settings = waa.settings_for(row["signal_suit"], row["tie_suit"] or None, row["num_decks"])
+    with waa.generation_settings(settings):
+        return _load_library_row(row)
+
+
+def _load_library_row(row):
+    if row["cards"]:
+        rounds, tail, deck = waa.decode_shoe(row["cards"])
+    else:
+        try:
+            rounds, tail, deck = waa.regenerate_shoe(
+                row["seed"], row["attempt"], config_hash=row["config_hash"])
+        except (ValueError, RuntimeError) as exc:
+            return {"error": "regenerate_failed", "detail": str(exc)}
+    serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(rounds, tail)
+    _update_state(rounds=ordered_rounds, tail=tail, deck=deck)
+    payload = _shoe_payload(serialized_rounds, ordered_rounds, tail, f"{STATE['version']}:g")
+    payload["meta"] = {
+        "rounds_len": len(ordered_rounds), "tail_len": len(tail), "deck_len": len(deck),
+        "fallback": None, "shoe_id": row["id"], "source": "library",
+    }
+    return payload
+
+
+def _partial_result(rounds, leftover, deck, *, coverage, attempts, elapsed_ms, rules_error=None):
+    """部分結果的回應；rules_error 不為 None 表示規則沒有套用成功（meta.rules_applied=false），牌面為原始花色。"""
+    serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(rounds, leftover)
+    _update_state(rounds=ordered_rounds, tail=leftover, deck=deck)
+    payload = _shoe_payload(serialized_rounds, ordered_rounds, leftover, f"{STATE['version']}:g")
+    payload["partial"] = True
+    payload["meta"] = {
+        "rounds_len": len(ordered_rounds), "tail_len": len(leftover), "deck_len": len(deck),
+        "fallback": None, "shoe_id": None, "source": "partial", "complete": False,
+        "coverage": round(coverage, 4), "attempts": attempts, "elapsed_ms": round(elapsed_ms, 1),
+        "rules_applied": rules_error is None,
+    }
+    if rules_error is not None:
+        payload["meta"]["rules_error"] = rules_error
+    return payload
+
+
+def _candidate_meta(meta, scores, objective):
+    """多候選生成時在 meta 附上排序目標與每副候選的切牌分數。"""
+    if scores is not None:
+        meta["objective"] = objective or waa.CANDIDATE_OBJECTIVE
+        meta["candidates"] = scores
+    return meta
+
+
+def _generate_candidates(req):
+    """多候選生成：平行產生 req.candidates 副牌，回傳切牌分析最佳的一副，meta 附全部分數。"""
+    started = time.perf_counter()
+    try:
+        (rounds, tail, deck), gen_key, scores = waa.generate_ranked_candidates(
+            min(req.candidates, MAX_CANDIDATES), objective=req.objective, deadline_ms=req.deadline_ms)
+    except ValueError as exc:
+        return {"error": "invalid_objective", "detail": str(exc)}
+    except RuntimeError as exc:
+        return {"error": "post_process_failed", "detail": str(exc)}
+    serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(rounds, tail)
+    _update_state(rounds=ordered_rounds, tail=tail, deck=deck)
+    shoe_id = _store_shoe(ordered_rounds, tail, deck, gen_key=gen_key)
+    payload = _shoe_payload(serialized_rounds, ordered_rounds, tail, f"{STATE['version']}:g")
+    payload["meta"] = _candidate_meta({
+        "rounds_len": len(ordered_rounds), "tail_len": len(tail), "deck_len": len(deck),
+        "fallback": None, "shoe_id": shoe_id, "source": "candidates", "complete": True,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }, scores, req.objective)
+    return payload
+
+
+def _generate_via_pool(pool, req):
+    """把生成交給共用工作池，結果從共享記憶體解碼後照本機路徑整理成回應。"""
+    timeout = req.deadline_ms / 1000 + 30 if req.deadline_ms is not None else None
+    try:
+        reply = pool.generate(signal_suit=waa.setting("SIGNAL_SUIT"), tie_suit=waa.setting("TIE_SIGNAL_SUIT"),
+                              deadline_ms=req.deadline_ms, timeout=timeout,
+                              candidates=min(req.candidates, MAX_CANDIDATES), objective=req.objective,
+                              num_decks=waa.setting("NUM_DECKS"))
+    except (OSError, EOFError) as exc:
+        return {"error": "pool_unavailable", "detail": str(exc)}
+    if "error" in reply:
+        return reply
+    rounds, tail, deck = load_shared_shoe(reply)
+    if reply["partial"]:
+        return _partial_result(rounds, tail, deck, coverage=reply["coverage"],
+                               attempts=reply["attempts"], elapsed_ms=reply["elapsed_ms"],
+                               rules_error=reply.get("rules_error"))
+    serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(rounds, tail)
+    _update_state(rounds=ordered_rounds, tail=tail, deck=deck)
+    shoe_id = _store_shoe(ordered_rounds, tail, deck, gen_key=reply["gen_key"])
+    payload = _shoe_payload(serialized_rounds, ordered_rounds, tail, f"{STATE['version']}:g")
+    payload["meta"] = _candidate_meta({
+        "rounds_len": len(ordered_rounds), "tail_len": len(tail), "deck_len": len(deck),
+        "fallback": None, "shoe_id": shoe_id, "source": "pool", "complete": True,
+        "elapsed_ms": round(reply["elapsed_ms"], 1),
+    }, reply.get("candidates"), req.objective)
+    return payload
+
+
 def _rebuild_after_cut(deck, cut_pos):
     """切牌後依序模擬發牌，回傳新的 Round 清單。"""
     if not WAA_OK:
@@ -268,156 +669,701 @@ def _rebuild_after_cut(deck, cut_pos):
     return rounds
 
 
+def _cut_key(cut_pos, length):
+    """把切點正規化成 0..length-1，與 deck[cut_pos:] + deck[:cut_pos] 的切片結果一致。"""
+    if 0 <= cut_pos < length:
+        return cut_pos
+    if -length <= cut_pos < 0:
+        return cut_pos + length
+    return 0
+
+
+def _compute_cut_outcome(deck, tail, cut_pos, rules):
+    """在牌的副本上重建切牌後的回合並以 rules（waa.rule_config() 快照）套用規則，結果以 waa.encode_shoe 壓縮保存。
+    用副本是因為 apply_shoe_rules 會就地改花色，不能影響目前牌靴或其他切點。"""
+    copies = {c.pos: waa.Card(c.rank, c.suit, c.pos, c.color) for c in deck}
+    cdeck = [copies[c.pos] for c in deck]
+    ctail = [copies[c.pos] for c in (tail or [])]
+    rebuilt_rounds = _rebuild_after_cut(cdeck, cut_pos)
+    if not rebuilt_rounds:
+        return {"error": "cut_failed"}
+    try:
+        processed_rounds, processed_tail = waa.apply_shoe_rules(rebuilt_rounds, ctail, config=rules)
+    except (RuntimeError, AssertionError) as exc:
+        # enforce_suit_distribution 以 assert 回報配額失敗，視同規則套用失敗
+        return {"error": "post_process_failed", "detail": str(exc)}
+    return {"blob": waa.encode_shoe(processed_rounds, processed_tail, cdeck), "signal_suit": rules["signal_suit"]}
+
+
+def _cut_outcome(key):
+    """查切點（已正規化）結果；不在快取時以這副牌的規則快照當場計算，寫回 LRU 快取。"""
+    version, deck, tail = STATE["version"], STATE["deck"], STATE["tail"]
+    with _CUT_LOCK:
+        outcomes = CUT_CACHE["outcomes"]
+        if CUT_CACHE["version"] == version and key in outcomes:
+            outcomes.move_to_end(key)
+            return outcomes[key]
+        rules = CUT_CACHE["rules"] if CUT_CACHE["version"] == version else None
+    if rules is None:
+        with waa.generation_settings(_state_settings()):
+            rules = waa.rule_config()
+    outcome = _compute_cut_outcome(deck, tail, key, rules)
+    with _CUT_LOCK:
+        if CUT_CACHE["version"] == version:
+            outcomes = CUT_CACHE["outcomes"]
+            outcomes[key] = outcome
+            outcomes.move_to_end(key)
+            while len(outcomes) > CUT_CACHE_MAX:
+                outcomes.popitem(last=False)
+    return outcome
+
+
+def _reset_cut_cache(version):
+    """換牌靴時呼叫（此時生效的 waa 設定就是這副牌的設定）：清空切牌快取並連同版本號記下規則快照。"""
+    rules = waa.rule_config() if WAA_OK else None
+    with _CUT_LOCK:
+        CUT_CACHE.update(version=version, rules=rules, outcomes=OrderedDict())
+
+
+def _cut_delta(payload, base_token, key, length):
+    """以前端持有的 base_token 版面為基準組出差量回應；基準已失效時回傳 None。
+    內容完全相同的局只回傳 [新索引, 基準索引]，其餘局才帶完整資料。"""
+    base_rows = RECENT_ROWS.get(base_token)
+    version, _, base_cut = base_token.partition(":")
+    if base_rows is None or version != str(STATE["version"]):
+        return None
+    base_index = {}
+    for i, row in enumerate(base_rows):
+        base_index.setdefault(json.dumps(row, sort_keys=True, ensure_ascii=False), i)
+    reuse, changed = [], {}
+    for i, row in enumerate(payload["rounds"]):
+        j = base_index.get(json.dumps(row, sort_keys=True, ensure_ascii=False))
+        if j is None:
+            changed[i] = row
+        else:
+            reuse.append([i, j])
+    rotation = key if base_cut == "g" else (key - int(base_cut)) % length
+    return {
+        "delta": True,
+        "version": payload["version"],
+        "base_version": base_token,
+        "cut_pos": key,
+        "rotation": rotation,
+        "boundaries": [len(row["cards"]) for row in payload["rounds"]],
+        "reuse": reuse,
+        "rounds": changed,
+        "suit_counts": payload["suit_counts"],
+    }
+
+
 # --- API 端點 ---
 @app.post("/api/generate_shoe")
-def generate_shoe(req: GenReq):
+def generate_shoe(req: GenReq, request: Request):
     """產生敏感鞋，並整合 fallback 邏輯與序列化資料。"""
+    return _window_rounds(_generate(req, group=getattr(request.state, "batch", None),
+                                    spent_ms=getattr(request.state, "deadline_spent_ms", 0.0)), req.rounds_limit)
+
+
+def _generate_batch(req, group):
+    """合併的相同請求：以一批平行生成替領頭與每個跟隨請求各產生一副不同的牌。
+    只有領頭的那副寫入 STATE 成為目前牌靴並回傳；跟隨者的牌只寫入牌靴庫，回應經 group 交付，
+    version 為 None（不是目前牌靴，沒有差量比對與分頁可用），以 meta.shoe_id 經 /api/library/{id}/load 載入，
+    因此不套用 rounds_limit。一副都沒產生時回傳 None（領頭照常生成）。"""
+    extra = group.seal()
+    started = time.perf_counter()
+    try:
+        built = waa.generate_parallel_shoes(extra + 1, deadline_ms=req.deadline_ms)
+    except RuntimeError as exc:
+        print(f"[API] batch generation failed: {exc}")
+        built = []
+    if not built:
+        group.deliver([])
+        return None
+
+    def meta(ordered_rounds, tail, deck, shoe_id):
+        return {
+            "rounds_len": len(ordered_rounds), "tail_len": len(tail), "deck_len": len(deck),
+            "fallback": None, "shoe_id": shoe_id, "source": "batch", "complete": True,
+            "coalesced": extra + 1, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
+
+    followers = []
+    for _, gen_key, (rounds, tail, deck) in built[1:]:
+        serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(rounds, tail)
+        shoe_id = _store_shoe(ordered_rounds, tail, deck, gen_key=gen_key)
+        payload = _shoe_body(serialized_rounds, ordered_rounds, tail, None)
+        payload["meta"] = meta(ordered_rounds, tail, deck, shoe_id)
+        followers.append(payload)
+    group.deliver(followers)
+
+    _, gen_key, (rounds, tail, deck) = built[0]
+    serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(rounds, tail)
+    _update_state(rounds=ordered_rounds, tail=tail, deck=deck)
+    shoe_id = _store_shoe(ordered_rounds, tail, deck, gen_key=gen_key)
+    leader = _shoe_payload(serialized_rounds, ordered_rounds, tail, f"{STATE['version']}:g")
+    leader["meta"] = meta(ordered_rounds, tail, deck, shoe_id)
+    return leader
+
+
+def _remaining_deadline(req, spent_ms):
+    """從 req.deadline_ms 扣掉已花掉的毫秒數，回傳改用剩餘預算的請求；預算已用完回傳 None。"""
+    if req.deadline_ms is None or spent_ms <= 0:
+        return req
+    remaining = int(req.deadline_ms - spent_ms)
+    if remaining <= 0:
+        return None
+    return req.model_copy(update={"deadline_ms": remaining})
+
+
+def _deadline_exhausted(req, spent_ms):
+    return {"error": "deadline_exceeded",
+            "detail": f"deadline_ms={req.deadline_ms} used up after {spent_ms:.0f} ms before generation could run"}
+
+
+def _generate(req, progress=None, group=None, spent_ms=0.0):
+    """generate_shoe 的主體；progress 會收到嘗試、規則重試與各階段耗時事件（供 /ws/generate 串流）。
+    group 為合併請求的 BatchGroup（見 coalesce.py），有跟隨者時改以一批平行生成。
+    spent_ms 是合併跟隨者等待批次已花掉的時間，從 deadline_ms 扣除。
+    副數、花色與該花色組合的調參值只在本請求的 waa.generation_settings 區塊內生效，不改寫 waa 的模組設定。"""
     if not WAA_OK:
         return {"error": "server_unavailable"}
-    # 依請求安全地覆寫 waa 的可調整設定（若存在）
+    num_decks = req.num_decks or DEFAULT_NUM_DECKS
+    if not 1 <= num_decks <= waa.MAX_NUM_DECKS:
+        return {"error": "invalid_num_decks", "detail": f"num_decks must be 1..{waa.MAX_NUM_DECKS}"}
+    signal_suit = _normalize_suit_input(req.signal_suit) if isinstance(req.signal_suit, str) else None
+    tie_suit = _normalize_suit_input(req.tie_signal_suit) if req.tie_signal_suit else None
+    remaining = _remaining_deadline(req, spent_ms)
+    if remaining is None:
+        return _deadline_exhausted(req, spent_ms)
+    settings = waa.settings_for(signal_suit or waa.SIGNAL_SUIT, tie_suit, num_decks)
+    with waa.generation_settings(settings):
+        return _generate_with_settings(remaining, progress, group)
+
+
+def _generate_with_settings(req, progress, group):
+    def emit(event):
+        if progress is not None:
+            progress(event)
+
+    if req.reuse_library:
+        lib = get_library()
+        found = lib.query(
+            signal_suit=waa.setting("SIGNAL_SUIT"), tie_suit=waa.setting("TIE_SIGNAL_SUIT") or "",
+            num_decks=waa.setting("NUM_DECKS"), random_order=True, limit=1,
+        ) if lib else []
+        if found:
+            return _load_library_shoe(lib.get(found[0]["id"]))
+    pool = get_pool()
+    if pool is not None:
+        return _generate_via_pool(pool, req)
+    if req.candidates > 1:
+        return _generate_candidates(req)
+    if group is not None and group.seal():
+        batch_started = time.perf_counter()
+        payload = _generate_batch(req, group)
+        if payload is not None:
+            return payload
+        # 批次沒產生領頭的牌：只用剩下的預算自行生成，批次已耗盡預算時直接回報逾時
+        spent_ms = (time.perf_counter() - batch_started) * 1000
+        remaining = _remaining_deadline(req, spent_ms)
+        if remaining is None:
+            return _deadline_exhausted(req, spent_ms)
+        req = remaining
     try:
-        if hasattr(waa, "NUM_SHOES"):
-            setattr(waa, "NUM_SHOES", int(req.num_shoes))
-        if hasattr(waa, "SIGNAL_SUIT") and isinstance(req.signal_suit, str):
-            normalized = _normalize_suit_input(req.signal_suit)
-            if normalized:
-                setattr(waa, "SIGNAL_SUIT", normalized)
-        # 和局訊號花色（若演算法支援且有設定值才覆寫）
-        if hasattr(waa, "TIE_SIGNAL_SUIT"):
-            if req.tie_signal_suit:
-                normalized_tie = _normalize_suit_input(req.tie_signal_suit)
-                if normalized_tie:
-                    setattr(waa, "TIE_SIGNAL_SUIT", normalized_tie)
-            else:
-                setattr(waa, "TIE_SIGNAL_SUIT", None)
-    except Exception:
-        # 即使設定失敗也不中斷主流程
+        shoe = waa.generate_ruled_shoe(deadline_ms=req.deadline_ms, progress=progress)
+    except waa.GenerationDeadline as exc:
+        return {"error": "deadline_exceeded", "detail": str(exc)}
+    except RuntimeError as exc:
+        return {"error": "post_process_failed", "detail": str(exc)}
+    if shoe.partial:
+        return _partial_result(shoe.rounds, shoe.tail, shoe.deck, coverage=shoe.coverage, attempts=shoe.attempts,
+                               elapsed_ms=shoe.elapsed_ms, rules_error=shoe.rules_error)
+    print(f"[API] generate_shoe: rounds={len(shoe.rounds)} tail={len(shoe.tail)} deck={len(shoe.deck)}")
+    phase_started = time.perf_counter()
+    serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(shoe.rounds, shoe.tail)
+    _emit_phase(emit, "serialize", phase_started)
+    _update_state(rounds=ordered_rounds, tail=shoe.tail, deck=shoe.deck)
+    shoe_id = _store_shoe(ordered_rounds, shoe.tail, shoe.deck, gen_key=shoe.gen_key)
+    payload = _shoe_payload(serialized_rounds, ordered_rounds, shoe.tail, f"{STATE['version']}:g")
+    payload["meta"] = {
+        "rounds_len": len(ordered_rounds), "tail_len": len(shoe.tail), "deck_len": len(shoe.deck),
+        "fallback": None, "shoe_id": shoe_id, "source": "generated", "complete": True,
+        "elapsed_ms": round(shoe.elapsed_ms, 1),
+    }
+    return payload
+
+
+def _emit_phase(emit, phase, since):
+    """送出一個階段耗時事件，回傳現在時間作為下一階段的起點。"""
+    now = time.perf_counter()
+    emit({"type": "phase", "phase": phase, "ms": round((now - since) * 1000, 1)})
+    return now
+
+
+# 串流回合時每個訊息帶的局數
+WS_ROUNDS_CHUNK = 16
+
+
+@app.websocket("/ws/generate")
+async def generate_ws(ws: WebSocket):
+    """以 WebSocket 串流生成進度：收到一個 GenReq JSON 後送出 attempt / rule_retry / phase 事件，
+    接著以 rounds 訊息分批送出回合，最後以 done（suit_counts、vertical、meta、version、queue_wait_ms）
+    或 error 結束。用戶端中途離線時停止轉送，已開始的生成在執行緒池中照常跑完。"""
+    await ws.accept()
+    try:
+        await _generate_ws(ws)
+    except WebSocketDisconnect:
         pass
-    last_error = None
-    max_rule_retry = getattr(waa, "MAX_RULE_RETRY", 10)
-    for attempt in range(max_rule_retry):
-        rounds, tail, deck = waa.generate_all_sensitive_shoe_or_retry(
-            max_attempts=waa.MAX_ATTEMPTS,
-            min_tail_stop=waa.MIN_TAIL_STOP,
-            multi_pass_min_cards=waa.MULTI_PASS_MIN_CARDS,
-        )
-        try:
-            print(f"[API] generate_shoe: rounds={len(rounds)} tail={len(tail)} deck={len(deck)}")
-        except Exception:
-            pass
-        # Fallback：若主流程沒有找到敏感局，改用 deck 再掃描；仍為 0 就退回切牌重建
-        use_rounds = rounds
-        fb = None
-        if not use_rounds and deck:
-            try:
-                sim = waa.Simulator(deck)
-                scanned = waa.scan_all_sensitive_rounds(sim)
-                if scanned:
-                    use_rounds = scanned
-                    fb = "scan"
-            except Exception:
-                pass
-        if (not use_rounds) and deck:
-            rebuilt = _rebuild_after_cut(deck, 0)
-            if rebuilt:
-                use_rounds = rebuilt
-                fb = fb or "all"
 
-        try:
-            processed_rounds, processed_tail = waa.apply_shoe_rules(use_rounds, tail)
-        except RuntimeError as exc:
-            last_error = exc
-            continue
 
-        serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(processed_rounds, processed_tail)
-        STATE.update({"rounds": ordered_rounds, "tail": processed_tail, "deck": deck})
-        return {
-            "rounds": serialized_rounds,
-            "suit_counts": _suit_counts(ordered_rounds, processed_tail),
-            "vertical": "\n".join(
-                [c.short() for r in ordered_rounds for c in r.cards]
-                + [c.short() for c in (processed_tail or [])]
-            ),
-            "meta": {"rounds_len": len(ordered_rounds), "tail_len": len(processed_tail), "deck_len": len(deck), "fallback": fb}
-        }
+async def _generate_ws(ws):
+    try:
+        req = GenReq(**await ws.receive_json())
+    except (ValueError, TypeError) as exc:
+        await ws.send_json({"type": "error", "error": "bad_request", "detail": str(exc)})
+        await ws.close()
+        return
+    gate = GATES["generate"]
+    if gate.saturated():
+        gate.rejected += 1
+        await ws.send_json({"type": "error", "error": "busy", "retry_after": gate.retry_after()})
+        await ws.close()
+        return
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
 
-    return {"error": "post_process_failed", "detail": str(last_error) if last_error else "unknown"}
+    def progress(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    job = asyncio.ensure_future(gate.run(lambda: run_in_threadpool(_generate, req, progress)))
+    # 連線中斷時沒有人讀 job 的結果；先取走例外，避免事件迴圈記錄 "exception was never retrieved"
+    job.add_done_callback(lambda fut: fut.cancelled() or fut.exception())
+    # 生成進行中持續轉送事件；生成結束且事件都送完才往下
+    while not (job.done() and events.empty()):
+        getter = asyncio.ensure_future(events.get())
+        done, _ = await asyncio.wait({job, getter}, return_when=asyncio.FIRST_COMPLETED)
+        if getter in done:
+            await ws.send_json(getter.result())
+        else:
+            getter.cancel()
+    try:
+        payload, wait_ms = job.result()
+    except Exception as exc:
+        payload, wait_ms = {"error": "generation_failed", "detail": str(exc)}, 0.0
+    if "error" in payload:
+        await ws.send_json({"type": "error", **payload})
+        await ws.close()
+        return
+    rounds = payload.pop("rounds")
+    for offset in range(0, len(rounds), WS_ROUNDS_CHUNK):
+        await ws.send_json({"type": "rounds", "offset": offset, "rounds": rounds[offset:offset + WS_ROUNDS_CHUNK]})
+    await ws.send_json({"type": "done", "queue_wait_ms": round(wait_ms, 1), **payload})
+    await ws.close()
 
 
 @app.post("/api/simulate_cut")
 def simulate_cut(req: CutReq):
-    """依據指定切點重建回合序列，並更新快取資料。"""
+    """依據指定切點取出（預先計算好的）切牌結果，並更新目前回合資料。
+    帶 base_version 時回傳差量：rotation、各局張數 boundaries、可沿用的局 reuse 與變動的局 rounds；
+    前端依 boundaries 長度逐局取 rounds[i] 或 reuse 指向的基準局即可還原完整資料。"""
     if not WAA_OK:
         return {"error": "server_unavailable"}
+    _sync_state()
     if not STATE["deck"]:
         return {"error": "no_shoe"}
-    rebuilt_rounds = _rebuild_after_cut(STATE["deck"], req.cut_pos)
-    if not rebuilt_rounds:
-        return {"error": "cut_failed"}
-    try:
-        processed_rounds, processed_tail = waa.apply_shoe_rules(rebuilt_rounds, STATE["tail"])
-    except RuntimeError as exc:
-        return {"error": "post_process_failed", "detail": str(exc)}
-    serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(processed_rounds, processed_tail)
-    STATE["rounds"] = ordered_rounds
-    STATE["tail"] = processed_tail
+    key = _cut_key(req.cut_pos, len(STATE["deck"]))
+    outcome = _cut_outcome(key)
+    if "error" in outcome:
+        return dict(outcome)
+    processed_rounds, processed_tail, _ = waa.decode_shoe(outcome["blob"])
+    serialized_rounds, ordered_rounds = _serialize_rounds_with_flags(
+        processed_rounds, processed_tail, outcome["signal_suit"])
+    _update_state(rounds=ordered_rounds, tail=processed_tail)
+    payload = _shoe_payload(serialized_rounds, ordered_rounds, processed_tail, f"{STATE['version']}:{key}")
+    if req.base_version:
+        delta = _cut_delta(payload, req.base_version, key, len(STATE["deck"]))
+        if delta is not None:
+            return delta
+    return _window_rounds(payload, req.rounds_limit)
+
+
+@app.get("/api/rounds")
+def rounds_page(offset: int = 0, limit: int = 50):
+    """分頁讀取目前版面的回合（格式同 generate_shoe 的 rounds，尾局在最後）；
+    資料取自最近一次回應的序列化結果，不重算。"""
+    if not WAA_OK:
+        return {"error": "server_unavailable"}
+    _sync_state()
+    if not STATE["deck"]:
+        return {"error": "no_shoe"}
+    view = _current_view()
+    rows = view["rows"]
+    offset = max(0, offset)
+    limit = max(1, min(limit, MAX_PAGE_ROWS))
     return {
-        "rounds": serialized_rounds,
-        "suit_counts": _suit_counts(ordered_rounds, processed_tail),
-        "vertical": "\n".join(
-            [c.short() for r in ordered_rounds for c in r.cards]
-            + [c.short() for c in (processed_tail or [])]
-        ),
+        "version": view["token"],
+        "total": len(rows),
+        "offset": offset,
+        "limit": limit,
+        "rounds": rows[offset:offset + limit],
+    }
+
+
+@app.get("/api/cut_hits")
+def cut_hits_range(
+    from_: int = Query(1, alias="from"),
+    to: Optional[int] = None,
+):
+    """讀取目前版面切點 from..to（1 起算、含兩端）的命中統計；整副的分析只算一次並快取。
+    每列為 [切點, 命中用張, 命中位置, 命中牌, 局數]，平均值仍以全部切點計算。"""
+    if not WAA_OK:
+        return {"error": "server_unavailable"}
+    _sync_state()
+    if not STATE["deck"] or not STATE["rounds"]:
+        return {"error": "no_shoe"}
+    rows, avg_hit, avg_rounds = _current_cut_hits()
+    start = max(1, from_)
+    end = min(len(rows), to if to is not None else start + MAX_PAGE_ROWS - 1, start + MAX_PAGE_ROWS - 1)
+    return {
+        "version": _current_view()["token"],
+        "total": len(rows),
+        "from": start,
+        "to": end,
+        "avg_hit": avg_hit,
+        "avg_rounds": avg_rounds,
+        "rows": [list(r) for r in rows[start - 1:end]],
     }
 
 
 @app.post("/api/scan")
 def scan(req: ScanReq):
-    """預留掃描功能，目前尚未實作，固定回傳空結果。"""
-    # 尚未提供掃描演算法，先回傳 0
-    return {"hits": [], "count": 0}
+    """查詢目前牌靴中符合 (莊點, 閒點, 用張) 的局；索引於生成 / 切牌時預先建好。"""
+    _sync_state()
+    key = (req.banker_point, req.player_point, req.used_cards)
+    rounds, tail, index = STATE["scan"]  # 同一版面的回合與索引
+    seqs = rounds + ([tail] if tail else [])
+    hits = []
+    for idx in index.get(key, []):
+        item = seqs[idx]
+        is_tail = idx == len(rounds)
+        cards = item if is_tail else item.cards
+        hits.append({
+            "round": idx + 1,
+            "start": cards[0].pos,
+            "used_cards": len(cards),
+            "result": (waa._seq_result(cards) or '') if is_tail else item.result,
+            "is_tail": is_tail,
+        })
+    out = {"hits": hits, "count": len(hits)}
+    if req.include_library:
+        lib = get_library()
+        out["library"] = lib.scan(*key) if lib else []
+    return out
 
 
 @app.get("/api/export/vertical")
-def export_vertical_plain():
-    """輸出目前 rounds 及 tail 的直式牌序，提供前端下載。"""
+def export_vertical_plain(request: Request):
+    """輸出目前 rounds 及 tail 的直式牌序，提供前端下載（同一版面快取並支援 If-None-Match）。"""
+    _sync_state()
     if not STATE["rounds"] and not STATE["tail"]:
         return Response("No data", media_type="text/plain")
-    text = "\n".join([c.short() for r in STATE["rounds"] for c in r.cards] + [c.short() for c in STATE["tail"]])
-    return Response(text, media_type="text/plain")
+
+    def build():
+        return "\n".join([c.short() for r in STATE["rounds"] for c in r.cards] + [c.short() for c in STATE["tail"]])
+    return _export_response(request, "vertical", build, media_type="text/plain")
 
 
 @app.get("/api/export/cut_hits.csv")
-def export_cut_hits_csv():
-    """輸出切牌命中統計 CSV，方便後續離線分析。"""
+def export_cut_hits_csv(request: Request):
+    """輸出切牌命中統計 CSV，方便後續離線分析（同一版面快取並支援 If-None-Match）。"""
     if not WAA_OK:
         return Response("Server unavailable", media_type="text/plain", status_code=503)
+    _sync_state()
     if not STATE["deck"] or not STATE["rounds"]:
         return Response("No data", media_type="text/plain", status_code=404)
 
-    marked = {r.cards[0].pos for r in STATE["rounds"]}
-    if STATE["tail"]:
-        marked.add(STATE["tail"][0].pos)
-    rows, avg_hit, avg_rounds = waa.simulate_all_cuts(
-        STATE["deck"], marked, use_b_order=True, rounds=STATE["rounds"], tail=STATE["tail"]
-    )
+    def build():
+        rows, avg_hit, avg_rounds = _current_cut_hits()
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        headers = ['鞋號', '用張', '索引', '命中', '局數']
+        w.writerow(['切牌命中統計'])
+        w.writerow(headers)
+        for r in rows:
+            w.writerow(r)
+        w.writerow(['', '', '', '', ''])
+        w.writerow(['平均', f"{avg_hit:.3f}", '', '', f"{avg_rounds:.3f}"])
+        return buf.getvalue()
 
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    headers = ['鞋號', '用張', '索引', '命中', '局數']
-    w.writerow(['切牌命中統計'])
-    w.writerow(headers)
-    for r in rows:
-        w.writerow(r)
-    w.writerow(['', '', '', '', ''])
-    w.writerow(['平均', f"{avg_hit:.3f}", '', '', f"{avg_rounds:.3f}"])
     ts = time.strftime("%Y%m%d_%H%M%S")
-    data = buf.getvalue()
-    return Response(
-        data, media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename=cut_hits_{ts}.csv"}
+    return _export_response(
+        request, "cut_hits", build, media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=cut_hits_{ts}.csv"},
     )
 
+@app.get("/api/library")
+def library_query(
+    signal_suit: Optional[str] = None,
+    tie_suit: Optional[str] = None,
+    rounds_len: Optional[int] = None,
+    tail_len: Optional[int] = None,
+    min_avg_hit: Optional[float] = None,
+    max_avg_hit: Optional[float] = None,
+    min_avg_rounds: Optional[float] = None,
+    max_avg_rounds: Optional[float] = None,
+    seed: Optional[int] = None,
+    num_decks: Optional[int] = None,
+    limit: int = 50,
+    offset: int = 0,
+):
+    """依花色、局數與切牌統計查詢牌靴庫（只回傳中繼資料）。"""
+    lib = get_library()
+    if lib is None:
+        return {"error": "library_unavailable"}
+    shoes = lib.query(
+        signal_suit=_normalize_suit_input(signal_suit),
+        # tie_suit 帶空值代表查「未設定和局花色」的牌靴
+        tie_suit=(_normalize_suit_input(tie_suit) or "") if tie_suit is not None else None,
+        rounds_len=rounds_len, tail_len=tail_len,
+        min_avg_hit=min_avg_hit, max_avg_hit=max_avg_hit,
+        min_avg_rounds=min_avg_rounds, max_avg_rounds=max_avg_rounds,
+        seed=seed, num_decks=num_decks, limit=max(1, min(limit, 500)), offset=max(0, offset),
+    )
+    return {"shoes": shoes, "count": len(shoes)}
+
+
+@app.post("/api/library/{shoe_id}/load")
+def library_load(shoe_id: int):
+    """把牌靴庫中的指定牌靴載入為目前牌靴，回應格式同 generate_shoe。"""
+    if not WAA_OK:
+        return {"error": "server_unavailable"}
+    lib = get_library()
+    if lib is None:
+        return {"error": "library_unavailable"}
+    row = lib.get(shoe_id)
+    if row is None:
+        return {"error": "not_found"}
+    return _load_library_shoe(row)
+
+
+def _store_imported(accepted):
+    """把通過驗證的匯入牌靴寫入牌靴庫：切牌統計整批計算（有 numpy 時一次算完），無種子可重建，一律存完整牌序。"""
+    lib = get_library()
+    if lib is None:
+        return
+    shoes = [waa.imported_shoe(record, out["sizes"]) for out, record in accepted]
+    try:
+        scores = waa.score_shoe_cuts(shoes)
+    except Exception as exc:
+        print(f"[API] import scoring failed: {exc}")
+        scores = [{}] * len(shoes)
+    for (out, _), (rounds, tail, deck), score in zip(accepted, shoes, scores):
+        try:
+            out["shoe_id"] = lib.save(
+                waa.encode_shoe(rounds, tail, deck),
+                signal_suit=out["signal_suit"], tie_suit=out["tie_suit"],
+                rounds_len=len(rounds), tail_len=len(tail),
+                avg_hit=score.get("avg_hit"), avg_rounds=score.get("avg_rounds"),
+                num_decks=len(deck) // 52,
+            )
+        except Exception as exc:
+            print(f"[API] store imported shoe failed: {exc}")
+
+
+def _import_batch(lines, first_index, store, defaults):
+    """驗證一批匯入行，回傳 (NDJSON 結果列, 通過數, 寫入數)；store 時通過的牌靴寫入牌靴庫並附 shoe_id。"""
+    results, accepted = [], []
+    for index, line in enumerate(lines, first_index):
+        record, out = waa.verify_line(line, **defaults)
+        out["index"] = index
+        results.append(out)
+        if store and out["ok"]:
+            accepted.append((out, record))
+    if accepted:
+        _store_imported(accepted)
+    for out in results:
+        out.pop("sizes", None)
+    text = "".join(json.dumps(out, ensure_ascii=False) + "\n" for out in results)
+    return text, sum(out["ok"] for out in results), sum("shoe_id" in out for out in results)
+
+
+class _UploadStreamingResponse(StreamingResponse):
+    """邊讀請求主體邊送出的串流回應。Starlette 的 StreamingResponse 送出時會另開工作呼叫 receive 等斷線，
+    把端點還沒讀到的請求主體吃掉；這裡只送出內容，斷線由端點的 request.stream() 拋出 ClientDisconnect 結束。"""
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
+@app.post("/api/import")
+async def import_shoes(
+    request: Request,
+    store: bool = False,
+    signal_suit: Optional[str] = None,
+    tie_suit: Optional[str] = None,
+    num_decks: Optional[int] = None,
+):
+    """批次匯入外部牌靴：請求主體為 JSON Lines（每行一副，格式見 waa.verify_shoe 上方說明），
+    邊接收邊以 IMPORT_BATCH 副為一批在執行緒池驗證，不必把整個主體讀進記憶體。
+    回應為串流 NDJSON，每批驗證完就送出該批結果：每副一行 {index, id?, ok, cards, rounds, violation_count, violations[], shoe_id?}，
+    最後一行 {summary: {shoes, ok, failed, stored, elapsed_ms, shoes_per_sec}}。
+    參數的花色 / 副數是預設值，紀錄內的同名欄位優先；store=true 時通過的牌靴寫入牌靴庫。"""
+    if not WAA_OK:
+        return {"error": "server_unavailable"}
+    defaults = {
+        "signal_suit": _normalize_suit_input(signal_suit) or waa.SIGNAL_SUIT,
+        "tie_suit": _normalize_suit_input(tie_suit),
+        "num_decks": num_decks or DEFAULT_NUM_DECKS,
+    }
+    started = time.perf_counter()
+    count = ok = stored = 0
+
+    async def verify(batch):
+        nonlocal count, ok, stored
+        text, passed, saved = await run_in_threadpool(_import_batch, batch, count + 1, store, defaults)
+        count, ok, stored = count + len(batch), ok + passed, stored + saved
+        return text
+
+    async def lines():
+        batch, pending = [], b""
+        async for data in request.stream():
+            *complete, pending = (pending + data).split(b"\n")
+            batch.extend(line for line in complete if line.strip())
+            if len(batch) >= IMPORT_BATCH:
+                yield await verify(batch)
+                batch = []
+        if pending.strip():
+            batch.append(pending)
+        if batch:
+            yield await verify(batch)
+        elapsed = time.perf_counter() - started
+        summary = {"shoes": count, "ok": ok, "failed": count - ok, "stored": stored,
+                   "elapsed_ms": round(elapsed * 1000, 1),
+                   "shoes_per_sec": round(count / elapsed, 1) if elapsed else None}
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return _UploadStreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/api/admission")
+def admission_stats():
+    """各端點類別的准入狀態：執行中、排隊中、拒絕次數與平均等待；coalesce 為請求合併的統計。"""
+    return {
+        **{name: gate.stats() for name, gate in GATES.items()},
+        "coalesce": {**BATCHES.stats(), "shared": IDEMPOTENCY.shared, "replayed": IDEMPOTENCY.replayed},
+    }
+
+
+# --- 暖機與健康檢查 ---
+WARMUP_ENABLED = os.getenv("WAA_WARMUP", "1") == "1"
+WARMUP_PREFILL = os.getenv("WAA_WARMUP_PREFILL", "1") == "1"  # 暖機時備好第一副牌（優先取牌靴庫）
+WARMUP_CANDIDATES = os.getenv("WAA_WARMUP_CANDIDATES", "0") == "1"  # 預先啟動多候選生成的行程池
+WARMUP = {"state": "starting", "steps": {}, "started_at": time.time(), "ready_at": None}
+
+
+def _warm_step(name, fn):
+    """執行單一暖機步驟並記錄耗時；fn 的回傳值記為 detail。失敗只記錄，不中斷其他步驟。"""
+    step = WARMUP["steps"][name] = {"status": "running"}
+    started = time.perf_counter()
+    try:
+        detail = fn()
+        step["status"] = "done"
+        if detail is not None:
+            step["detail"] = detail
+    except Exception as exc:
+        step["status"] = "failed"
+        step["detail"] = str(exc)
+    step["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return step["status"] == "done"
+
+
+def _warm_candidates():
+    # 每個行程都讀一次排列表；submit 數量等於行程數，讓池子把行程全部開起來
+    executor = waa._candidate_executor()
+    for fut in [executor.submit(waa.warm_pattern_tables) for _ in range(waa.CANDIDATE_WORKERS)]:
+        fut.result()
+    return waa.CANDIDATE_WORKERS
+
+
+def _warm_rng():
+    # 第一次產生排列時 NumPy 要建 Philox 產生器與暫存區，先跑一個區塊
+    stream = waa._permutation_stream(0)
+    if stream is None:
+        return "python"
+    stream.deck(0)
+    return "philox"
+
+
+def _prefill_shoe():
+    """沒有目前牌靴時備好一副：多 worker 先看共享狀態，其次牌靴庫，最後才現場生成（皆用預設花色與副數）。"""
+    _sync_state()
+    if STATE["deck"]:
+        return "shared"
+    lib = get_library()
+    found = lib.query(
+        signal_suit=waa.SIGNAL_SUIT, tie_suit=waa.TIE_SIGNAL_SUIT or "",
+        num_decks=DEFAULT_NUM_DECKS, random_order=True, limit=1,
+    ) if lib else []
+    if found:
+        result = _load_library_shoe(lib.get(found[0]["id"]))
+        if "error" not in result:
+            return "library"
+    result = _generate(GenReq(num_shoes=1, signal_suit=waa.SIGNAL_SUIT, tie_signal_suit=waa.TIE_SIGNAL_SUIT))
+    if "error" in result:
+        raise RuntimeError(result.get("detail") or result["error"])
+    return "generated"
+
+
+def _gated_prefill(loop):
+    """經由生成閘門執行 _prefill_shoe：與 /api/generate_shoe、牌靴庫載入共用同時執行上限，
+    暖機期間進來的生成請求會排在它後面，不會同時改寫 STATE。"""
+    gate = GATES["generate"]
+    future = asyncio.run_coroutine_threadsafe(gate.run(lambda: run_in_threadpool(_prefill_shoe)), loop)
+    result, _ = future.result()
+    return result
+
+
+def _warm_up(loop):
+    """依序備好冷啟動成本：排列表（有落地快取就讀檔）、牌靴庫、亂數引擎、候選行程池與第一副牌。
+    loop 是伺服器的事件迴圈，第一副牌要在上面排進生成閘門。"""
+    WARMUP["state"] = "warming"
+    ok = _warm_step("pattern_tables", waa.warm_pattern_tables)
+    ok &= _warm_step("library", lambda: None if get_library() is None else get_library().count())
+    ok &= _warm_step("rng", _warm_rng)
+    if WARMUP_CANDIDATES:
+        ok &= _warm_step("candidate_pool", _warm_candidates)
+    if WARMUP_PREFILL:
+        ok &= _warm_step("prefill_shoe", lambda: _gated_prefill(loop))
+    WARMUP["ready_at"] = time.time()
+    WARMUP["state"] = "ready" if ok else "degraded"
+
+
+def _warmup_report():
+    return {
+        "state": WARMUP["state"],
+        "steps": WARMUP["steps"],
+        "uptime_s": round(time.time() - WARMUP["started_at"], 1),
+        "warmup_s": round(WARMUP["ready_at"] - WARMUP["started_at"], 1) if WARMUP["ready_at"] else None,
+    }
+
+
+@app.get("/healthz")
+def healthz():
+    """存活檢查：行程能回應就回 200，附上暖機進度。"""
+    return {"status": "ok", "waa": WAA_OK, "warmup": _warmup_report()}
+
+
+@app.get("/readyz")
+def readyz():
+    """就緒檢查：暖機完成前回 503；部分步驟失敗（degraded）仍可服務，回 200。"""
+    report = _warmup_report()
+    ready = report["state"] in ("ready", "degraded")
+    return JSONResponse({"ready": ready, **report}, status_code=200 if ready else 503)
+
+
 # 將靜態站點掛載在最後，避免攔截 /api/* 路徑
-app.mount("/", StaticFiles(directory="web", html=True), name="static")
+app.mount("/", static_app("web"), name="static")
 
@@ -0,0 +1,200 @@
+"""請求合併（single-flight）：一群人同時按下生成時，相同的請求不必各自跑一次完整搜尋。
+
+兩種模式，都在准入控制之外處理，跟隨的請求不佔生成閘門的執行與排隊名額：
+- 帶 Idempotency-Key 標頭：同一把鍵的請求共用同一個回應（同一副牌）；成功的回應保留
+  WAA_IDEMPOTENCY_TTL 秒，期間重送直接重播。回應附 X-Coalesced: shared（與在途請求共用）
+  或 replay（重播已完成的回應）。同一把鍵配上不同主體回 422。
+- 未帶鍵：主體完全相同的請求在領頭請求排隊期間加入同一組（BatchGroup）；領頭請求開始生成時
+  關閉該組，以一批平行生成為每個請求各產生一副不同的牌（X-Coalesced: batch）。
+  組內人數上限 WAA_COALESCE_MAX；批次沒能替某個跟隨者產生牌時，該請求改為照常自行排隊生成，
+  等待批次的時間記在 request.state.deadline_spent_ms，由端點從 deadline_ms 扣除。
+
+設定 WAA_COALESCE=0 可整個關閉。
+
+CoalesceMiddleware 只讓 POST /api/generate_shoe 走 BaseHTTPMiddleware（合併邏輯需要 call_next 的回應物件），
+其他請求原樣交給下一層：BaseHTTPMiddleware 在回應開始後會和端點搶讀請求主體，/api/import 邊讀邊回時會卡住。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi.responses import JSONResponse, Response
+from starlette.middleware.base import BaseHTTPMiddleware
+
+COALESCE_ENABLED = os.getenv("WAA_COALESCE", "1") == "1"
+COALESCE_MAX = max(2, int(os.getenv("WAA_COALESCE_MAX", "8")))
+IDEMPOTENCY_TTL = float(os.getenv("WAA_IDEMPOTENCY_TTL", "300"))
+IDEMPOTENCY_MAX = 256  # 保留的已完成回應上限
+COALESCE_PATH = "/api/generate_shoe"
+
+
+async def _freeze(response):
+    """把 call_next 回傳的串流回應讀成 (狀態碼, 標頭, 內容)，方便重複送出。"""
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    headers = {k: v for k, v in response.headers.items() if k.lower() != "content-length"}
+    return response.status_code, headers, body
+
+
+def _failed(frozen):
+    """回應是否為失敗：4xx / 5xx，或 API 慣用的 200 + {"error": ...} 主體。"""
+    status, headers, body = frozen
+    if status >= 400:
+        return True
+    if "json" not in headers.get("content-type", ""):
+        return False
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return False
+    return isinstance(data, dict) and "error" in data
+
+
+def _thaw(frozen, coalesced):
+    status, headers, body = frozen
+    return Response(body, status_code=status, headers={**headers, "X-Coalesced": coalesced})
+
+
+class IdempotencyCache:
+    """Idempotency-Key → 在途或已完成的回應；只在事件迴圈執行緒上操作。"""
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, limit=IDEMPOTENCY_MAX):
+        self.ttl = ttl
+        self.limit = limit
+        self._entries = OrderedDict()  # key -> {"digest", "future", "expires"}
+        self.shared = 0
+        self.replayed = 0
+
+    def _purge(self):
+        now = time.monotonic()
+        for key in [k for k, e in self._entries.items() if e["expires"] is not None and e["expires"] < now]:
+            del self._entries[key]
+        while len(self._entries) > self.limit:
+            self._entries.popitem(last=False)
+
+    async def run(self, key, body, call):
+        """同一把鍵只執行一次 call()；失敗（例外、4xx / 5xx 或帶 error 的主體，見 _failed）的結果不保留，
+        重送會重新執行。"""
+        self._purge()
+        digest = hashlib.sha256(body).hexdigest()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry["digest"] != digest:
+                return JSONResponse(
+                    {"error": "idempotency_key_reused", "detail": "same Idempotency-Key with a different request body"},
+                    status_code=422,
+                )
+            done = entry["future"].done()
+            frozen = await asyncio.shield(entry["future"])
+            if done:
+                self.replayed += 1
+            else:
+                self.shared += 1
+            return _thaw(frozen, "replay" if done else "shared")
+        future = asyncio.get_running_loop().create_future()
+        entry = self._entries[key] = {"digest": digest, "future": future, "expires": None}
+        try:
+            frozen = await _freeze(await call())
+        except BaseException as exc:
+            self._entries.pop(key, None)
+            future.set_exception(exc)
+            future.exception()  # 沒有跟隨者時避免 "exception was never retrieved"
+            raise
+        future.set_result(frozen)
+        if _failed(frozen):
+            self._entries.pop(key, None)
+        else:
+            entry["expires"] = time.monotonic() + self.ttl
+        return _thaw(frozen, "leader")
+
+
+class BatchGroup:
+    """一組相同的生成請求：領頭請求（在執行緒池中）seal() 後決定批次大小，再以 deliver() 交付跟隨者的結果。"""
+
+    def __init__(self, loop, limit=COALESCE_MAX):
+        self.loop = loop
+        self.limit = limit
+        self.followers = []
+        self.open = True
+        self._lock = threading.Lock()
+
+    def join(self):
+        """在事件迴圈上加入此組，回傳等待結果的 future；組已關閉或滿了回傳 None。"""
+        with self._lock:
+            if not self.open or len(self.followers) + 1 >= self.limit:
+                return None
+            future = self.loop.create_future()
+            self.followers.append(future)
+            return future
+
+    def seal(self):
+        """關閉此組（之後的相同請求另組新批次），回傳跟隨者人數；可從任何執行緒呼叫。"""
+        with self._lock:
+            self.open = False
+            return len(self.followers)
+
+    def deliver(self, payloads):
+        """依序交付跟隨者的回應主體；數量不足的跟隨者收到 None（改為自行生成）。可從任何執行緒呼叫。"""
+        for i, future in enumerate(self.followers):
+            payload = payloads[i] if i < len(payloads) else None
+            self.loop.call_soon_threadsafe(_settle, future, payload)
+
+
+def _settle(future, payload):
+    if not future.done():
+        future.set_result(payload)
+
+
+class BatchCoalescer:
+    """相同主體的請求 → 目前仍開放加入的 BatchGroup；只在事件迴圈執行緒上操作。"""
+
+    def __init__(self, limit=COALESCE_MAX):
+        self.limit = limit
+        self._groups = {}
+        self.batched = 0
+
+    async def run(self, request, body, call_next):
+        """跟隨者等待領頭的批次結果，沒拿到牌時照常 call_next（已等待的毫秒數記在 request.state.deadline_spent_ms）；
+        領頭把組掛在 request.state.batch 上交給端點。"""
+        key = hashlib.sha256(body).hexdigest()
+        group = self._groups.get(key)
+        future = group.join() if group is not None else None
+        if future is not None:
+            waited = time.monotonic()
+            payload = await future
+            if payload is not None:
+                self.batched += 1
+                return JSONResponse(payload, headers={"X-Coalesced": "batch"})
+            request.state.deadline_spent_ms = (time.monotonic() - waited) * 1000
+            return await call_next(request)
+        group = self._groups[key] = BatchGroup(asyncio.get_running_loop(), self.limit)
+        request.state.batch = group
+        try:
+            return await call_next(request)
+        finally:
+            # 端點沒有走到批次（錯誤、改走工作池等）時，讓跟隨者各自生成
+            group.seal()
+            group.deliver([])
+            if self._groups.get(key) is group:
+                del self._groups[key]
+
+    def stats(self):
+        return {"open_groups": len(self._groups), "batched": self.batched}
+
+
+IDEMPOTENCY = IdempotencyCache()
+BATCHES = BatchCoalescer()
+
+
+class CoalesceMiddleware(BaseHTTPMiddleware):
+    """以 dispatch 處理 POST COALESCE_PATH，其餘請求不經過 BaseHTTPMiddleware（見模組說明）。"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] == COALESCE_PATH:
+            await super().__call__(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
@@ -0,0 +1,239 @@
+"""牌靴庫：以 SQLite 保存套用規則後的牌靴與其統計資料。
+
+每副牌靴以 waa.encode_shoe 的緊湊格式存成 BLOB，並把常用的查詢條件
+（訊號花色、和局花色、局數、尾局張數、切牌平均值、種子）拆成獨立欄位建索引，
+讓 API 可以直接挑出符合條件的既有牌靴，而不必重新生成。
+另外以 round_keys 表保存每局的 (莊點, 閒點, 用張)，供 /api/scan 跨牌靴查詢。
+精簡模式（WAA_LIBRARY_COMPACT=1）只存 (種子, 嘗試序號, 設定雜湊)，cards 留空，載入時以
+waa.regenerate_shoe 重建。
+多 worker 部署時，current_shoe 表（單列）保存「目前牌靴」，讓各 HTTP worker 看到同一副牌。
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+# waa 無法載入時不開牌靴庫，由 api/app.py 回報 server_unavailable
+try:
+    import waa  # type: ignore
+except Exception:
+    waa = None  # type: ignore
+
+LIBRARY_PATH = os.getenv("WAA_LIBRARY_PATH", "shoe_library.db")
+LIBRARY_COMPACT = os.getenv("WAA_LIBRARY_COMPACT", "0") == "1"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shoes (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at  REAL    NOT NULL,
+    signal_suit TEXT    NOT NULL,
+    tie_suit    TEXT    NOT NULL DEFAULT '',
+    rounds_len  INTEGER NOT NULL,
+    tail_len    INTEGER NOT NULL,
+    avg_hit     REAL,
+    avg_rounds  REAL,
+    seed        INTEGER,
+    cards       BLOB    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_shoes_suits ON shoes (signal_suit, tie_suit);
+CREATE INDEX IF NOT EXISTS idx_shoes_shape ON shoes (rounds_len, tail_len);
+CREATE INDEX IF NOT EXISTS idx_shoes_avg_hit ON shoes (avg_hit);
+CREATE INDEX IF NOT EXISTS idx_shoes_avg_rounds ON shoes (avg_rounds);
+CREATE INDEX IF NOT EXISTS idx_shoes_seed ON shoes (seed);
+CREATE TABLE IF NOT EXISTS round_keys (
+    shoe_id      INTEGER NOT NULL REFERENCES shoes (id) ON DELETE CASCADE,
+    banker_point INTEGER NOT NULL,
+    player_point INTEGER NOT NULL,
+    used_cards   INTEGER NOT NULL,
+    round_idx    INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_round_keys_lookup
+    ON round_keys (banker_point, player_point, used_cards, shoe_id);
+CREATE TABLE IF NOT EXISTS current_shoe (
+    id          INTEGER PRIMARY KEY CHECK (id = 1),
+    seq         INTEGER NOT NULL,
+    deck_seq    INTEGER NOT NULL,
+    signal_suit TEXT    NOT NULL,
+    tie_suit    TEXT    NOT NULL DEFAULT '',
+    cards       BLOB    NOT NULL
+);
+"""
+
+# 舊版資料表缺少的欄位，開啟時補上
+_MIGRATIONS = (
+    ("attempt", "INTEGER"),
+    ("config_hash", "TEXT"),
+    ("num_decks", "INTEGER NOT NULL DEFAULT 8"),  # 加欄位前的紀錄都是 8 副牌
+)
+
+# 查詢時回傳的中繼欄位（不含 cards BLOB）
+META_COLUMNS = (
+    "id", "created_at", "signal_suit", "tie_suit", "rounds_len", "tail_len",
+    "avg_hit", "avg_rounds", "seed", "attempt", "config_hash", "num_decks",
+)
+
+
+class ShoeLibrary:
+    """單一 SQLite 檔案的牌靴庫；連線可跨執行緒共用，寫入以鎖保護。"""
+
+    def __init__(self, path=LIBRARY_PATH, *, compact=LIBRARY_COMPACT):
+        self.path = path
+        self.compact = compact
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")  # 多個行程同時讀寫
+            self._conn.executescript(_SCHEMA)
+            existing = {r["name"] for r in self._conn.execute("PRAGMA table_info(shoes)")}
+            for col, decl in _MIGRATIONS:
+                if col not in existing:
+                    self._conn.execute(f"ALTER TABLE shoes ADD COLUMN {col} {decl}")
+            self._backfill_round_keys()
+
+    def _backfill_round_keys(self):
+        """補建舊資料（round_keys 表建立前寫入的牌靴）的掃描索引。"""
+        rows = self._conn.execute(
+            "SELECT id, cards FROM shoes WHERE length(cards) > 0"
+            " AND id NOT IN (SELECT DISTINCT shoe_id FROM round_keys)"
+        ).fetchall()
+        for row in rows:
+            self._insert_round_keys(row["id"], row["cards"])
+
+    def _insert_round_keys(self, shoe_id, blob):
+        rounds, tail, _ = waa.decode_shoe(blob)
+        index = waa.build_scan_index(rounds, tail)
+        self._conn.executemany(
+            "INSERT INTO round_keys (shoe_id, banker_point, player_point, used_cards, round_idx)"
+            " VALUES (?, ?, ?, ?, ?)",
+            [
+                (shoe_id, bpt, ppt, used, idx)
+                for (bpt, ppt, used), positions in index.items()
+                if used  # 用張 0 是查詢時的萬用值，不需落地
+                for idx in positions
+            ],
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def save(self, blob, *, signal_suit, tie_suit, rounds_len, tail_len,
+             avg_hit=None, avg_rounds=None, seed=None, attempt=None, config_hash=None, num_decks=8):
+        """寫入一副牌靴，回傳新紀錄的 id。
+        精簡模式且帶齊 (seed, attempt, config_hash) 時 cards 存空值，blob 只用來建掃描索引。"""
+        compact = self.compact and None not in (seed, attempt, config_hash)
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO shoes (created_at, signal_suit, tie_suit, rounds_len, tail_len,"
+                " avg_hit, avg_rounds, seed, attempt, config_hash, num_decks, cards)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), signal_suit, tie_suit or "", rounds_len, tail_len,
+                 avg_hit, avg_rounds, seed, attempt, config_hash, num_decks,
+                 sqlite3.Binary(b"" if compact else blob)),
+            )
+            self._insert_round_keys(cur.lastrowid, blob)
+            return cur.lastrowid
+
+    def query(self, *, signal_suit=None, tie_suit=None, rounds_len=None, tail_len=None,
+              min_avg_hit=None, max_avg_hit=None, min_avg_rounds=None, max_avg_rounds=None,
+              seed=None, num_decks=None, random_order=False, limit=50, offset=0):
+        """依條件查詢牌靴中繼資料；tie_suit 傳空字串代表「未設定和局花色」。"""
+        where, args = [], []
+        for col, op, val in (
+            ("signal_suit", "=", signal_suit),
+            ("tie_suit", "=", tie_suit),
+            ("rounds_len", "=", rounds_len),
+            ("tail_len", "=", tail_len),
+            ("avg_hit", ">=", min_avg_hit),
+            ("avg_hit", "<=", max_avg_hit),
+            ("avg_rounds", ">=", min_avg_rounds),
+            ("avg_rounds", "<=", max_avg_rounds),
+            ("seed", "=", seed),
+            ("num_decks", "=", num_decks),
+        ):
+            if val is None:
+                continue
+            where.append(f"{col} {op} ?")
+            args.append(val)
+        sql = f"SELECT {', '.join(META_COLUMNS)} FROM shoes"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY RANDOM()" if random_order else " ORDER BY id DESC"
+        sql += " LIMIT ? OFFSET ?"
+        args.extend([int(limit), int(offset)])
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [dict(r) for r in rows]
+
+    def scan(self, banker_point, player_point, used_cards=0, *, limit=20):
+        """以索引找出含有指定 (莊點, 閒點, 用張) 局的牌靴；用張 0 表示不限。"""
+        sql = (
+            "SELECT shoe_id, COUNT(*) AS hits FROM round_keys"
+            " WHERE banker_point = ? AND player_point = ?"
+        )
+        args = [banker_point, player_point]
+        if used_cards:
+            sql += " AND used_cards = ?"
+            args.append(used_cards)
+        sql += " GROUP BY shoe_id ORDER BY hits DESC, shoe_id DESC LIMIT ?"
+        args.append(int(limit))
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [dict(r) for r in rows]
+
+    def get(self, shoe_id):
+        """取回單一牌靴（含 cards BLOB，精簡紀錄為空）；不存在時回傳 None。"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(META_COLUMNS)}, cards FROM shoes WHERE id = ?", (shoe_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def publish_current(self, blob, *, signal_suit, tie_suit, deck_changed):
+        """寫入目前牌靴並遞增序號，回傳 (seq, deck_seq)；換新牌靴時 deck_seq 同步成新的 seq。"""
+        with self._lock, self._conn:
+            # 單一 UPSERT 取得寫入鎖後再讀回，避免多個行程同時發布時拿到相同序號
+            self._conn.execute(
+                "INSERT INTO current_shoe (id, seq, deck_seq, signal_suit, tie_suit, cards)"
+                " VALUES (1, 1, 1, ?, ?, ?)"
+                " ON CONFLICT (id) DO UPDATE SET seq = seq + 1,"
+                " deck_seq = CASE WHEN ? THEN seq + 1 ELSE deck_seq END,"
+                " signal_suit = excluded.signal_suit, tie_suit = excluded.tie_suit, cards = excluded.cards",
+                (signal_suit, tie_suit or "", sqlite3.Binary(blob), bool(deck_changed)),
+            )
+            row = self._conn.execute("SELECT seq, deck_seq FROM current_shoe WHERE id = 1").fetchone()
+        return row["seq"], row["deck_seq"]
+
+    def current_if_newer(self, seq):
+        """目前牌靴序號大於 seq 時回傳整列，否則回傳 None（只查序號，成本很低）。"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT seq, deck_seq, signal_suit, tie_suit, cards FROM current_shoe"
+                " WHERE id = 1 AND seq > ?", (seq,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM shoes").fetchone()[0]
+
+
+_LIBRARY = None
+_LIBRARY_LOCK = threading.Lock()
+
+
+def get_library():
+    """延遲開啟全域牌靴庫；開啟失敗（或 waa 無法載入，無法建掃描索引）時回傳 None，讓 API 照常運作。"""
+    global _LIBRARY
+    if waa is None:
+        return None
+    with _LIBRARY_LOCK:
+        if _LIBRARY is None:
+            try:
+                _LIBRARY = ShoeLibrary(LIBRARY_PATH)
+            except sqlite3.Error as exc:
+                print(f"[API] shoe library unavailable: {exc}")
+                return None
+        return _LIBRARY
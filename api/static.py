@@ -0,0 +1,226 @@
+"""前端靜態檔：啟動時預先壓縮並加上指紋，讓瀏覽器可以長期快取。
+
+- 非 HTML 檔（script.js、style.css…）以內容雜湊產生指紋網址，例如 script.3f2a9c1b0d.js，
+  回應 Cache-Control: public, max-age=31536000, immutable。
+- HTML（index.html）中指向這些檔案的 href / src 改寫成指紋網址，本身以 no-cache + ETag 回應，
+  每次載入只需一次條件式請求就能確認是否換版。
+- 每個檔案預先備好 gzip（有安裝 brotli 時另備 br）版本，依 Accept-Encoding 選擇，附 Vary 與各自的 ETag。
+- 原始網址（/script.js）與舊指紋網址（換版前快取的 HTML 引用的）仍可取得目前內容，但只給 no-cache；
+  其他路徑（新增的檔案、子目錄等）交給一般的 StaticFiles 處理。
+- 目錄內容改變時（每 STATIC_RESCAN_SECONDS 秒檢查一次修改時間與大小）重新建表；掃描與壓縮在執行緒池進行，
+  事件迴圈上只替換表格。
+
+設定 WAA_STATIC_PRECOMPRESS=0 改回單純的 StaticFiles。
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import time
+
+from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+try:
+    import brotli  # 選用：未安裝時只提供 gzip
+except ImportError:
+    brotli = None  # type: ignore
+
+STATIC_PRECOMPRESS = os.getenv("WAA_STATIC_PRECOMPRESS", "1") == "1"
+STATIC_RESCAN_SECONDS = 2.0
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+_FINGERPRINT = re.compile(r"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{10})(?P<ext>\.[^./]+)$")
+_REFERENCE = re.compile(r"""(?P<attr>\b(?:href|src))=(?P<q>["'])(?P<url>[^"'?#]+)(?P=q)""")
+
+
+def _encoding_weights(header):
+    """Accept-Encoding 解析成 {編碼（小寫）: q}；q 寫壞（例如 q=abc）的項目整項略過。"""
+    weights = {}
+    for item in (header or "").split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = None
+        if q is not None:
+            weights[coding] = q
+    return weights
+
+
+def accepts_encoding(header, coding):
+    """Accept-Encoding 是否接受 coding：明列時以它的 q 為準，否則看 *；q=0 表示拒絕。
+    api/app.py 的匯出端點與這裡的靜態檔共用。"""
+    weights = _encoding_weights(header)
+    return weights.get(coding, weights.get("*", 0.0)) > 0
+
+
+def _variants(body):
+    """一個檔案的各編碼版本：{編碼: (內容, ETag)}；壓縮後沒有變小的版本不保留。"""
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    out = {"identity": (body, f'"{digest}"')}
+    compressed = {"gzip": gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        compressed["br"] = brotli.compress(body)
+    for coding, data in compressed.items():
+        if len(data) < len(body):
+            out[coding] = (data, f'"{digest}-{coding}"')
+    return out
+
+
+class PrecompressedStatic:
+    """掛在 / 的 ASGI 靜態檔應用；見模組說明。"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fallback = StaticFiles(directory=directory, html=True)
+        self._refreshing = False  # 只在事件迴圈上讀寫：同一時間只有一個請求觸發重新掃描
+        self._checked_at = 0.0
+        self._signature = self._scan()
+        # 相對路徑 -> 項目（原始網址）、指紋路徑 -> 項目
+        self._files, self._fingerprinted = self._build(self._signature)
+
+    # --- 建表 ---
+
+    def _scan(self):
+        """目錄簽章：(相對路徑, 修改時間, 大小) 的排序清單。"""
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                full = os.path.join(root, name)
+                st = os.stat(full)
+                rel = os.path.relpath(full, self.directory).replace(os.sep, "/")
+                entries.append((rel, st.st_mtime_ns, st.st_size))
+        return tuple(sorted(entries))
+
+    def _build(self, signature):
+        """讀檔、壓縮並改寫 HTML，回傳新的 (files, fingerprinted)；不動目前的表格，可在執行緒池執行。"""
+        files, fingerprinted, urls = {}, {}, {}
+        pages = []
+        for rel, _, _ in signature:
+            with open(os.path.join(self.directory, rel), "rb") as f:
+                body = f.read()
+            media_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+            if media_type == "text/html":
+                pages.append((rel, body))
+                continue
+            stem, ext = os.path.splitext(rel)
+            url = f"{stem}.{hashlib.sha256(body).hexdigest()[:10]}{ext}"
+            entry = {"media_type": media_type, "variants": _variants(body), "url": url}
+            files[rel] = entry
+            fingerprinted[url] = entry
+            urls[rel] = url
+        for rel, body in pages:
+            base = os.path.dirname(rel)
+            text = _REFERENCE.sub(lambda m: self._rewrite(m, base, urls), body.decode("utf-8"))
+            files[rel] = {"media_type": "text/html", "variants": _variants(text.encode("utf-8"))}
+        return files, fingerprinted
+
+    @staticmethod
+    def _rewrite(match, base, urls):
+        """把 HTML 中指向已知檔案的相對 / 根目錄網址改成指紋網址，其餘保持原樣。"""
+        url = match.group("url")
+        if "://" in url or url.startswith("//"):
+            return match.group(0)
+        rooted = url.startswith("/")
+        rel = os.path.normpath(url.lstrip("/") if rooted else os.path.join(base, url)).replace(os.sep, "/")
+        if rel not in urls:
+            return match.group(0)
+        new = "/" + urls[rel] if rooted else os.path.relpath(urls[rel], base or ".").replace(os.sep, "/")
+        return f"{match.group('attr')}={match.group('q')}{new}{match.group('q')}"
+
+    def _scan_and_build(self, signature):
+        """在執行緒池執行：重新掃描目錄，和 signature 不同時建新表；回傳 (新簽章, 表格)，沒有變化回傳 None。"""
+        current = self._scan()
+        if current == signature:
+            return None
+        return current, self._build(current)
+
+    async def _maybe_refresh(self):
+        now = time.monotonic()
+        if self._refreshing or now - self._checked_at < STATIC_RESCAN_SECONDS:
+            return
+        self._refreshing = True
+        self._checked_at = now
+        try:
+            rebuilt = await run_in_threadpool(self._scan_and_build, self._signature)
+        except OSError as exc:
+            # 目錄暫時讀不到（部署中）：清空表格，全部交給 StaticFiles
+            print(f"[API] static rebuild failed: {exc}")
+            self._files, self._fingerprinted, self._signature = {}, {}, None
+        else:
+            if rebuilt is not None:
+                self._signature, (self._files, self._fingerprinted) = rebuilt
+        finally:
+            self._refreshing = False
+
+    # --- 服務 ---
+
+    def _lookup(self, rel):
+        """回傳 (項目, Cache-Control)；找不到時回傳 (None, None)。"""
+        if rel in ("", "."):
+            rel = "index.html"
+        elif rel.endswith("/"):
+            rel += "index.html"
+        entry = self._fingerprinted.get(rel)
+        if entry is not None:
+            return entry, IMMUTABLE
+        entry = self._files.get(rel)
+        if entry is not None:
+            return entry, REVALIDATE
+        m = _FINGERPRINT.match(rel)
+        if m is not None:
+            # 舊版 HTML 引用的指紋：給目前內容，但不能標成 immutable
+            entry = self._files.get(m.group("stem") + m.group("ext"))
+            if entry is not None:
+                return entry, REVALIDATE
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.fallback(scope, receive, send)
+            return
+        await self._maybe_refresh()
+        path = scope["path"]
+        root = scope.get("root_path", "")
+        if root and path.startswith(root):
+            path = path[len(root):]
+        entry, cache_control = self._lookup(path.lstrip("/"))
+        if entry is None:
+            await self.fallback(scope, receive, send)
+            return
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        accept = headers.get("accept-encoding")
+        variants = entry["variants"]
+        coding = next((c for c in ("br", "gzip") if c in variants and accepts_encoding(accept, c)), "identity")
+        body, etag = variants[coding]
+        out = {"Cache-Control": cache_control, "ETag": etag, "Vary": "Accept-Encoding"}
+        if coding != "identity":
+            out["Content-Encoding"] = coding
+        match = headers.get("if-none-match")
+        etags = {tag for _, tag in variants.values()}
+        if match and (match.strip() == "*" or any(t.strip().removeprefix("W/") in etags for t in match.split(","))):
+            await Response(status_code=304, headers=out)(scope, receive, send)
+            return
+        response = Response(body, media_type=entry["media_type"], headers=out)
+        if scope["method"] == "HEAD":
+            response.body = b""
+        await response(scope, receive, send)
+
+
+def static_app(directory):
+    """依 WAA_STATIC_PRECOMPRESS 回傳預先壓縮的靜態檔應用或一般的 StaticFiles。"""
+    if STATIC_PRECOMPRESS:
+        return PrecompressedStatic(directory)
+    return StaticFiles(directory=directory, html=True)
@@ -0,0 +1,210 @@
+"""生成工作池：多個 HTTP worker 共用的一組生成行程。
+
+部署方式（`python app.py` 在 WAA_WORKERS > 1 時會自動照這樣啟動）：
+- 先執行 `python -m api.workers`：在 WAA_POOL_ADDRESS 監聽，底下開 WAA_GEN_PROCS 個生成行程；
+- 各 uvicorn worker 設定相同的 WAA_POOL_ADDRESS 後，generate_shoe 改把工作送到工作池。
+
+生成結果以 waa.encode_shoe 的緊湊格式寫進 multiprocessing.shared_memory，
+連線上只傳區塊名稱、長度與中繼資料；HTTP worker 直接在共享記憶體上解碼後釋放區塊，
+不必 pickle 整串 Card / Round。HTTP worker 收到回覆後回送 "ack" 接手區塊；
+沒有確認（逾時斷線、傳送失敗）時由工作池自行刪除，避免區塊殘留在 /dev/shm。
+
+連線金鑰取自 WAA_POOL_AUTHKEY，沒有預設值；`python app.py` 多 worker 啟動時會產生隨機金鑰
+並經環境變數傳給工作池與各 HTTP worker。
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+# waa 無法載入時 api/app.py 不會走到工作池（直接回報 server_unavailable）
+try:
+    import waa  # type: ignore
+except Exception:
+    waa = None  # type: ignore
+
+POOL_ADDRESS = os.getenv("WAA_POOL_ADDRESS", "")  # 例如 127.0.0.1:7861；空字串表示不使用工作池
+GEN_PROCS = int(os.getenv("WAA_GEN_PROCS", str(max(1, (os.cpu_count() or 2) - 1))))
+ACK_TIMEOUT = 5.0  # 等 HTTP worker 確認接手共享記憶體區塊的秒數
+
+
+def pool_authkey():
+    """WAA_POOL_AUTHKEY 的位元組；未設定時拋出 RuntimeError（不提供預設金鑰）。"""
+    key = os.getenv("WAA_POOL_AUTHKEY", "")
+    if not key:
+        raise RuntimeError("WAA_POOL_AUTHKEY is not set")
+    return key.encode("utf-8")
+
+
+def parse_address(text):
+    """'host:port' 轉成 TCP 位址，其他字串視為 Unix socket 路徑。"""
+    host, sep, port = text.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return text
+
+
+# --- 生成行程端 ---
+
+def _share(rounds, tail, deck, meta):
+    """把牌靴編碼後放進新的共享記憶體區塊，回傳給 HTTP worker 的回覆。"""
+    blob = waa.encode_shoe(rounds, tail, deck)
+    shm = shared_memory.SharedMemory(create=True, size=len(blob))
+    shm.buf[:len(blob)] = blob
+    # 區塊交給 HTTP worker 釋放；取消本行程的追蹤，避免生成行程結束時被提早刪除
+    resource_tracker.unregister(shm._name, "shared_memory")
+    shm.close()
+    return {**meta, "shm": shm.name, "size": len(blob)}
+
+
+def _discard(reply):
+    """HTTP worker 沒有接手時刪除回覆中的共享記憶體區塊。"""
+    try:
+        shm = shared_memory.SharedMemory(name=reply["shm"])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _generate_job(params):
+    """在生成行程中產生並套用規則；與 generate_shoe 的本機路徑共用 waa.generate_ruled_shoe（含時間預算與規則重試）。
+    花色、副數與調參值只在這次工作的 waa.generation_settings 區塊內生效。"""
+    settings = waa.settings_for(params["signal_suit"], params.get("tie_suit"), params.get("num_decks"))
+    try:
+        with waa.generation_settings(settings):
+            shoe = waa.generate_ruled_shoe(deadline_ms=params.get("deadline_ms"))
+    except waa.GenerationDeadline as exc:
+        return {"error": "deadline_exceeded", "detail": str(exc)}
+    except RuntimeError as exc:
+        return {"error": "post_process_failed", "detail": str(exc)}
+    if shoe.partial:
+        return _share(shoe.rounds, shoe.tail, shoe.deck, {
+            "partial": True, "coverage": shoe.coverage, "attempts": shoe.attempts,
+            "elapsed_ms": shoe.elapsed_ms, "rules_error": shoe.rules_error,
+        })
+    return _share(shoe.rounds, shoe.tail, shoe.deck, {
+        "partial": False, "elapsed_ms": shoe.elapsed_ms, "gen_key": shoe.gen_key,
+    })
+
+
+def _generate_candidates(params, executor):
+    """多候選生成：各候選分散到行程池，排序與挑選在工作池主行程完成後只共享最佳的一副。"""
+    started = time.perf_counter()
+    try:
+        (rounds, tail, deck), gen_key, scores = waa.generate_ranked_candidates(
+            params["candidates"], objective=params.get("objective"), deadline_ms=params.get("deadline_ms"),
+            signal_suit=params["signal_suit"], tie_suit=params.get("tie_suit"),
+            num_decks=params.get("num_decks"), executor=executor,
+        )
+    except ValueError as exc:
+        return {"error": "invalid_objective", "detail": str(exc)}
+    except RuntimeError as exc:
+        return {"error": "post_process_failed", "detail": str(exc)}
+    return _share(rounds, tail, deck, {
+        "partial": False, "elapsed_ms": (time.perf_counter() - started) * 1000,
+        "gen_key": gen_key, "candidates": scores,
+    })
+
+
+def _serve_connection(conn, executor):
+    with conn:
+        while True:
+            try:
+                params = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if params.get("candidates", 1) > 1:
+                    reply = _generate_candidates(params, executor)
+                else:
+                    reply = executor.submit(_generate_job, params).result()
+            except Exception as exc:
+                reply = {"error": "worker_failed", "detail": str(exc)}
+            try:
+                conn.send(reply)
+                acked = "shm" not in reply or (conn.poll(ACK_TIMEOUT) and conn.recv() == "ack")
+            except (EOFError, OSError):
+                acked = False
+            if not acked:
+                # 對方已逾時離開或斷線：區塊沒有人會釋放，由這裡刪除
+                if "shm" in reply:
+                    _discard(reply)
+                return
+
+
+def serve(address=POOL_ADDRESS, procs=GEN_PROCS):
+    """工作池主迴圈：每條連線一個執行緒，實際生成交給行程池。"""
+    authkey = pool_authkey()
+    waa.warm_pattern_tables()  # 先備好排列表，fork 出的生成行程直接沿用
+    executor = ProcessPoolExecutor(max_workers=procs)
+    with Listener(parse_address(address), authkey=authkey) as listener:
+        print(f"[POOL] listening on {address} with {procs} generation processes")
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=_serve_connection, args=(conn, executor), daemon=True).start()
+
+
+# --- HTTP worker 端 ---
+
+class PoolClient:
+    """連到生成工作池；每次請求開一條連線，因此可在多個執行緒間共用。"""
+
+    def __init__(self, address=POOL_ADDRESS, authkey=None):
+        self.address = parse_address(address)
+        self.authkey = authkey if authkey is not None else pool_authkey()
+
+    def generate(self, *, signal_suit, tie_suit=None, deadline_ms=None, timeout=None, candidates=1, objective=None,
+                 num_decks=None):
+        """送出生成工作並等待回覆；逾時回傳 {"error": "pool_timeout"}。candidates > 1 時回覆附候選分數。
+
+        回覆帶共享記憶體區塊時先回送 "ack"，之後由呼叫端以 load_shared_shoe 釋放；
+        逾時直接離開時工作池收不到確認，會自行刪除區塊。
+        """
+        with Client(self.address, authkey=self.authkey) as conn:
+            conn.send({"signal_suit": signal_suit, "tie_suit": tie_suit, "deadline_ms": deadline_ms,
+                       "candidates": candidates, "objective": objective, "num_decks": num_decks})
+            if timeout is not None and not conn.poll(timeout):
+                return {"error": "pool_timeout"}
+            reply = conn.recv()
+            if "shm" in reply:
+                conn.send("ack")
+            return reply
+
+
+def load_shared_shoe(reply):
+    """在共享記憶體上直接解碼牌靴，解碼後釋放區塊；回傳 (rounds, tail, deck)。"""
+    shm = shared_memory.SharedMemory(name=reply["shm"])
+    try:
+        view = shm.buf[:reply["size"]]
+        try:
+            return waa.decode_shoe(view)
+        finally:
+            view.release()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+_POOL = None
+
+
+def get_pool():
+    """有設定 WAA_POOL_ADDRESS 時回傳共用的 PoolClient，否則回傳 None（本機生成）。
+
+    有位址但沒有設定 WAA_POOL_AUTHKEY 時不連線，同樣回傳 None 並印出警告。
+    """
+    global _POOL
+    if _POOL is None and POOL_ADDRESS:
+        try:
+            _POOL = PoolClient()
+        except RuntimeError as exc:
+            print(f"[POOL] disabled: {exc}")
+    return _POOL
+
+
+if __name__ == "__main__":
+    serve()
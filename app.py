@@ -8,4 +8,29 @@ if __name__ == "__main__":
     import uvicorn
 
     port = int(os.getenv("PORT", "7860"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WAA_WORKERS", "1"))
+    if workers <= 1:
+        uvicorn.run(app, host="0.0.0.0", port=port)
+    else:
+        # Multi-worker layout: one shared generation pool process plus N HTTP
+        # workers that sync the current shoe through the SQLite library.
+        import multiprocessing
+        import secrets
+
+        os.environ.setdefault("WAA_POOL_ADDRESS", "127.0.0.1:7861")
+        # Random per-launch key, inherited by the pool and the HTTP workers
+        # through the environment; never fall back to a guessable default.
+        os.environ.setdefault("WAA_POOL_AUTHKEY", secrets.token_hex(16))
+        os.environ["WAA_SHARED_STATE"] = "1"
+        from api import workers as pool
+
+        # Not a daemon: the pool server spawns its own generation processes,
+        # which daemonic processes may not do. It is terminated below instead.
+        server = multiprocessing.Process(
+            target=pool.serve, args=(os.environ["WAA_POOL_ADDRESS"],)
+        )
+        server.start()
+        try:
+            uvicorn.run("app:app", host="0.0.0.0", port=port, workers=workers)
+        finally:
+            server.terminate()
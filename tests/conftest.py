@@ -0,0 +1,7 @@
+"""pytest 共用設定：測試從專案根目錄匯入 waa 與 api。"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
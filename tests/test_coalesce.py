@@ -0,0 +1,104 @@
+"""請求合併（api/coalesce.py）的測試：Idempotency-Key 重播、同鍵不同主體、失敗不保留，以及批次後的剩餘時間預算。"""
+import time
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+from api.coalesce import COALESCE_PATH, CoalesceMiddleware, IdempotencyCache
+
+
+@pytest.fixture
+def client():
+    cache = IdempotencyCache(ttl=60)
+    calls = []
+    app = FastAPI()
+
+    @app.post(COALESCE_PATH)
+    async def generate(request: Request):
+        data = await request.json()
+        calls.append(data)
+        if data.get("status"):
+            return JSONResponse({"detail": "boom"}, status_code=data["status"])
+        if data.get("fail"):
+            return {"error": "deadline_exceeded"}
+        return {"shoe": len(calls)}
+
+    async def dispatch(request, call_next):
+        body = await request.body()
+        key = request.headers.get("idempotency-key")
+        if key:
+            return await cache.run(key, body, lambda: call_next(request))
+        return await call_next(request)
+
+    app.add_middleware(CoalesceMiddleware, dispatch=dispatch)
+    with TestClient(app) as c:
+        c.calls = calls
+        c.cache = cache
+        yield c
+
+
+def _post(client, body, key="k1"):
+    return client.post(COALESCE_PATH, json=body, headers={"Idempotency-Key": key})
+
+
+def test_replays_completed_response(client):
+    first = _post(client, {"signal_suit": "♥"})
+    second = _post(client, {"signal_suit": "♥"})
+    assert first.headers["X-Coalesced"] == "leader"
+    assert second.headers["X-Coalesced"] == "replay"
+    assert second.json() == first.json() == {"shoe": 1}
+    assert len(client.calls) == 1
+    assert client.cache.replayed == 1
+
+
+def test_distinct_keys_run_separately(client):
+    assert _post(client, {"signal_suit": "♥"}, key="a").json() == {"shoe": 1}
+    assert _post(client, {"signal_suit": "♥"}, key="b").json() == {"shoe": 2}
+
+
+def test_rejects_key_reused_with_different_body(client):
+    _post(client, {"signal_suit": "♥"})
+    resp = _post(client, {"signal_suit": "♠"})
+    assert resp.status_code == 422
+    assert resp.json()["error"] == "idempotency_key_reused"
+    assert len(client.calls) == 1
+
+
+@pytest.mark.parametrize("body", [{"fail": True}, {"status": 400}, {"status": 503}])
+def test_failures_are_not_cached(client, body):
+    first = _post(client, body)
+    second = _post(client, body)
+    assert first.headers["X-Coalesced"] == second.headers["X-Coalesced"] == "leader"
+    assert len(client.calls) == 2
+    assert client.cache.replayed == 0
+
+
+def test_requests_without_key_pass_through(client):
+    resp = client.post(COALESCE_PATH, json={"signal_suit": "♥"})
+    assert "X-Coalesced" not in resp.headers
+    assert client.post(COALESCE_PATH, json={"signal_suit": "♥"}).json() == {"shoe": 2}
+
+
+class _Group:
+    def seal(self):
+        return 1
+
+    def deliver(self, payloads):
+        pass
+
+
+def test_batch_fallback_spends_only_the_remaining_deadline(monkeypatch):
+    app_module = pytest.importorskip("api.app")
+    if not app_module.WAA_OK:
+        pytest.skip("waa unavailable")
+
+    def slow_batch(k, **kwargs):
+        time.sleep(0.2)
+        return []
+
+    monkeypatch.setattr(app_module.waa, "generate_parallel_shoes", slow_batch)
+    req = app_module.GenReq(num_shoes=1, signal_suit="♥", deadline_ms=100)
+    assert app_module._generate(req, group=_Group())["error"] == "deadline_exceeded"
+    assert app_module._generate(req, spent_ms=150)["error"] == "deadline_exceeded"
@@ -0,0 +1,90 @@
+"""牌靴緊湊編碼（encode_shoe / decode_shoe）與計數器式洗牌的測試。"""
+import struct
+
+import pytest
+
+import waa
+
+
+def _shoe(seed=7):
+    """以固定 (種子, 嘗試) 重建一副套用過規則的牌靴。"""
+    waa._RNG_LOCAL.rng = waa.random.Random(seed)
+    deck = waa.build_shuffled_deck()
+    packed = waa.pack_all_sensitive_once(deck, min_tail_stop=waa.MIN_TAIL_STOP, multi_pass_min_cards=waa.MULTI_PASS_MIN_CARDS)
+    assert packed is not None
+    rounds, tail = packed
+    return rounds, tail, deck
+
+
+def _flat(rounds, tail):
+    return [(c.rank, c.suit, c.pos, c.color) for r in sorted(rounds, key=lambda r: r.start_index) for c in r.cards] + \
+        [(c.rank, c.suit, c.pos, c.color) for c in tail]
+
+
+def test_round_trip_keeps_cards_colors_and_boundaries():
+    rounds, tail, deck = _shoe()
+    for i, c in enumerate(deck):
+        c.color = 'R' if i % 3 == 0 else ('B' if i % 3 == 1 else None)
+    got_rounds, got_tail, got_deck = waa.decode_shoe(waa.encode_shoe(rounds, tail, deck))
+    assert [(c.rank, c.suit, c.pos, c.color) for c in got_deck] == [(c.rank, c.suit, c.pos, c.color) for c in deck]
+    assert _flat(got_rounds, got_tail) == _flat(rounds, tail)
+    ordered = sorted(rounds, key=lambda r: r.start_index)
+    assert [r.start_index for r in got_rounds] == [r.start_index for r in ordered]
+    assert [r.sensitive for r in got_rounds] == [r.sensitive for r in ordered]
+    assert [r.result for r in got_rounds] == [r.result for r in ordered]
+
+
+def test_decoded_rounds_share_deck_cards():
+    rounds, tail, deck = _shoe()
+    got_rounds, got_tail, got_deck = waa.decode_shoe(waa.encode_shoe(rounds, tail, deck))
+    ids = {id(c) for c in got_deck}
+    assert all(id(c) in ids for r in got_rounds for c in r.cards)
+    assert all(id(c) in ids for c in got_tail)
+
+
+def _as_v1(blob):
+    """把版本 2 的編碼改寫成版本 1：拿掉每局的 start_index 區段。"""
+    version, n_deck, n_rounds, n_tail = waa._SHOE_HEADER.unpack_from(blob, 0)
+    assert version == 2
+    off = waa._SHOE_HEADER.size + n_deck + n_rounds
+    return waa._SHOE_HEADER.pack(1, n_deck, n_rounds, n_tail) + blob[waa._SHOE_HEADER.size:off] + blob[off + 2 * n_rounds:]
+
+
+def test_decodes_version_1_blobs():
+    rounds, tail, deck = _shoe()
+    blob = waa.encode_shoe(rounds, tail, deck)
+    got_rounds, got_tail, _ = waa.decode_shoe(_as_v1(blob))
+    assert _flat(got_rounds, got_tail) == _flat(rounds, tail)
+    # 版本 1 以每局首張牌的 pos 當起點
+    assert [r.start_index for r in got_rounds] == [r.cards[0].pos for r in got_rounds]
+
+
+def test_rejects_unknown_version():
+    rounds, tail, deck = _shoe()
+    blob = bytearray(waa.encode_shoe(rounds, tail, deck))
+    blob[0] = 9
+    with pytest.raises(ValueError):
+        waa.decode_shoe(bytes(blob))
+
+
+def test_header_layout_is_stable():
+    rounds, tail, deck = _shoe()
+    blob = waa.encode_shoe(rounds, tail, deck)
+    assert struct.unpack_from('<BHHH', blob, 0) == (2, len(deck), len(rounds), len(tail))
+    n_seq = sum(len(r.cards) for r in rounds) + len(tail)
+    assert len(blob) == 7 + len(deck) + len(rounds) + 2 * len(rounds) + 2 * n_seq
+
+
+@pytest.mark.skipif(waa.np is None, reason="需要 numpy")
+def test_permutations_are_addressed_by_seed_and_counter():
+    a = waa.batch_permutations(123, 0, n=416)
+    b = waa.batch_permutations(123, 0, n=416)
+    assert (a == b).all()
+    assert sorted(a[5].tolist()) == list(range(416))
+    assert not (a == waa.batch_permutations(123, 1, n=416)).all()
+    assert not (a == waa.batch_permutations(124, 0, n=416)).all()
+    stream = waa.PermutationStream(123)
+    later = stream.deck(waa._PERM_BLOCK + 3)
+    first = stream.deck(3)
+    assert [(c.rank, c.suit) for c in first] == [(c.rank, c.suit) for c in waa.deck_from_permutation(a[3])]
+    assert [(c.rank, c.suit) for c in later] == [(c.rank, c.suit) for c in waa.PermutationStream(123).deck(waa._PERM_BLOCK + 3)]
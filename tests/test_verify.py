@@ -0,0 +1,97 @@
+"""匯入驗證器（waa.verify_shoe / verify_record / verify_line）的測試。"""
+import json
+
+import pytest
+
+import waa
+
+
+def _generated_record(signal_suit, tie_suit=None, seed=11):
+    """以固定種子在 2 副牌設定下生成並套用規則，轉成匯入紀錄。"""
+    settings = {**waa.settings_for(signal_suit, tie_suit, 2), 'SEED': seed}
+    with waa.generation_settings(settings):
+        shoe = waa.generate_ruled_shoe()
+    return waa.shoe_record(shoe.rounds, shoe.tail, num_decks=2)
+
+
+@pytest.fixture(scope='module')
+def record():
+    return _generated_record('♥')
+
+
+@pytest.fixture(scope='module')
+def tie_record():
+    return _generated_record('♥', '♦', seed=12)
+
+
+def _rules(out):
+    return {v['rule'] for v in out['violations']}
+
+
+def test_accepts_generated_shoe(record):
+    out = waa.verify_record(record, signal_suit='♥')
+    assert out['ok'], out['violations']
+    assert out['cards'] == 104
+    assert sum(out['sizes']) == 104
+
+
+def test_accepts_generated_shoe_with_tie_suit(tie_record):
+    out = waa.verify_record(tie_record, signal_suit='♥', tie_suit='♦')
+    assert out['ok'], out['violations']
+
+
+def test_rejects_wrong_tail_length(record):
+    out = waa.verify_shoe(*waa.parse_shoe_record(record), tail_len=record['tail'] + 1, signal_suit='♥', num_decks=2)
+    assert not out['ok']
+    assert 'tail' in _rules(out)
+
+
+def test_rejects_tie_suit_the_shoe_was_not_built_for(record):
+    out = waa.verify_record(record, signal_suit='♥', tie_suit='♦')
+    assert not out['ok']
+    assert _rules(out) <= {'tie', 'tie_outside', 'balance'}
+    assert _rules(out) & {'tie', 'tie_outside'}
+
+
+def test_rejects_unbalanced_suits(record):
+    cards = record['cards'].split()
+    changed = 0
+    for i, card in enumerate(cards):
+        if card.endswith('♠') and changed < 3:
+            cards[i] = card[:-1] + '♣'
+            changed += 1
+    out = waa.verify_record({**record, 'cards': ' '.join(cards)}, signal_suit='♥')
+    assert _rules(out) == {'balance'}
+
+
+def test_balance_limit_ignores_tuned_globals(record, monkeypatch):
+    monkeypatch.setattr(waa, 'LATE_BALANCE_DIFF', 0)
+    assert waa.verify_record(record, signal_suit='♥')['ok']
+    assert 'balance' in _rules(waa.verify_shoe(*waa.parse_shoe_record(record), tail_len=record['tail'],
+                                               signal_suit='♥', num_decks=2, balance_diff=-1))
+
+
+def test_rejects_missing_cards(record):
+    cards = record['cards'].split()[:-1]
+    out = waa.verify_record({**record, 'cards': ' '.join(cards), 'colors': record['colors'][:-1]}, signal_suit='♥')
+    assert 'coverage' in _rules(out)
+
+
+@pytest.mark.parametrize('mutate', [
+    lambda r: {**r, 'cards': 'XX ' + r['cards']},
+    lambda r: {**r, 'colors': r['colors'][:-3]},
+    lambda r: {k: v for k, v in r.items() if k != 'cards'},
+])
+def test_reports_bad_format(record, mutate):
+    out = waa.verify_record(mutate(record), signal_suit='♥')
+    assert not out['ok']
+    assert _rules(out) == {'format'}
+
+
+def test_verify_line_handles_invalid_json(record):
+    parsed, out = waa.verify_line('{"cards": ')
+    assert parsed is None
+    assert _rules(out) == {'format'}
+    parsed, out = waa.verify_line(json.dumps(record, ensure_ascii=False).encode('utf-8'), signal_suit='♥')
+    assert parsed == record
+    assert out['ok']
@@ -0,0 +1,205 @@
+"""牌靴大小的擴展性量測：不同副數下各階段的耗時與記憶體，找出超線性成長的階段。
+
+階段：
+- generate：洗牌 + 掃描 + 補強 / 精確打包 + 尾局（generate_all_sensitive_shoe_or_retry，含失敗的嘗試）
+- rules：apply_shoe_rules（花色分配、平衡、顏色規則）
+- cuts：simulate_all_cuts 逐切點分析（純 Python）
+- cuts_batch：simulate_all_cuts_batch（NumPy；未安裝時略過）
+- export：encode_shoe + 三種 CSV 匯出（寫到暫存資料夾）
+
+每副牌以固定種子產生，因此記憶體量測可在不開 tracemalloc 的計時之後，以相同種子重跑一次取得，
+計時不受追蹤成本影響。最後以 log-log 最小平方法估計每個階段對張數的成長指數（1 ≈ 線性）。
+
+範例：
+    python tools/bench_scaling.py --decks 2 4 6 8 10 12 --samples 3
+    python tools/bench_scaling.py --decks 6 8 --samples 5 --no-memory --json bench.json
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import waa  # noqa: E402
+
+STAGES = ("generate", "rules", "cuts", "cuts_batch", "export")
+SUPERLINEAR = 1.25  # 成長指數超過此值即標記
+
+
+class _Meter:
+    """依序量測各階段；memory=True 時以 tracemalloc 記錄每階段的峰值配置量。"""
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.ms = {}
+        self.peak_kib = {}
+
+    def run(self, name, fn):
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        out = fn()
+        self.ms[name] = (time.perf_counter() - started) * 1000
+        if self.memory:
+            self.peak_kib[name] = (tracemalloc.get_traced_memory()[1] - base) / 1024
+        return out
+
+
+def _one_shoe(seed, meter, out_dir, deadline_ms):
+    """以固定種子跑完整流程；規則失敗時換下一個種子（與 API 的規則重試相同）。回傳嘗試次數。"""
+    for retry in range(10):
+        waa.SEED = seed + retry * 2**32
+        rounds, tail, deck = meter.run("generate", lambda: waa.generate_all_sensitive_shoe_or_retry(
+            max_attempts=waa.MAX_ATTEMPTS, min_tail_stop=waa.MIN_TAIL_STOP,
+            multi_pass_min_cards=waa.MULTI_PASS_MIN_CARDS, deadline_ms=deadline_ms))
+        attempts = waa.LAST_GEN_ATTEMPT
+        try:
+            rounds, tail = meter.run("rules", lambda: waa.apply_shoe_rules(rounds, tail))
+        except (RuntimeError, AssertionError):
+            continue
+        marked = {r.cards[0].pos for r in rounds}
+        if tail:
+            marked.add(tail[0].pos)
+        rows, avg_hit, avg_rounds = meter.run("cuts", lambda: waa.simulate_all_cuts(
+            deck, marked, use_b_order=True, rounds=rounds, tail=tail))
+        if waa.np is not None:
+            def batch():
+                points, mask, pos, _ = waa.batch_cut_inputs([(rounds, tail)])
+                return waa.simulate_all_cuts_batch(points, mask, pos)
+            meter.run("cuts_batch", batch)
+
+        def export():
+            shoe = waa.ShoeResult(shoe_index=1, rounds=rounds, tail=tail, deck=deck)
+            waa.encode_shoe(rounds, tail, deck)
+            waa.export_rounds([shoe], "bench", out_dir=out_dir)
+            waa.export_vertical([shoe], "bench", out_dir=out_dir)
+            waa.export_cut_hits([waa.CutSimulationResult(
+                shoe_index=1, rows=rows, avg_hit=avg_hit, avg_rounds=avg_rounds)], "bench", out_dir=out_dir)
+        meter.run("export", export)
+        return attempts
+    raise RuntimeError("規則重試 10 次仍失敗")
+
+
+def _median(vals):
+    vals = sorted(vals)
+    if not vals:
+        return 0.0
+    mid = len(vals) // 2
+    return vals[mid] if len(vals) % 2 else (vals[mid - 1] + vals[mid]) / 2
+
+
+def measure(num_decks, samples, *, seed, memory, deadline_ms):
+    """量測單一副數：回傳各階段耗時中位數、記憶體峰值中位數與平均嘗試次數。"""
+    waa.NUM_DECKS = num_decks
+    times = {name: [] for name in STAGES}
+    peaks = {name: [] for name in STAGES}
+    attempts, failed = [], 0
+    with tempfile.TemporaryDirectory() as out_dir:
+        for i in range(samples):
+            shoe_seed = seed + i * 2**40
+            meter = _Meter(memory=False)
+            try:
+                attempts.append(_one_shoe(shoe_seed, meter, out_dir, deadline_ms))
+            except (RuntimeError, waa.GenerationDeadline):
+                failed += 1
+                continue
+            for name, ms in meter.ms.items():
+                times[name].append(ms)
+            if memory:
+                # 相同種子重跑一次，只取記憶體（tracemalloc 會拖慢計時）
+                meter = _Meter(memory=True)
+                tracemalloc.start()
+                try:
+                    _one_shoe(shoe_seed, meter, out_dir, None)
+                finally:
+                    tracemalloc.stop()
+                for name, kib in meter.peak_kib.items():
+                    peaks[name].append(kib)
+    return {
+        "decks": num_decks,
+        "cards": num_decks * 52,
+        "ok": samples - failed,
+        "failed": failed,
+        "attempts": round(sum(attempts) / len(attempts), 1) if attempts else None,
+        "ms": {name: round(_median(v), 2) for name, v in times.items() if v},
+        "peak_kib": {name: round(_median(v), 1) for name, v in peaks.items() if v},
+    }
+
+
+def growth_exponents(rows, field):
+    """每個階段以 log(值) 對 log(張數) 做最小平方，斜率即成長指數。"""
+    out = {}
+    for name in STAGES:
+        pts = [(math.log(r["cards"]), math.log(r[field][name]))
+               for r in rows if r[field].get(name, 0) > 0]
+        if len(pts) < 2:
+            continue
+        mx = sum(x for x, _ in pts) / len(pts)
+        my = sum(y for _, y in pts) / len(pts)
+        var = sum((x - mx) ** 2 for x, _ in pts)
+        if var:
+            out[name] = round(sum((x - mx) * (y - my) for x, y in pts) / var, 2)
+    return out
+
+
+def print_report(rows, exponents, mem_exponents):
+    stages = [name for name in STAGES if any(name in r["ms"] for r in rows)]
+    print(f"\n{'decks':>5}{'cards':>7}{'ok':>4}{'att':>7}" + "".join(f"{name + ' ms':>16}" for name in stages))
+    for r in rows:
+        att = f"{r['attempts']:.1f}" if r["attempts"] is not None else "-"
+        print(f"{r['decks']:>5}{r['cards']:>7}{r['ok']:>4}{att:>7}"
+              + "".join(f"{r['ms'].get(name, 0):>16.1f}" for name in stages))
+    if any(r["peak_kib"] for r in rows):
+        print(f"\n{'decks':>5}{'cards':>7}" + "".join(f"{name + ' KiB':>16}" for name in stages))
+        for r in rows:
+            print(f"{r['decks']:>5}{r['cards']:>7}" + "".join(f"{r['peak_kib'].get(name, 0):>16.1f}" for name in stages))
+    print("\n成長指數（時間 / 記憶體，1 ≈ 線性）：")
+    for name in stages:
+        t = exponents.get(name)
+        m = mem_exponents.get(name)
+        flag = "  <- 超線性" if t is not None and t > SUPERLINEAR else ""
+        print(f"  {name:<12} {t if t is not None else '-':>6} / {m if m is not None else '-':>6}{flag}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="牌靴副數擴展性量測")
+    parser.add_argument("--decks", type=int, nargs="+", default=[2, 4, 6, 8, 10, 12], help="要量測的副數")
+    parser.add_argument("--samples", type=int, default=3, help="每個副數量測的牌靴數")
+    parser.add_argument("--seed", type=int, default=1, help="基準種子（相同種子可重現結果）")
+    parser.add_argument("--deadline-ms", type=int, default=60000, help="單副牌生成的時間上限，超過記為失敗")
+    parser.add_argument("--no-memory", action="store_true", help="略過 tracemalloc 記憶體量測（時間減半）")
+    parser.add_argument("--json", metavar="PATH", help="把結果寫成 JSON")
+    args = parser.parse_args(argv)
+    for n in args.decks:
+        if not 1 <= n <= waa.MAX_NUM_DECKS:
+            parser.error(f"副數必須在 1..{waa.MAX_NUM_DECKS}")
+
+    waa.warm_pattern_tables()  # 建表是一次性成本，不算進任何副數
+    # 先以最小副數跑一副暖身（NumPy 首次呼叫、匯出檔案建立等），不列入結果
+    measure(min(args.decks), 1, seed=args.seed - 1, memory=False, deadline_ms=args.deadline_ms)
+    rows = []
+    for n in sorted(args.decks):
+        print(f"[量測] {n} 副（{n * 52} 張）× {args.samples}")
+        rows.append(measure(n, args.samples, seed=args.seed, memory=not args.no_memory,
+                            deadline_ms=args.deadline_ms))
+    exponents = growth_exponents(rows, "ms")
+    mem_exponents = growth_exponents(rows, "peak_kib")
+    print_report(rows, exponents, mem_exponents)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"rows": rows, "time_exponent": exponents, "memory_exponent": mem_exponents},
+                      f, ensure_ascii=False, indent=1)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""API 壓力 / 浸泡測試：以模擬使用者的操作流程打 FastAPI 端點並統計延遲與資源用量。
+
+使用者流程照 web/script.js 的操作：生成牌靴 → 連續切牌 → 匯出直式牌序與切牌統計。
+情境（--scenario）：
+- journey：每位使用者重複完整流程
+- cuts：先生成一副牌，之後只切牌（量測切牌快取與差量回應）
+- exports：先生成一副牌，之後只匯出
+- mixed：依權重隨機挑選生成 / 切牌 / 匯出
+
+目標（--target）：
+- inproc：在同一個行程內以 TestClient 呼叫 api.app:app（含 lifespan），伺服器資源即本行程
+- http://host:port：打已啟動的伺服器；帶 --server-pid 時從 /proc 取樣該行程的 CPU / RSS
+
+範例：
+    python tools/loadtest.py --scenario journey --users 4 --duration 60
+    python tools/loadtest.py --target http://127.0.0.1:7860 --server-pid 1234 --scenario mixed --users 16
+
+429（准入控制拒絕）與其他錯誤分開計數；--json 可把完整結果寫成檔案方便比較。
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+SCENARIOS = ("journey", "cuts", "exports", "mixed")
+MIXED_WEIGHTS = (("generate", 1), ("cut", 6), ("export", 2))
+
+
+# --- 傳輸層 ---
+
+class HttpTransport:
+    """以 urllib 打外部伺服器；每個請求獨立連線，可在多執行緒間共用。"""
+
+    def __init__(self, base):
+        self.base = base.rstrip("/")
+
+    def request(self, method, path, body=None, timeout=120):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.base + path, data=data, method=method)
+        if data is not None:
+            req.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read()
+
+    def close(self):
+        pass
+
+
+class InProcessTransport:
+    """同行程的 TestClient；以 with 進入，讓所有執行緒共用同一個事件迴圈（准入閘門綁在上面）。"""
+
+    def __init__(self):
+        from fastapi.testclient import TestClient
+        os.chdir(ROOT)  # api.app 以相對路徑掛載 web/ 靜態檔
+        from api.app import app
+        self._client = TestClient(app)
+        self._client.__enter__()
+        wait_ready(self)
+
+    def request(self, method, path, body=None, timeout=120):
+        resp = self._client.request(method, path, json=body)
+        return resp.status_code, resp.content
+
+    def close(self):
+        self._client.__exit__(None, None, None)
+
+
+def wait_ready(transport, timeout=300):
+    """等 /readyz 回 200 再開始量測，避免把暖機時間算進第一批請求。"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        status, _ = transport.request("GET", "/readyz")
+        if status in (200, 404):  # 404：伺服器版本沒有 /readyz
+            return
+        time.sleep(0.5)
+    raise RuntimeError(f"伺服器 {timeout} 秒內未就緒")
+
+
+# --- 伺服器資源取樣 ---
+
+def _read_proc(pid):
+    """回傳 (累計 CPU 秒數, RSS 位元組)；讀不到時回傳 None。"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+    return cpu, rss_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class ResourceSampler(threading.Thread):
+    """每 interval 秒取樣一次伺服器行程，統計平均 CPU% 與 RSS 峰值。"""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []  # (時間, CPU 秒數, RSS)
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.is_set():
+            got = _read_proc(self.pid)
+            if got is not None:
+                self.samples.append((time.perf_counter(), *got))
+            self._halt.wait(self.interval)
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+        got = _read_proc(self.pid)
+        if got is not None:
+            self.samples.append((time.perf_counter(), *got))
+
+    def summary(self):
+        if len(self.samples) < 2:
+            return None
+        (t0, cpu0, _), (t1, cpu1, _) = self.samples[0], self.samples[-1]
+        rss = [s[2] for s in self.samples]
+        return {
+            "pid": self.pid,
+            "cpu_percent": round((cpu1 - cpu0) / (t1 - t0) * 100, 1) if t1 > t0 else 0.0,
+            "rss_start_mb": round(rss[0] / 2**20, 1),
+            "rss_peak_mb": round(max(rss) / 2**20, 1),
+            "rss_end_mb": round(rss[-1] / 2**20, 1),
+        }
+
+
+# --- 使用者流程 ---
+
+class Recorder:
+    """收集每個請求的 (端點, 狀態, 毫秒)；append 在 CPython 下是原子操作。"""
+
+    def __init__(self):
+        self.records = []
+
+    def call(self, transport, name, method, path, body=None):
+        started = time.perf_counter()
+        try:
+            status, content = transport.request(method, path, body)
+        except Exception:
+            status, content = 0, b""
+        ms = (time.perf_counter() - started) * 1000
+        # 演算法層的錯誤以 200 + {"error": ...} 回傳，也算失敗
+        if status == 200 and content[:9] == b'{"error":':
+            status = -1
+        self.records.append((name, status, ms))
+        return status, content
+
+
+class User:
+    """單一模擬使用者；持有上一個切牌版本，切牌時帶 base_version 走差量路徑，和前端一致。"""
+
+    def __init__(self, transport, recorder, args, rng):
+        self.t = transport
+        self.rec = recorder
+        self.args = args
+        self.rng = rng
+        self.version = None
+        self.deck_len = (args.decks or 8) * 52
+
+    def generate(self):
+        body = {"num_shoes": 1, "signal_suit": self.rng.choice("HSDC")}
+        if self.args.decks:
+            body["num_decks"] = self.args.decks
+        if self.args.deadline_ms:
+            body["deadline_ms"] = self.args.deadline_ms
+        if self.args.reuse_library:
+            body["reuse_library"] = True
+        status, content = self.rec.call(self.t, "generate_shoe", "POST", "/api/generate_shoe", body)
+        if status == 200:
+            data = json.loads(content)
+            self.version = data.get("version")
+            self.deck_len = data.get("meta", {}).get("deck_len") or self.deck_len
+
+    def cut(self):
+        body = {"cut_pos": self.rng.randrange(self.deck_len)}
+        if self.version:
+            body["base_version"] = self.version
+        status, content = self.rec.call(self.t, "simulate_cut", "POST", "/api/simulate_cut", body)
+        if status == 200:
+            self.version = json.loads(content).get("version") or self.version
+
+    def export(self):
+        self.rec.call(self.t, "export_vertical", "GET", "/api/export/vertical")
+        self.rec.call(self.t, "export_cut_hits", "GET", "/api/export/cut_hits.csv")
+
+    def step(self, scenario):
+        if scenario == "journey":
+            self.generate()
+            for _ in range(self.args.cuts):
+                self.cut()
+            self.export()
+        elif scenario == "cuts":
+            self.cut()
+        elif scenario == "exports":
+            self.export()
+        else:
+            names, weights = zip(*MIXED_WEIGHTS)
+            getattr(self, self.rng.choices(names, weights)[0])()
+        if self.args.think_ms:
+            time.sleep(self.rng.uniform(0, 2 * self.args.think_ms) / 1000)
+
+
+def _percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, round(q / 100 * (len(sorted_vals) - 1))))
+    return sorted_vals[idx]
+
+
+def summarize(records, wall_s):
+    """依端點彙總：次數、每秒處理量、p50/p95/p99、錯誤率與 429 比例。"""
+    by_name = defaultdict(list)
+    for name, status, ms in records:
+        by_name[name].append((status, ms))
+    by_name["(all)"] = [(status, ms) for _, status, ms in records]
+    out = {}
+    for name, items in by_name.items():
+        lat = sorted(ms for status, ms in items if status == 200)
+        rejected = sum(1 for status, _ in items if status == 429)
+        errors = sum(1 for status, _ in items if status not in (200, 429))
+        out[name] = {
+            "count": len(items),
+            "ok": len(lat),
+            "throughput_rps": round(len(lat) / wall_s, 2) if wall_s else 0.0,
+            "p50_ms": round(_percentile(lat, 50), 1),
+            "p95_ms": round(_percentile(lat, 95), 1),
+            "p99_ms": round(_percentile(lat, 99), 1),
+            "max_ms": round(lat[-1], 1) if lat else 0.0,
+            "error_rate": round(errors / len(items), 4) if items else 0.0,
+            "rejected_rate": round(rejected / len(items), 4) if items else 0.0,
+        }
+    return out
+
+
+def run_scenario(transport, scenario, args, server_pid):
+    """跑一個情境：users 個執行緒各自重複流程，直到 duration 秒或 iterations 次用完。"""
+    recorder = Recorder()
+    if scenario in ("cuts", "exports", "mixed"):
+        # 這些情境需要伺服器上已有目前牌靴；暖機請求不列入統計
+        User(transport, Recorder(), args, random.Random(0)).generate()
+    sampler = ResourceSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def worker(idx):
+        user = User(transport, recorder, args, random.Random(args.seed * 1000 + idx))
+        done = 0
+        while (deadline is None or time.perf_counter() < deadline) and \
+                (not args.iterations or done < args.iterations):
+            user.step(scenario)
+            done += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.users)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    wall_s = time.perf_counter() - started
+    if sampler:
+        sampler.stop()
+    return {
+        "scenario": scenario,
+        "users": args.users,
+        "wall_s": round(wall_s, 2),
+        "endpoints": summarize(recorder.records, wall_s),
+        "server": sampler.summary() if sampler else None,
+    }
+
+
+def print_report(result):
+    print(f"\n== {result['scenario']}  users={result['users']}  wall={result['wall_s']}s ==")
+    print(f"{'endpoint':<18}{'count':>7}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'err%':>7}{'429%':>7}")
+    for name, s in result["endpoints"].items():
+        print(f"{name:<18}{s['count']:>7}{s['throughput_rps']:>8}{s['p50_ms']:>9}{s['p95_ms']:>9}"
+              f"{s['p99_ms']:>9}{s['max_ms']:>9}{s['error_rate'] * 100:>7.1f}{s['rejected_rate'] * 100:>7.1f}")
+    server = result["server"]
+    if server:
+        print(f"server pid={server['pid']} cpu={server['cpu_percent']}% "
+              f"rss={server['rss_start_mb']}→{server['rss_end_mb']} MB (peak {server['rss_peak_mb']} MB)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="waa API 壓力 / 浸泡測試")
+    parser.add_argument("--target", default="inproc", help="inproc 或伺服器網址（例如 http://127.0.0.1:7860）")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="可重複指定；預設依序跑全部情境")
+    parser.add_argument("--users", type=int, default=4, help="同時模擬的使用者數")
+    parser.add_argument("--duration", type=float, default=30.0, help="每個情境的秒數（0 表示只看 --iterations）")
+    parser.add_argument("--iterations", type=int, default=0, help="每位使用者的流程次數上限（0 表示不限）")
+    parser.add_argument("--cuts", type=int, default=8, help="journey 情境中每次生成後的切牌次數")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="每步之間的平均停頓毫秒數")
+    parser.add_argument("--deadline-ms", type=int, default=None, help="生成請求帶的 deadline_ms")
+    parser.add_argument("--decks", type=int, default=None, help="生成請求帶的 num_decks（省略表示伺服器預設）")
+    parser.add_argument("--reuse-library", action="store_true", help="生成請求帶 reuse_library（量測牌靴庫路徑）")
+    parser.add_argument("--server-pid", type=int, default=None, help="外部伺服器的 PID，用來取樣 CPU / RSS")
+    parser.add_argument("--seed", type=int, default=1, help="使用者亂數種子")
+    parser.add_argument("--json", metavar="PATH", help="把所有情境的結果寫成 JSON")
+    args = parser.parse_args(argv)
+    if not args.duration and not args.iterations:
+        parser.error("--duration 與 --iterations 至少要設定一個")
+
+    if args.target == "inproc":
+        transport = InProcessTransport()
+        server_pid = args.server_pid or os.getpid()
+    else:
+        transport = HttpTransport(args.target)
+        wait_ready(transport)
+        server_pid = args.server_pid
+    results = []
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            result = run_scenario(transport, scenario, args, server_pid)
+            print_report(result)
+            results.append(result)
+    finally:
+        transport.close()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"target": args.target, "results": results}, f, ensure_ascii=False, indent=1)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-產生「整靴全敏感局」的百家樂牌靴（8 副牌 / 416 張）。
+產生「整靴全敏感局」的百家樂牌靴（預設 8 副牌 / 416 張；副數由 NUM_DECKS 設定）。
 需求：
 - 不用 A 段、不要標記局；只保留敏感局（swap 前兩張→結果在閒/莊間翻轉、張數相同、且不把 原=和 且 換後=莊 算進來）。
 - 主流程：先掃天然敏感局，再對剩牌做「重複洗牌補強」，盡量塞滿。
 - 停止條件：當剩餘的牌無法排列成敏感局時(整副牌重洗。
 - 如果只剩 4/5/6 張且任何排列都無法成為敏感局 → 放棄此靴、重洗重來。
-- 若可排列成敏感局，程式會自動把尾局排列成敏感局，完成 416/416 全敏感。
+- 若可排列成敏感局，程式會自動把尾局排列成敏感局，完成整靴（例如 416/416）全敏感。
 - 也支援「手動指定最後一局順序」：若指定，並且與剩餘牌面一致且確實為敏感局，就使用手動順序；否則回退自動嘗試。
 
 輸出：
@@ -17,17 +17,29 @@
 
 使用方式：
 - 直接執行本腳本；可調整 CONFIG 區塊（包含 NUM_SHOES 可一次產生多副牌）。
+- 副數：python waa.py --decks 6（任何模式皆可；預設 NUM_DECKS，亦可用環境變數 WAA_NUM_DECKS）
+- 批次模式：python waa.py --batch 輸出資料夾 [--shoes N] [--workers W] [--seed S]
+  每副牌完成就寫出三個 CSV 並更新 checkpoint.json；中斷後以相同指令重跑即從未完成的牌靴接續。
 """
 from __future__ import annotations
 from dataclasses import dataclass
-from typing import List, Tuple, Optional, Dict
-import random, time, csv, collections, itertools, os
+from typing import List, Tuple, Optional, Dict, Callable
+import random, time, csv, collections, functools, itertools, os, struct, threading, hashlib, json, logging, contextlib
+
+try:
+    import numpy as np  # 批次切牌統計用；未安裝時其餘功能照常
+except ImportError:
+    np = None  # type: ignore
+
+# 規則套用失敗的細節走 logging：命令列模式顯示；API 預設不輸出（切牌模擬會大量重跑規則）
+log = logging.getLogger('waa')
 
 # =========================
 # CONFIG（可依需求調整）
 # =========================
 SEED: Optional[int] = None        # 指定整體亂數種子；None 表示每次執行都不同
 MAX_ATTEMPTS: int = 1000000       # 最多重試靴數（已設極高，請勿調小避免影響成功率）
+MAX_RULE_RETRY: int = 10          # 規則套用失敗時重新生成的次數上限（generate_ruled_shoe）
 # 花色處理（以下設定為流程必要條件，不建議修改為其他狀態）
 HEART_SIGNAL_ENABLED: bool = True # 固定啟用訊號花色補位
 SIGNAL_SUIT: str = '♥'            # 訊號花色（預設愛心，若需更換請同步調整流程）
@@ -44,12 +56,37 @@ MANUAL_TAIL: List[str] = []
 NUM_SHOES: int = 1               # 一次生成的敏感靴數量
 MIN_TAIL_STOP: int = 7            # 剩餘 < 7 張時停止補強，交給尾局排敏感
 MULTI_PASS_MIN_CARDS: int = 4     # 重複洗牌補強的最小剩牌門檻
+EXACT_PACK_ENABLED: bool = True   # 天然敏感局後先以回溯搜尋把剩牌精確拆成敏感局，失敗才回到重洗補強
+EXACT_PACK_NODE_BUDGET: int = 5000  # 精確打包的搜尋節點上限（超過視為無解）
+# 敏感點數排列表的落地快取（建表約 1 秒，讀檔約 0.03 秒）；空字串表示不落地
+PATTERN_CACHE_PATH: str = os.getenv('WAA_PATTERN_CACHE', 'pattern_tables.json')
+# 生成引擎：'shuffle' = 洗牌後掃描 + 補強；'constructive' = 逐局直接抽出敏感局
+GENERATION_ENGINE: str = 'shuffle'
+CONSTRUCT_FINISH_CARDS: int = 48  # 逐局抽到剩這麼多張時改用精確打包收尾
+CONSTRUCT_MAX_DRAWS: int = 400    # 單局最多抽樣次數，超過就回溯
+CONSTRUCT_BACKTRACK_ROUNDS: int = 3  # 每次回溯退回的局數
+CONSTRUCT_MAX_BACKTRACKS: int = 30   # 單次嘗試最多回溯次數，超過交回外層重試
+BATCH_CUT_STATS: bool = True      # 命令列模式：全部鞋生成後以 NumPy 一次計算切牌統計（未安裝 numpy 時逐鞋計算）
+# 洗牌亂數：'philox' = 以 (種子, 計數器) 定址的 NumPy Philox 批次產生排列；'python' = random.shuffle
+SHUFFLE_RNG: str = 'philox'
+# 自動調參結果（python waa.py --autotune 產生）；依 (訊號花色, 和局花色) 覆寫 TUNABLE_PARAMS，檔案不存在則用上面的預設值
+TUNING_PATH: str = os.getenv('WAA_TUNING_PATH', 'tuning.json')
+# 多候選生成：一次產生 K 副牌，以切牌分析排序後取最佳；目標見 CANDIDATE_OBJECTIVES
+CANDIDATE_OBJECTIVE: str = 'min_avg_hit'
+CANDIDATE_WORKERS: int = int(os.getenv('WAA_CANDIDATE_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+# 最近一次成功生成的 (基準種子, 嘗試序號)；搭配 generation_config_hash() 即可以 regenerate_shoe 重建
+# 多執行緒（API）請改用 last_generation_key()：全域值可能已被其他執行緒的生成覆寫
+LAST_GEN_SEED: Optional[int] = None
+LAST_GEN_ATTEMPT: Optional[int] = None
+_GEN_LOCAL = threading.local()
 
 # =========================
 # 基本常數與資料結構
 # =========================
 SUITS = ['♠','♥','♦','♣']
-NUM_DECKS = 8
+NUM_DECKS = int(os.getenv('WAA_NUM_DECKS', '8'))  # 牌靴副數；API 的 num_decks / 命令列 --decks 會覆寫
+MAX_NUM_DECKS = 16  # 緊湊編碼以 uint16 存位置，另限制單次生成的成本
 RANKS = ['A'] + [str(i) for i in range(2, 10)] + ['10', 'J', 'Q', 'K']
 CARD_VALUES = {**{str(i): i for i in range(2, 10)}, '10': 0, 'J': 0, 'Q': 0, 'K': 0, 'A': 1}
 
@@ -57,7 +94,7 @@ CARD_VALUES = {**{str(i): i for i in range(2, 10)}, '10': 0, 'J': 0, 'Q': 0, 'K'
 class Card:
     rank: str
     suit: str
-    pos: int  # 0..415 在原靴的絕對索引
+    pos: int  # 0..shoe_size()-1 在原靴的絕對索引
     color: Optional[str] = None  # 'R' 或 'B'；獨立於花色
     def point(self) -> int: return CARD_VALUES[self.rank]
     def short(self) -> str: return f"{self.rank}{self.suit}"
@@ -92,15 +129,104 @@ class CutSimulationResult:
 # 牌靴與模擬
 # =========================
 
+# 每個執行緒各自一條亂數流：生成時依 (基準種子 + attempt) 重設，緊接著的規則套用沿用同一條流，
+# 因此整副牌靴（含顏色）只由一組種子決定，也不會被其他執行緒（例如背景切牌計算）打亂。
+_RNG_LOCAL = threading.local()
+
+def _rng() -> random.Random:
+    rng = getattr(_RNG_LOCAL, 'rng', None)
+    if rng is None:
+        rng = _RNG_LOCAL.rng = random.Random()
+    return rng
+
+# =========================
+# 每次呼叫的生成設定
+# =========================
+# 副數、花色、調參值與種子可以只在單一執行緒內覆寫：with generation_settings(...) 區塊內的生成、規則套用與
+# 設定雜湊都讀區塊的值，伺服器同時處理的其他請求不受影響；區塊外（命令列）讀模組 CONFIG。
+CALL_SETTINGS = ('NUM_DECKS', 'SIGNAL_SUIT', 'TIE_SIGNAL_SUIT', 'MIN_TAIL_STOP', 'MULTI_PASS_MIN_CARDS', 'LATE_BALANCE_DIFF', 'SEED')
+_SETTINGS_LOCAL = threading.local()
+
+def setting(name: str):
+    """目前生效的設定值：本執行緒的 generation_settings 區塊優先，否則為模組 CONFIG。"""
+    values = getattr(_SETTINGS_LOCAL, 'values', None)
+    if values is not None and name in values:
+        return values[name]
+    return globals()[name]
+
+@contextlib.contextmanager
+def generation_settings(values: Dict[str, object]):
+    """在本執行緒內以 values（CALL_SETTINGS 中的名稱）覆寫設定；可巢狀，離開區塊時恢復外層的值。"""
+    unknown = set(values) - set(CALL_SETTINGS)
+    if unknown:
+        raise ValueError(f"不可覆寫的設定：{', '.join(sorted(unknown))}")
+    outer = getattr(_SETTINGS_LOCAL, 'values', None)
+    _SETTINGS_LOCAL.values = {**(outer or {}), **values}
+    try:
+        yield
+    finally:
+        _SETTINGS_LOCAL.values = outer
+
+def settings_for(signal_suit: str, tie_suit: Optional[str] = None, num_decks: Optional[int] = None) -> Dict[str, object]:
+    """(訊號花色, 和局花色, 副數) 的完整生成設定，含該花色組合的調參結果（tuned_params）；
+    num_decks 省略時沿用目前生效的副數。可交給 generation_settings，也可原樣帶到子行程。"""
+    return {'NUM_DECKS': num_decks or setting('NUM_DECKS'), 'SIGNAL_SUIT': signal_suit,
+            'TIE_SIGNAL_SUIT': tie_suit or None, **tuned_params(signal_suit, tie_suit)}
+
+def current_settings() -> Dict[str, object]:
+    """目前生效的副數、花色與調參值（不含 SEED），可帶到子行程重現同一組設定。"""
+    return {name: setting(name) for name in CALL_SETTINGS if name != 'SEED'}
+
+def shoe_size() -> int:
+    """目前生效的牌靴張數（NUM_DECKS × 52）。"""
+    return setting('NUM_DECKS') * 52
+
 def build_shuffled_deck() -> List[Card]:
     base = [Card(rank=r, suit=s, pos=-1) for s in SUITS for r in RANKS]
     deck: List[Card] = []
-    for _ in range(NUM_DECKS):
+    for _ in range(setting('NUM_DECKS')):
         deck.extend([Card(c.rank, c.suit, -1) for c in base])
-    random.shuffle(deck)
+    _rng().shuffle(deck)
     for i, c in enumerate(deck): c.pos = i
     return deck
 
+# =========================
+# 批次洗牌（計數器式亂數）
+# =========================
+# 每個排列由 (種子, 計數器) 唯一決定：計數器 c 落在第 c // _PERM_BLOCK 區塊的第 c % _PERM_BLOCK 列。
+# 區塊編號放在 Philox 計數器的高位字，各區塊的亂數流互不重疊，平行工作者只要分配不同計數器即可。
+_PERM_BLOCK = 64
+
+def batch_permutations(seed: int, block: int, *, n: Optional[int] = None) -> 'np.ndarray':
+    """回傳第 block 區塊的 _PERM_BLOCK 個 0..n-1 排列（int16 陣列，形狀 (_PERM_BLOCK, n)）。"""
+    _require_numpy()
+    n = n or shoe_size()
+    bitgen = np.random.Philox(key=seed & (2**64 - 1), counter=[0, 0, block, 0])
+    rows = np.tile(np.arange(n, dtype=np.int16), (_PERM_BLOCK, 1))
+    return np.random.Generator(bitgen).permuted(rows, axis=1)
+
+def deck_from_permutation(perm) -> List[Card]:
+    """依排列建牌靴：牌號 i 對應 build_shuffled_deck 未洗前的第 i 張（花色主序、點數次序）。"""
+    deck: List[Card] = []
+    for pos, i in enumerate(perm.tolist()):
+        i %= 52
+        deck.append(Card(RANKS[i % 13], SUITS[i // 13], pos))
+    return deck
+
+class PermutationStream:
+    """依計數器取排列；同一區塊只產生一次，連續嘗試時一次呼叫涵蓋 _PERM_BLOCK 副牌。"""
+    def __init__(self, seed: int):
+        self.seed = seed
+        self._block = -1
+        self._perms = None
+
+    def deck(self, counter: int) -> List[Card]:
+        block, row = divmod(counter, _PERM_BLOCK)
+        if block != self._block:
+            self._perms = batch_permutations(self.seed, block)
+            self._block = block
+        return deck_from_permutation(self._perms[row])
+
 class Simulator:
     def __init__(self, deck: List[Card]):
         self.deck = deck
@@ -180,13 +306,42 @@ def scan_all_sensitive_rounds(sim: Simulator) -> List[Round]:
             out.append(r)
     return out
 
+def select_natural_rounds(rounds: List[Round]) -> List[Round]:
+    """從互相重疊的天然敏感局中挑出不重疊、總張數最多的一組（加權區間排程 DP）。
+    天然局在原靴上是連續區間 [start, start+張數)，每個起點至多一局，因此以位置做 O(N) DP。"""
+    if not rounds:
+        return []
+    by_start = {r.start_index: r for r in rounds}
+    end = max(r.start_index + len(r.cards) for r in rounds)
+    # best[i]：只用起點 >= i 的局時可覆蓋的最多張數
+    best = [0] * (end + 1)
+    take = [False] * (end + 1)
+    for i in range(end - 1, -1, -1):
+        best[i] = best[i + 1]
+        r = by_start.get(i)
+        if r is not None:
+            covered = len(r.cards) + best[i + len(r.cards)]
+            if covered >= best[i]:
+                best[i] = covered
+                take[i] = True
+    out: List[Round] = []
+    i = 0
+    while i < end:
+        if take[i]:
+            r = by_start[i]
+            out.append(r)
+            i += len(r.cards)
+        else:
+            i += 1
+    return out
+
 def multi_pass_candidates_from_cards_simple(card_pool: List[Card]) -> List[Round]:
     """把剩餘牌重洗，找敏感局，並映射回原靴的卡片順序。"""
     if len(card_pool) < 4:
         return []
     # 洗剩牌
     shuffled = card_pool.copy()
-    random.shuffle(shuffled)
+    _rng().shuffle(shuffled)
     # 建臨時牌（pos=臨時索引）與映射到原牌
     temp_cards = [Card(c.rank, c.suit, i) for i,c in enumerate(shuffled)]
     idx2orig: Dict[int, Card] = {i: c for i,c in enumerate(shuffled)}
@@ -330,6 +485,217 @@ def try_use_manual_tail(tail_cards: List[Card], manual: List[str]) -> Optional[L
         ordered.append(short2stack[face].pop())
     return ordered if _is_sensitive_sequence(ordered) else None
 
+# =========================
+# 精確打包（剩牌點數多重集合 → 敏感局的回溯搜尋）
+# =========================
+# 敏感判定只與點數有關，因此先列舉所有「剛好用完自身張數」的 4/5/6 張敏感點數序列，
+# 依點數多重集合分組；搜尋時只處理 10 維的點數計數，最後才把點數映射回實際 Card。
+PointKey = Tuple[int, ...]  # 長度 10 的點數計數（索引 = 點數）
+
+class _PackBudgetExceeded(Exception):
+    """精確打包超過節點預算時中止搜尋用。"""
+
+class _AttemptDeadline(Exception):
+    """時間預算在單次嘗試中途用盡（精確打包、補強與逐局建構的迴圈內檢查）；外層轉成 GenerationDeadline。"""
+
+def _past(deadline: Optional[float]) -> bool:
+    """deadline 為 time.perf_counter() 的絕對時間；None 表示不限。"""
+    return deadline is not None and time.perf_counter() >= deadline
+
+_PATTERN_TABLES: Optional[Tuple[Dict[PointKey, List[Tuple[int, ...]]], List[List[PointKey]]]] = None
+
+def _deal_points(pts: Tuple[int, ...]) -> Optional[Tuple[str, int]]:
+    """以點數序列（從第 0 張開始）模擬一局，回傳 (結果, 用張)；牌不夠時回傳 None。
+    補牌規則與 Simulator.simulate_round 相同。"""
+    n = len(pts)
+    if n < 4:
+        return None
+    p_tot = (pts[0] + pts[2]) % 10
+    b_tot = (pts[1] + pts[3]) % 10
+    idx = 4
+    if not ((p_tot in (8, 9)) or (b_tot in (8, 9))):
+        p3 = None
+        if p_tot <= 5:
+            if idx >= n: return None
+            p3 = pts[idx]; idx += 1; p_tot = (p_tot + p3) % 10
+        if p3 is None:
+            draw = b_tot <= 5
+        else:
+            draw = (
+                b_tot <= 2
+                or (b_tot == 3 and p3 != 8)
+                or (b_tot == 4 and p3 in (2, 3, 4, 5, 6, 7))
+                or (b_tot == 5 and p3 in (4, 5, 6, 7))
+                or (b_tot == 6 and p3 in (6, 7))
+            )
+        if draw:
+            if idx >= n: return None
+            b_tot = (b_tot + pts[idx]) % 10; idx += 1
+    res = '和' if p_tot == b_tot else ('閒' if p_tot > b_tot else '莊')
+    return res, idx
+
+def _is_sensitive_points(pts: Tuple[int, ...]) -> bool:
+    """點數版 _is_sensitive_sequence：整段剛好一局且 P1↔B1 交換後符合敏感定義。"""
+    orig = _deal_points(pts)
+    if orig is None or orig[1] != len(pts):
+        return False
+    swap = _deal_points((pts[1], pts[0]) + tuple(pts[2:]))
+    if swap is None:
+        return False
+    res, swap_res = orig[0], swap[0]
+    return (
+        swap_res != res
+        and swap_res != '和'
+        and swap[1] == len(pts)
+        and not (res == '和' and swap_res == '莊')
+    )
+
+def sensitive_point_patterns() -> Tuple[Dict[PointKey, List[Tuple[int, ...]]], List[List[PointKey]]]:
+    """回傳 (點數計數 → 所有敏感排列, 每個點數 → 含該點數的計數清單)；首次呼叫時建表並快取。
+    每個點數的清單依張數由多到少排列，同張數維持列舉順序，讓搜尋結果可重現。"""
+    global _PATTERN_TABLES
+    if _PATTERN_TABLES is not None:
+        return _PATTERN_TABLES
+    by_key: Dict[PointKey, List[Tuple[int, ...]]] = {}
+
+    def extend(pts: Tuple[int, ...]) -> None:
+        dealt = _deal_points(pts)
+        if dealt is None:
+            if len(pts) < 6:
+                for v in range(10):
+                    extend(pts + (v,))
+            return
+        if dealt[1] == len(pts) and _is_sensitive_points(pts):
+            counts = [0] * 10
+            for v in pts:
+                counts[v] += 1
+            by_key.setdefault(tuple(counts), []).append(pts)
+
+    for prefix in itertools.product(range(10), repeat=4):
+        extend(prefix)
+    _PATTERN_TABLES = _index_patterns(by_key)
+    return _PATTERN_TABLES
+
+def _index_patterns(by_key: Dict[PointKey, List[Tuple[int, ...]]]) -> Tuple[Dict[PointKey, List[Tuple[int, ...]]], List[List[PointKey]]]:
+    """由「點數計數 → 排列」表建出每個點數可用的計數索引（張數多的優先）。"""
+    by_value: List[List[PointKey]] = [[] for _ in range(10)]
+    for key in by_key:
+        for v, cnt in enumerate(key):
+            if cnt:
+                by_value[v].append(key)
+    for keys in by_value:
+        keys.sort(key=lambda k: -sum(k))
+    return by_key, by_value
+
+_PATTERN_CACHE_TAG = 'waa-sensitive-patterns/2'
+
+def warm_pattern_tables(path: Optional[str] = None) -> str:
+    """預先備好敏感點數排列表：已在記憶體回傳 'memory'，從落地快取讀入回傳 'file'，
+    重新建表（並寫回快取）回傳 'built'。快取是純資料 JSON（只存計數 → 排列，索引讀入後重建），
+    讀檔不會執行任何程式碼；格式標記不符或內容不完整時忽略並重建。"""
+    global _PATTERN_TABLES
+    if _PATTERN_TABLES is not None:
+        return 'memory'
+    path = PATTERN_CACHE_PATH if path is None else path
+    if path:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                doc = json.load(f)
+            if doc.get('tag') == _PATTERN_CACHE_TAG:
+                by_key = {tuple(key): [tuple(p) for p in pats] for key, pats in doc['patterns']}
+                if by_key and all(len(key) == 10 for key in by_key):
+                    _PATTERN_TABLES = _index_patterns(by_key)
+                    return 'file'
+        except (OSError, ValueError, TypeError, KeyError, AttributeError):
+            pass
+    by_key, _ = sensitive_point_patterns()
+    if path:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'tag': _PATTERN_CACHE_TAG, 'patterns': [[list(k), [list(p) for p in v]] for k, v in by_key.items()]},
+                          f, separators=(',', ':'))
+            os.replace(tmp, path)
+        except OSError:
+            pass  # 快取只是加速，寫不進去照常運作
+    return 'built'
+
+def exact_pack_points(counts: PointKey, *, node_budget: int, deadline: Optional[float] = None) -> Optional[List[PointKey]]:
+    """把點數計數完整拆成敏感局（以點數計數表示）；無解或超過節點預算時回傳 None。
+    每層固定挑「剩餘張數最少的點數」分支（精確覆蓋的最少選項欄），失敗狀態以計數記憶。
+    超過 deadline 時拋出 _AttemptDeadline（每個節點都檢查；相對於展開節點的成本可忽略）。"""
+    _, by_value = sensitive_point_patterns()
+    failed: set = set()
+    picked: List[PointKey] = []
+    nodes = 0
+
+    def dfs(cur: PointKey) -> bool:
+        nonlocal nodes
+        total = sum(cur)
+        if total == 0:
+            return True
+        if total < 4 or cur in failed:
+            return False
+        nodes += 1
+        if nodes > node_budget:
+            raise _PackBudgetExceeded
+        if _past(deadline):
+            raise _AttemptDeadline
+        v = min((v for v in range(10) if cur[v]), key=lambda v: cur[v])
+        for key in by_value[v]:
+            if any(need > have for need, have in zip(key, cur)):
+                continue
+            nxt = tuple(have - need for have, need in zip(cur, key))
+            if 0 < sum(nxt) < 4:
+                continue
+            picked.append(key)
+            if dfs(nxt):
+                return True
+            picked.pop()
+        failed.add(cur)
+        return False
+
+    try:
+        ok = dfs(tuple(counts))
+    except _PackBudgetExceeded:
+        return None
+    return picked if ok else None
+
+def exact_pack_cards(card_pool: List[Card], *, node_budget: int, deadline: Optional[float] = None) -> Optional[List[Round]]:
+    """以 exact_pack_points 把剩牌全部排成敏感局；每組點數隨機挑一種敏感排列與實際牌。"""
+    counts = [0] * 10
+    stacks: Dict[int, List[Card]] = collections.defaultdict(list)
+    for c in card_pool:
+        counts[c.point()] += 1
+        stacks[c.point()].append(c)
+    keys = exact_pack_points(tuple(counts), node_budget=node_budget, deadline=deadline)
+    if keys is None:
+        return None
+    by_key, _ = sensitive_point_patterns()
+    for stack in stacks.values():
+        _rng().shuffle(stack)
+    out: List[Round] = []
+    for key in keys:
+        pts = _rng().choice(by_key[key])
+        cards = [stacks[v].pop() for v in pts]
+        res = _deal_points(pts)
+        out.append(Round(cards[0].pos, cards, res[0] if res else '', True))
+    return out
+
+def _reserve_manual_tail(pool: List[Card], manual: List[str]) -> Optional[List[Card]]:
+    """從牌池中依 manual 牌面取出手動尾局；牌面不足或不是敏感局時回傳 None。"""
+    if not manual:
+        return None
+    short2stack: Dict[str, List[Card]] = collections.defaultdict(list)
+    for c in pool:
+        short2stack[c.short()].append(c)
+    ordered: List[Card] = []
+    for face in manual:
+        if not short2stack[face]:
+            return None
+        ordered.append(short2stack[face].pop())
+    return ordered if _is_sensitive_sequence(ordered) else None
+
 # =========================
 # 花色處理（S_idx + 平衡）
 # =========================
@@ -481,7 +847,7 @@ def enforce_suit_distribution(rounds: List[RoundView], signal_suit: str, s_idx:
     # 2. 計算 S_idx 所涵蓋局的總容量（每局的張數加總）
     s_cap = sum(len(rounds[i].cards) for i in s_idx)
     if s_idx and s_cap < total_signal:
-        print(f"[驗證] S_idx 容量不足：容量 {s_cap} < 訊號花色總數 {total_signal}，S_idx 長度={len(s_idx)}")
+        log.info("[驗證] S_idx 容量不足：容量 %d < 訊號花色總數 %d，S_idx 長度=%d", s_cap, total_signal, len(s_idx))
         raise RuntimeError(f"S_idx 容量不足 ({s_cap})，無法容納所有 {signal_suit} ({total_signal})")
 
     # 3. 收集所有非 S_idx 的訊號牌當 donors
@@ -529,7 +895,7 @@ def enforce_suit_distribution(rounds: List[RoundView], signal_suit: str, s_idx:
         receivers = [k for k, c in enumerate(rounds[i].cards) if c.suit != signal_suit]
         for _ in range(need):
             if not donors or not receivers:
-                print(f"[驗證] 交換資源不足：donors={len(donors)} receivers={len(receivers)}，S_idx 長度={len(s_idx)}")
+                log.info("[驗證] 交換資源不足：donors=%d receivers=%d，S_idx 長度=%d", len(donors), len(receivers), len(s_idx))
                 raise RuntimeError("花色交換資源不足")
             di, dj = donors.pop()
             rk = receivers.pop()
@@ -587,7 +953,7 @@ def late_balance(rounds: List[RoundView], locked_ids: set, diff: int, signal_sui
         # 強化驗證輸出：平衡失敗時輸出分佈與門檻
         dist = ', '.join(f'{s}:{c.get(s, 0)}' for s in (suits_to_balance))
         sig = signal_suit if signal_suit else '-'
-        print(f"[驗證] 花色平衡失敗：允許差<={diff}，分佈=({dist})，排除訊號花色={sig}")
+        log.info("[驗證] 花色平衡失敗：允許差<=%s，分佈=(%s)，排除訊號花色=%s", diff, dist, sig)
     return ok
 
 def _apply_color_rule_for_shoe(round_views: List[RoundView], tail: Optional[List[Card]]) -> None:
@@ -634,7 +1000,7 @@ def _apply_color_rule_for_shoe(round_views: List[RoundView], tail: Optional[List
 
         chosen = None
         if ok1 and ok2:
-            chosen = random.choice([pat1, pat2])
+            chosen = _rng().choice([pat1, pat2])
         elif ok1:
             chosen = pat1
         else:
@@ -676,7 +1042,7 @@ def _apply_color_rule_for_shoe(round_views: List[RoundView], tail: Optional[List
                 # 若 color_pool 比 uncolored 多（理論上不會），縮減多餘配額
                 color_pool = color_pool[:len(uncolored)]
 
-        random.shuffle(color_pool)  # 隨機化分配
+        _rng().shuffle(color_pool)  # 隨機化分配
 
         for card in uncolored:
             card.color = color_pool.pop()
@@ -694,7 +1060,11 @@ def _apply_color_rule_for_shoe(round_views: List[RoundView], tail: Optional[List
 # 主流程（一次打包 + 外層重試）
 # =========================
 
-def pack_all_sensitive_once(deck: List[Card], *, min_tail_stop: int, multi_pass_min_cards: int) -> Optional[Tuple[List[Round], List[Card]]]:
+# 嘗試失敗時回報 (已排好的敏感局, 剩牌, 牌靴)，供截止時間到時交回最佳部分結果
+PartialCallback = Callable[[List[Round], List[Card], List[Card]], None]
+
+def pack_all_sensitive_once(deck: List[Card], *, min_tail_stop: int, multi_pass_min_cards: int, on_partial: Optional[PartialCallback] = None, deadline: Optional[float] = None) -> Optional[Tuple[List[Round], List[Card]]]:
+    """超過 deadline 時把目前的敏感局交給 on_partial 後拋出 _AttemptDeadline。"""
     sim = Simulator(deck)
     # 1) 掃全靴天然敏感
     all_sensitive = scan_all_sensitive_rounds(sim)
@@ -703,18 +1073,34 @@ def pack_all_sensitive_once(deck: List[Card], *, min_tail_stop: int, multi_pass_
     used_pos: set[int] = set()
     out_rounds: List[Round] = []
 
-    # 先把天然敏感局放進暫存（不過濾重疊，後面用 used_pos 控制）
-    for r in all_sensitive:
-        if any(c.pos in used_pos for c in r.cards):
-            continue
+    # 先把天然敏感局放進暫存：以區間 DP 挑出覆蓋張數最多的不重疊組合
+    for r in select_natural_rounds(all_sensitive):
         out_rounds.append(r)
         for c in r.cards: used_pos.add(c.pos)
 
+    # 1b) 精確打包：剩牌能完整拆成敏感局就直接完成（手動尾局先保留下來）
+    if EXACT_PACK_ENABLED:
+        remaining = [c for c in deck if c.pos not in used_pos]
+        manual = _reserve_manual_tail(remaining, MANUAL_TAIL)
+        if manual is not None:
+            reserved = {c.pos for c in manual}
+            remaining = [c for c in remaining if c.pos not in reserved]
+        try:
+            packed = exact_pack_cards(remaining, node_budget=EXACT_PACK_NODE_BUDGET, deadline=deadline)
+        except _AttemptDeadline:
+            if on_partial: on_partial(out_rounds, remaining + (manual or []), deck)
+            raise
+        if packed is not None:
+            return out_rounds + packed, manual or []
+
     # 反覆補強
     while True:
         remaining = [c for c in deck if c.pos not in used_pos]
         if len(remaining) < multi_pass_min_cards:
             break
+        if _past(deadline):
+            if on_partial: on_partial(out_rounds, remaining, deck)
+            raise _AttemptDeadline
         extra = multi_pass_candidates_from_cards_simple(remaining)
         if not extra:
             break
@@ -732,6 +1118,7 @@ def pack_all_sensitive_once(deck: List[Card], *, min_tail_stop: int, multi_pass_
     if not leftover:
         return out_rounds, []
     if len(leftover) >= min_tail_stop:
+        if on_partial: on_partial(out_rounds, leftover, deck)
         return None
 
     # 3a) 先試手動尾局
@@ -740,30 +1127,324 @@ def pack_all_sensitive_once(deck: List[Card], *, min_tail_stop: int, multi_pass_
         # 3b) 自動排列
         tail = try_make_tail_sensitive(leftover)
     if tail is None:
+        if on_partial: on_partial(out_rounds, leftover, deck)
         return None
     return out_rounds, tail
 
 
-def generate_all_sensitive_shoe_or_retry(*, max_attempts: int, min_tail_stop: int, multi_pass_min_cards: int) -> Tuple[List[Round], List[Card], List[Card]]:
-    """外層重試直到整靴 416/416 皆敏感。回傳：(敏感局、尾局牌（可能空）、完整牌靴)。"""
-    attempt = 0
-    while attempt < max_attempts:
-        attempt += 1
-        # 設定種子：若指定 SEED，每次以 SEED+attempt 改變；否則用時間熵
-        if SEED is not None:
-            random.seed(SEED + attempt)
+def _draw_sensitive_round(pool: List[Card], max_draws: int) -> Optional[Round]:
+    """從牌池不放回地隨機發一局，直到抽到敏感局；抽中的牌自牌池移除。
+    每次抽樣等同自然洗牌下的一局，只接受敏感局，因此分布是「自然洗牌、條件為敏感」。"""
+    n = len(pool)
+    for _ in range(max_draws):
+        pts: List[int] = []
+        dealt = None
+        # 部分 Fisher-Yates：第 k 張抽到的牌換到 pool[n-1-k]
+        while dealt is None:
+            k = len(pts)
+            if k >= n:
+                return None
+            j = _rng().randrange(n - k)
+            pool[j], pool[n - 1 - k] = pool[n - 1 - k], pool[j]
+            pts.append(pool[n - 1 - k].point())
+            if len(pts) >= 4:
+                dealt = _deal_points(tuple(pts))
+        if _is_sensitive_points(tuple(pts)):
+            k = len(pts)
+            cards = [pool[n - 1 - i] for i in range(k)]
+            del pool[n - k:]
+            return Round(-1, cards, dealt[0], True)
+    return None
+
+def _number_constructive(rounds: List[Round], rest: List[Card]) -> Tuple[List[Round], List[Card]]:
+    """依發牌順序重新編號，局與其後的牌都共用回傳 deck 中的 Card。"""
+    deck = [c for r in rounds for c in r.cards] + rest
+    for i, c in enumerate(deck):
+        c.pos = i
+    return [Round(r.cards[0].pos, r.cards, r.result, True) for r in rounds], deck
+
+def build_constructive_shoe(on_partial: Optional[PartialCallback] = None, deadline: Optional[float] = None) -> Optional[Tuple[List[Round], List[Card], List[Card]]]:
+    """逐局建構整靴：從剩餘 NUM_DECKS 副牌多重集合抽敏感局，剩 CONSTRUCT_FINISH_CARDS 張時以精確打包收尾；
+    收尾失敗或抽不到敏感局時退回幾局重抽。回傳格式同 generate_all_sensitive_shoe_or_retry；
+    回溯次數用盡則回傳 None，超過 deadline 則拋出 _AttemptDeadline（兩者都先把已抽好的局交給 on_partial）。"""
+    base = [Card(rank=r, suit=s, pos=-1) for s in SUITS for r in RANKS]
+    pool = [Card(c.rank, c.suit, -1) for _ in range(setting('NUM_DECKS')) for c in base]
+    tail = _reserve_manual_tail(pool, MANUAL_TAIL) or []
+    if tail:
+        reserved = {id(c) for c in tail}
+        pool = [c for c in pool if id(c) not in reserved]
+    rounds: List[Round] = []
+    backtracks = 0
+
+    def report_partial() -> None:
+        if on_partial:
+            rest = pool + tail
+            numbered, deck = _number_constructive(rounds, rest)
+            on_partial(numbered, rest, deck)
+
+    while True:
+        if len(pool) <= CONSTRUCT_FINISH_CARDS:
+            try:
+                packed = exact_pack_cards(pool, node_budget=EXACT_PACK_NODE_BUDGET, deadline=deadline)
+            except _AttemptDeadline:
+                report_partial()
+                raise
+            if packed is not None:
+                _rng().shuffle(packed)
+                rounds.extend(packed)
+                break
+            r = None
         else:
-            random.seed(time.time_ns() + attempt)
-        deck = build_shuffled_deck()
-        packed = pack_all_sensitive_once(deck, min_tail_stop=min_tail_stop, multi_pass_min_cards=multi_pass_min_cards)
-        if packed is None:
+            if _past(deadline):
+                report_partial()
+                raise _AttemptDeadline
+            r = _draw_sensitive_round(pool, CONSTRUCT_MAX_DRAWS)
+        if r is not None:
+            rounds.append(r)
             continue
+        # 回溯：退回最後幾局，讓剩牌組成改變後再抽
+        backtracks += 1
+        if backtracks > CONSTRUCT_MAX_BACKTRACKS or not rounds:
+            report_partial()
+            return None
+        for _ in range(min(CONSTRUCT_BACKTRACK_ROUNDS, len(rounds))):
+            pool.extend(rounds.pop().cards)
+
+    rounds, deck = _number_constructive(rounds, tail)
+    return rounds, tail, deck
+
+def _generation_attempt(base_seed: int, attempt: int, stream: Optional[PermutationStream], *, min_tail_stop: int, multi_pass_min_cards: int, on_partial: Optional[PartialCallback] = None, deadline: Optional[float] = None) -> Optional[Tuple[List[Round], List[Card], List[Card]]]:
+    """執行單次嘗試；結果只由 (base_seed, attempt) 與 CONFIG 決定。失敗回傳 None。
+    超過 deadline（time.perf_counter() 絕對時間）時中途放棄並拋出 _AttemptDeadline，不會產生另一種結果。"""
+    _RNG_LOCAL.rng = random.Random(base_seed + attempt)
+    if GENERATION_ENGINE == 'constructive':
+        built = build_constructive_shoe(on_partial, deadline)
+        if built is None:
+            return None
+        rounds, tail, deck = built
+    else:
+        deck = stream.deck(attempt) if stream is not None else build_shuffled_deck()
+        packed = pack_all_sensitive_once(deck, min_tail_stop=min_tail_stop, multi_pass_min_cards=multi_pass_min_cards, on_partial=on_partial, deadline=deadline)
+        if packed is None:
+            return None
         rounds, tail = packed
-        total_cards = sum(len(r.cards) for r in rounds) + len(tail)
-        if all(r.sensitive for r in rounds) and total_cards == 416:
-            return rounds, tail, deck
+    total_cards = sum(len(r.cards) for r in rounds) + len(tail)
+    if all(r.sensitive for r in rounds) and total_cards == shoe_size():
+        return rounds, tail, deck
+    return None
+
+def _permutation_stream(base_seed: int) -> Optional[PermutationStream]:
+    return PermutationStream(base_seed) if SHUFFLE_RNG == 'philox' and np is not None else None
+
+class GenerationDeadline(RuntimeError):
+    """時間預算用盡仍未生成全敏感牌靴；附上目前覆蓋率最高的部分結果。
+    rounds 皆為敏感局，leftover 為未能排入敏感局的牌，coverage = 敏感局張數 / 全靴張數。"""
+    def __init__(self, rounds: List[Round], leftover: List[Card], deck: List[Card], *, attempts: int, elapsed_ms: float):
+        self.rounds, self.leftover, self.deck = rounds, leftover, deck
+        self.attempts, self.elapsed_ms = attempts, elapsed_ms
+        self.coverage = sum(len(r.cards) for r in rounds) / len(deck) if deck else 0.0
+        super().__init__(f"時間預算 {elapsed_ms:.0f} ms 用盡（{attempts} 次嘗試），最佳覆蓋率 {self.coverage:.1%}")
+
+# 生成進度回呼：每次嘗試結束送出一個事件 dict（type='attempt'）
+ProgressCallback = Callable[[dict], None]
+
+def _rejection_reason(leftover: Optional[int], min_tail_stop: int) -> str:
+    """嘗試失敗原因：leftover = 補強後仍剩太多牌；tail = 尾局排不成敏感局；backtrack = 逐局引擎回溯用盡。"""
+    if GENERATION_ENGINE == 'constructive':
+        return 'backtrack'
+    if leftover is None:
+        return 'incomplete'
+    return 'leftover' if leftover >= min_tail_stop else 'tail'
+
+def generate_all_sensitive_shoe_or_retry(*, max_attempts: int, min_tail_stop: int, multi_pass_min_cards: int, deadline_ms: Optional[float] = None, progress: Optional[ProgressCallback] = None) -> Tuple[List[Round], List[Card], List[Card]]:
+    """外層重試直到整靴（shoe_size() 張）皆敏感。回傳：(敏感局、尾局牌（可能空）、完整牌靴)。
+    指定 deadline_ms 時，預算用盡即拋出帶最佳部分結果的 GenerationDeadline；除了嘗試之間，
+    嘗試內的精確打包、補強與逐局建構迴圈也會檢查，單次嘗試不會拖過預算。
+    progress 每次嘗試後收到 {type, attempt, ok, ms, elapsed_ms, reason, leftover}。"""
+    global LAST_GEN_SEED, LAST_GEN_ATTEMPT
+    # 基準種子：指定 SEED 時固定，否則取一次時間熵；每次嘗試以 (基準種子, attempt) 定址
+    seed = setting('SEED')
+    base_seed = seed if seed is not None else time.time_ns()
+    stream = _permutation_stream(base_seed)
+    started = time.perf_counter()
+    deadline = started + deadline_ms / 1000 if deadline_ms is not None else None
+    best: List[Tuple[List[Round], List[Card], List[Card]]] = []
+    last_leftover: List[int] = []
+
+    def on_partial(rounds: List[Round], leftover: List[Card], deck: List[Card]) -> None:
+        last_leftover[:] = [len(leftover)]
+        if deadline_ms is not None and (not best or len(leftover) < len(best[0][1])):
+            best[:] = [(list(rounds), list(leftover), deck)]
+
+    track = deadline_ms is not None or progress is not None
+    for attempt in range(1, max_attempts + 1):
+        if deadline_ms is not None and attempt > 1:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if elapsed_ms >= deadline_ms:
+                raise GenerationDeadline(*(best[0] if best else ([], [], [])), attempts=attempt - 1, elapsed_ms=elapsed_ms)
+        attempt_started = time.perf_counter()
+        last_leftover.clear()
+        try:
+            built = _generation_attempt(base_seed, attempt, stream, min_tail_stop=min_tail_stop, multi_pass_min_cards=multi_pass_min_cards, on_partial=on_partial if track else None, deadline=deadline)
+        except _AttemptDeadline:
+            raise GenerationDeadline(*(best[0] if best else ([], [], [])), attempts=attempt,
+                                     elapsed_ms=(time.perf_counter() - started) * 1000) from None
+        if progress is not None:
+            now = time.perf_counter()
+            leftover = last_leftover[0] if last_leftover else None
+            progress({
+                "type": "attempt", "attempt": attempt, "ok": built is not None,
+                "ms": round((now - attempt_started) * 1000, 1),
+                "elapsed_ms": round((now - started) * 1000, 1),
+                "reason": None if built is not None else _rejection_reason(leftover, min_tail_stop),
+                "leftover": leftover,
+            })
+        if built is not None:
+            LAST_GEN_SEED, LAST_GEN_ATTEMPT = base_seed, attempt
+            _GEN_LOCAL.key = {'seed': base_seed, 'attempt': attempt, 'config_hash': generation_config_hash()}
+            return built
     raise RuntimeError(f"重試 {max_attempts} 次仍無法全敏感；請提高 MAX_ATTEMPTS 或調整參數。")
 
+# =========================
+# 種子重建
+# =========================
+
+def generation_config_hash() -> str:
+    """影響生成結果的 CONFIG 摘要；(種子, 嘗試序號) 只在雜湊相同時才能重建出同一副牌靴。"""
+    fields = (
+        setting('NUM_DECKS'), setting('SIGNAL_SUIT'), setting('TIE_SIGNAL_SUIT'), HEART_SIGNAL_ENABLED, setting('LATE_BALANCE_DIFF'),
+        COLOR_RULE_ENABLED, A_PASSWORD_SUIT, A_PASSWORD_COUNT, B_PASSWORD_SUIT, B_PASSWORD_COUNT,
+        tuple(MANUAL_TAIL), setting('MIN_TAIL_STOP'), setting('MULTI_PASS_MIN_CARDS'), EXACT_PACK_ENABLED, EXACT_PACK_NODE_BUDGET,
+        GENERATION_ENGINE, CONSTRUCT_FINISH_CARDS, CONSTRUCT_MAX_DRAWS, CONSTRUCT_BACKTRACK_ROUNDS,
+        CONSTRUCT_MAX_BACKTRACKS, 'philox' if _permutation_stream(0) is not None else 'python',
+    )
+    return hashlib.sha1(repr(fields).encode('utf-8')).hexdigest()[:16]
+
+def last_generation_key() -> Optional[dict]:
+    """本執行緒最近一次成功生成的 {seed, attempt, config_hash}（設定雜湊取自生成當下）；尚未生成時回傳 None。"""
+    return getattr(_GEN_LOCAL, 'key', None)
+
+def regenerate_shoe(seed: int, attempt: int, *, config_hash: Optional[str] = None, apply_rules: bool = True) -> Tuple[List[Round], List[Card], List[Card]]:
+    """只重跑成功的那次嘗試（不重跑之前失敗的嘗試），並在同一條亂數流上套用規則。
+    config_hash 與目前設定不符、或該嘗試無法重現時拋出 ValueError。"""
+    if config_hash is not None and config_hash != generation_config_hash():
+        raise ValueError("設定雜湊不符：目前 CONFIG 與生成時不同，無法重建")
+    built = _generation_attempt(seed, attempt, _permutation_stream(seed), min_tail_stop=setting('MIN_TAIL_STOP'), multi_pass_min_cards=setting('MULTI_PASS_MIN_CARDS'))
+    if built is None:
+        raise ValueError(f"種子 {seed} 第 {attempt} 次嘗試無法重建全敏感牌靴")
+    rounds, tail, deck = built
+    if apply_rules:
+        rounds, tail = apply_shoe_rules(rounds, tail)
+    return rounds, tail, deck
+
+# =========================
+# 自動調參（依訊號設定挑選最快的生成參數）
+# =========================
+# 搜尋空間；LATE_BALANCE_DIFF 是輸出規格（非訊號花色最大差），只允許收緊、不得放寬
+TUNABLE_PARAMS: Dict[str, Tuple[int, ...]] = {
+    'MIN_TAIL_STOP': (5, 6, 7, 8, 9, 10),
+    'MULTI_PASS_MIN_CARDS': (4, 5, 6, 8),
+    'LATE_BALANCE_DIFF': tuple(range(1, LATE_BALANCE_DIFF + 1)),
+}
+_TUNING_DEFAULTS: Dict[str, int] = {name: globals()[name] for name in TUNABLE_PARAMS}
+_TUNING_CACHE: Dict[str, object] = {'path': None, 'mtime': None, 'entries': {}}
+
+def _tuning_key(signal_suit: str, tie_suit: Optional[str]) -> str:
+    return f"{signal_suit}|{tie_suit or ''}"
+
+def load_tuning(path: Optional[str] = None) -> Dict[str, dict]:
+    """讀取調參檔（依修改時間快取）；不存在或格式錯誤時回傳空 dict。"""
+    path = path or TUNING_PATH
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    if _TUNING_CACHE['path'] != path or _TUNING_CACHE['mtime'] != mtime:
+        try:
+            with open(path, encoding='utf-8') as f:
+                entries = json.load(f).get('entries', {})
+        except (OSError, ValueError, AttributeError):
+            entries = {}
+        _TUNING_CACHE.update(path=path, mtime=mtime, entries=entries)
+    return _TUNING_CACHE['entries']  # type: ignore[return-value]
+
+def tuned_params(signal_suit: str, tie_suit: Optional[str], *, path: Optional[str] = None) -> Dict[str, int]:
+    """(訊號花色, 和局花色) 對應的參數（未調過的用預設值）；LATE_BALANCE_DIFF 不會大於原始預設。"""
+    entry = load_tuning(path).get(_tuning_key(signal_suit, tie_suit)) or {}
+    params = dict(_TUNING_DEFAULTS)
+    for name, value in (entry.get('params') or {}).items():
+        if name in params and isinstance(value, int):
+            params[name] = value
+    params['LATE_BALANCE_DIFF'] = min(params['LATE_BALANCE_DIFF'], _TUNING_DEFAULTS['LATE_BALANCE_DIFF'])
+    return params
+
+def apply_tuning(signal_suit: Optional[str] = None, tie_suit: Optional[str] = None, *, path: Optional[str] = None) -> Dict[str, int]:
+    """把 tuned_params 的結果寫回模組 CONFIG 並回傳；預設取目前的 SIGNAL_SUIT / TIE_SIGNAL_SUIT。
+    只給命令列啟動時用；同時處理多個請求的伺服器改用 generation_settings(settings_for(...))。"""
+    if signal_suit is None:
+        signal_suit, tie_suit = SIGNAL_SUIT, TIE_SIGNAL_SUIT
+    params = tuned_params(signal_suit, tie_suit, path=path)
+    globals().update(params)
+    return params
+
+def _tuning_trial(params: Dict[str, int], seed: int, *, attempt_cap: int, rule_retries: int) -> Tuple[bool, float]:
+    """以固定種子跑一副牌（生成 + 規則套用），回傳 (是否成功, 秒數)；嘗試或規則重試超過上限視為失敗。
+    params 只在本執行緒的 generation_settings 區塊內生效。"""
+    started = time.perf_counter()
+    for retry in range(rule_retries):
+        with generation_settings({**params, 'SEED': seed + retry * 2**32}):
+            try:
+                rounds, tail, _ = generate_all_sensitive_shoe_or_retry(
+                    max_attempts=attempt_cap, min_tail_stop=params['MIN_TAIL_STOP'],
+                    multi_pass_min_cards=params['MULTI_PASS_MIN_CARDS'])
+            except RuntimeError:
+                break
+            try:
+                apply_shoe_rules(rounds, tail)
+            except (RuntimeError, AssertionError):
+                continue
+        return True, time.perf_counter() - started
+    return False, time.perf_counter() - started
+
+def autotune(signal_suit: str, tie_suit: Optional[str] = None, *, samples: int = 20, seed: int = 1,
+             attempt_cap: int = 200, rule_retries: int = 10, path: Optional[str] = None) -> dict:
+    """在 TUNABLE_PARAMS 的格點上以相同種子組（共同亂數）量測成功率與每秒牌靴數，
+    挑出成功率不低於預設值、且最快的一組寫進調參檔並回傳該筆紀錄。"""
+    names = list(TUNABLE_PARAMS)
+    results = []
+    with generation_settings({'SIGNAL_SUIT': signal_suit, 'TIE_SIGNAL_SUIT': tie_suit}):
+        for values in itertools.product(*(TUNABLE_PARAMS[n] for n in names)):
+            params = dict(zip(names, values))
+            trials = [_tuning_trial(params, seed + i * 2**40, attempt_cap=attempt_cap, rule_retries=rule_retries)
+                      for i in range(samples)]
+            ok = sum(1 for success, _ in trials if success)
+            total_s = sum(sec for _, sec in trials)
+            results.append({
+                'params': params,
+                'success_rate': ok / samples,
+                'shoes_per_sec': ok / total_s if total_s else 0.0,
+            })
+            print(f"[調參] {params} 成功率={ok}/{samples} 每秒={results[-1]['shoes_per_sec']:.3f}")
+    baseline = next(r for r in results if r['params'] == _TUNING_DEFAULTS)
+    eligible = [r for r in results if r['success_rate'] >= baseline['success_rate']]
+    best = max(eligible, key=lambda r: (r['shoes_per_sec'], r['params'] == _TUNING_DEFAULTS))
+    entry = {
+        **best, 'baseline': baseline, 'samples': samples, 'seed': seed,
+        'attempt_cap': attempt_cap, 'tuned_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    path = path or TUNING_PATH
+    try:
+        with open(path, encoding='utf-8') as f:
+            doc = json.load(f)
+    except (OSError, ValueError):
+        doc = {}
+    doc.setdefault('entries', {})[_tuning_key(signal_suit, tie_suit)] = entry
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(doc, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+    return entry
+
 # =========================
 # 輸出
 # =========================
@@ -791,7 +1472,127 @@ def simulate_all_cuts(deck: List[Card], marked_start_pos: set[int], *, use_b_ord
     return rows, avg_hit, avg_rounds
 
 
-def export_rounds(shoes: List[ShoeResult], ts: str) -> str:
+# =========================
+# 批次切牌統計（NumPy，多靴 × 全部切點一次算完）
+# =========================
+
+@dataclass
+class CutBatchStats:
+    """simulate_all_cuts_batch 的結果；陣列形狀皆為 (鞋數, 張數)，未命中處為 -1。"""
+    hit_at: 'np.ndarray'
+    hit_pos: 'np.ndarray'
+    rounds_before: 'np.ndarray'
+    avg_hit: 'np.ndarray'       # (鞋數,)，只計命中的切點
+    avg_rounds: 'np.ndarray'    # (鞋數,)
+    summary: Dict[str, object]  # 全部鞋的分布：平均、百分位數、直方圖
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("批次切牌統計需要 numpy；請先 pip install numpy")
+
+def batch_cut_inputs(shoes: List[Tuple[List[Round], List[Card]]]) -> Tuple['np.ndarray', 'np.ndarray', 'np.ndarray', List[List[Card]]]:
+    """把多副 (rounds, tail) 轉成 B 順序的點數 / 標記 / pos 矩陣，標記規則同 API（各局與尾局首張）。
+    另回傳每副的 B 順序牌序，供 cut_batch_rows 組出命中牌面。"""
+    _require_numpy()
+    seqs: List[List[Card]] = []
+    for rounds, tail in shoes:
+        seqs.append([c for r in sorted(rounds, key=lambda x: x.start_index) for c in r.cards] + list(tail or []))
+    if len({len(s) for s in seqs}) > 1:
+        raise ValueError("批次切牌統計需要每副牌張數相同")
+    points = np.array([[c.point() for c in seq] for seq in seqs], dtype=np.int8)
+    pos = np.array([[c.pos for c in seq] for seq in seqs], dtype=np.int32)
+    marked = np.zeros(points.shape, dtype=bool)
+    for n, (rounds, tail) in enumerate(shoes):
+        starts = {r.cards[0].pos for r in rounds}
+        if tail:
+            starts.add(tail[0].pos)
+        marked[n] = np.isin(pos[n], list(starts))
+    return points, marked, pos, seqs
+
+def _round_lengths_batch(points: 'np.ndarray') -> 'np.ndarray':
+    """以環狀序列計算每個起點的一局張數（4/5/6），規則同 Simulator.simulate_round。"""
+    p1, b1, p2, b2, c5 = (np.roll(points, -k, axis=1).astype(np.int16) for k in range(5))
+    p_tot = (p1 + p2) % 10
+    b_tot = (b1 + b2) % 10
+    natural = (p_tot >= 8) | (b_tot >= 8)
+    p_draw = ~natural & (p_tot <= 5)
+    p3 = c5
+    banker_after_p3 = (
+        (b_tot <= 2)
+        | ((b_tot == 3) & (p3 != 8))
+        | ((b_tot == 4) & (p3 >= 2) & (p3 <= 7))
+        | ((b_tot == 5) & (p3 >= 4) & (p3 <= 7))
+        | ((b_tot == 6) & ((p3 == 6) | (p3 == 7)))
+    )
+    b_draw = ~natural & np.where(p_draw, banker_after_p3, b_tot <= 5)
+    return (4 + p_draw.astype(np.int16) + b_draw.astype(np.int16)).astype(np.int16)
+
+def simulate_all_cuts_batch(points: 'np.ndarray', marked: 'np.ndarray', pos: Optional['np.ndarray'] = None, *, bins: int = 20) -> CutBatchStats:
+    """對每副牌、每個切點同時執行 first_hit_after_single_cut 的發牌邏輯。
+    points / marked / pos 形狀為 (鞋數, 張數)；pos 省略時以序列索引代替。"""
+    _require_numpy()
+    points = np.asarray(points)
+    marked = np.asarray(marked, dtype=bool)
+    n_shoes, length = points.shape
+    if pos is None:
+        pos = np.broadcast_to(np.arange(length), points.shape)
+    lengths = _round_lengths_batch(points)
+    rows = np.arange(n_shoes)[:, None]
+    cur = np.broadcast_to(np.arange(length), points.shape).copy()  # 目前局首張在 seq 中的索引
+    dealt = np.zeros(points.shape, dtype=np.int32)
+    rounds_before = np.zeros(points.shape, dtype=np.int32)
+    hit_at = np.full(points.shape, -1, dtype=np.int32)
+    hit_pos = np.full(points.shape, -1, dtype=np.int32)
+    active = np.ones(points.shape, dtype=bool)
+    while active.any():
+        # 剩不到 4 張：未命中
+        active &= dealt < length - 3
+        hit = active & marked[rows, cur]
+        hit_at[hit] = dealt[hit] + 1
+        hit_pos[hit] = np.broadcast_to(pos, points.shape)[rows, cur][hit]
+        active &= ~hit
+        k = lengths[rows, cur]
+        # 這局需要的牌超過剩餘張數：未命中
+        active &= dealt + k <= length
+        dealt = np.where(active, dealt + k, dealt)
+        rounds_before = np.where(active, rounds_before + 1, rounds_before)
+        cur = np.where(active, (cur + k) % length, cur)
+    hits = hit_at > 0
+    hit_cnt = hits.sum(axis=1)
+    denom = np.maximum(hit_cnt, 1)
+    avg_hit = np.where(hits, hit_at, 0).sum(axis=1) / denom
+    avg_rounds = np.where(hits, rounds_before, 0).sum(axis=1) / denom
+    hit_vals = hit_at[hits]
+    round_vals = rounds_before[hits]
+    pcts = (5, 25, 50, 75, 95)
+    summary: Dict[str, object] = {
+        'shoes': int(n_shoes),
+        'cuts': int(n_shoes * length),
+        'hit_rate': float(hits.mean()) if hits.size else 0.0,
+        'avg_hit_mean': float(avg_hit.mean()) if n_shoes else 0.0,
+        'avg_rounds_mean': float(avg_rounds.mean()) if n_shoes else 0.0,
+    }
+    for name, vals in (('hit_at', hit_vals), ('rounds_before', round_vals)):
+        if vals.size:
+            summary[f'{name}_mean'] = float(vals.mean())
+            summary[f'{name}_percentiles'] = {p: float(v) for p, v in zip(pcts, np.percentile(vals, pcts))}
+            counts, edges = np.histogram(vals, bins=bins)
+            summary[f'{name}_histogram'] = {'counts': counts.tolist(), 'edges': edges.tolist()}
+    return CutBatchStats(hit_at, hit_pos, rounds_before, avg_hit, avg_rounds, summary)
+
+def cut_batch_rows(stats: CutBatchStats, shoe: int, seq: List[Card]) -> List[Tuple[int, int, int, str, int]]:
+    """把批次結果中第 shoe 副牌轉回 simulate_all_cuts 的 rows 格式。"""
+    by_pos = {c.pos: c for c in seq}
+    rows: List[Tuple[int, int, int, str, int]] = []
+    for cut_start in range(stats.hit_at.shape[1]):
+        hit_at = int(stats.hit_at[shoe, cut_start])
+        hit_pos = int(stats.hit_pos[shoe, cut_start])
+        card = by_pos[hit_pos].short() if hit_at != -1 else ''
+        rows.append((cut_start + 1, hit_at, hit_pos, card, int(stats.rounds_before[shoe, cut_start])))
+    return rows
+
+
+def export_rounds(shoes: List[ShoeResult], ts: str, *, out_dir: str = '.') -> str:
     headers = ['起始', '張數', '結果', '敏感', '信花', '莊點', '閒點', '牌序', '顏色序']
     blocks: List[List[List[str]]] = []
 
@@ -800,7 +1601,7 @@ def export_rounds(shoes: List[ShoeResult], ts: str) -> str:
         sorted_rounds = sorted(shoe.rounds, key=lambda x: x.start_index)
 
         for r in sorted_rounds:
-            signal_cnt = sum(1 for c in r.cards if c.suit == SIGNAL_SUIT)
+            signal_cnt = sum(1 for c in r.cards if c.suit == setting('SIGNAL_SUIT'))
             bpt, ppt = _seq_points(r.cards) or (None, None)
             colors = ''.join(('紅' if getattr(c, 'color', None) == 'R'
                               else '黑' if getattr(c, 'color', None) == 'B'
@@ -818,7 +1619,7 @@ def export_rounds(shoes: List[ShoeResult], ts: str) -> str:
             ])
 
         if shoe.tail:
-            signal_cnt = sum(1 for c in shoe.tail if c.suit == SIGNAL_SUIT)
+            signal_cnt = sum(1 for c in shoe.tail if c.suit == setting('SIGNAL_SUIT'))
             bpt, ppt = _seq_points(shoe.tail) or (None, None)
             colors = ''.join(('紅' if getattr(c, 'color', None) == 'R'
                               else '黑' if getattr(c, 'color', None) == 'B'
@@ -846,7 +1647,7 @@ def export_rounds(shoes: List[ShoeResult], ts: str) -> str:
 
         blocks.append(rows)
 
-    path = f"all_sensitive_B_rounds_{ts}.csv"
+    path = os.path.join(out_dir, f"all_sensitive_B_rounds_{ts}.csv")
     with open(path, 'w', newline='', encoding='utf-8-sig') as f:
         w = csv.writer(f)
         if not blocks:
@@ -875,7 +1676,7 @@ def export_rounds(shoes: List[ShoeResult], ts: str) -> str:
 
 
 
-def export_vertical(shoes: List[ShoeResult], ts: str) -> str:
+def export_vertical(shoes: List[ShoeResult], ts: str, *, out_dir: str = '.') -> str:
     headers = ['牌']
     blocks: List[List[List[str]]] = []
     for shoe in shoes:
@@ -889,7 +1690,7 @@ def export_vertical(shoes: List[ShoeResult], ts: str) -> str:
                 rows.append([c.short()])
         blocks.append(rows)
 
-    path = f"all_sensitive_vertical_{ts}.csv"
+    path = os.path.join(out_dir, f"all_sensitive_vertical_{ts}.csv")
     with open(path, 'w', newline='', encoding='utf-8-sig') as f:
         w = csv.writer(f)
         if not blocks:
@@ -919,7 +1720,7 @@ def export_vertical(shoes: List[ShoeResult], ts: str) -> str:
     return path
 
 
-def export_cut_hits(stats: List[CutSimulationResult], ts: str) -> str:
+def export_cut_hits(stats: List[CutSimulationResult], ts: str, *, out_dir: str = '.') -> str:
     headers = ['切點', '命張', '命索', '命牌', '前局']
     blocks: List[List[List[str]]] = []
     for stat in stats:
@@ -936,7 +1737,7 @@ def export_cut_hits(stats: List[CutSimulationResult], ts: str) -> str:
         rows.append(['平均', f"{stat.avg_hit:.3f}", '', '', f"{stat.avg_rounds:.3f}"])
         blocks.append(rows)
 
-    path = f"cut_hits_{ts}.csv"
+    path = os.path.join(out_dir, f"cut_hits_{ts}.csv")
     with open(path, 'w', newline='', encoding='utf-8-sig') as f:
         w = csv.writer(f)
         if not blocks:
@@ -993,8 +1794,15 @@ def first_hit_after_single_cut(deck: List[Card], marked_start_pos: set[int], cut
         rounds_before += 1
 
 
-def apply_shoe_rules(rounds: List[Round], tail: Optional[List[Card]]) -> Tuple[List[Round], Optional[List[Card]]]:
-    """Apply suit distribution and color rules to a generated shoe."""
+def rule_config() -> dict:
+    """apply_shoe_rules 讀取的設定快照（目前生效的值，見 setting）；其他執行緒帶著它套規則，不受之後的設定影響。"""
+    return {'signal_suit': setting('SIGNAL_SUIT'), 'tie_suit': setting('TIE_SIGNAL_SUIT'), 'balance_diff': setting('LATE_BALANCE_DIFF')}
+
+def apply_shoe_rules(rounds: List[Round], tail: Optional[List[Card]], *, config: Optional[dict] = None) -> Tuple[List[Round], Optional[List[Card]]]:
+    """Apply suit distribution and color rules to a generated shoe.
+    config 為 rule_config() 的快照；省略時讀目前生效的設定。"""
+    cfg = config or rule_config()
+    signal_suit, tie_suit, balance_diff = cfg['signal_suit'], cfg['tie_suit'], cfg['balance_diff']
     views: List[RoundView] = [RoundView(cards=r.cards, result=r.result) for r in sorted(rounds, key=lambda x: x.start_index)]
     tail_idx: Optional[int] = None
     banker_aliases = {'莊', 'Banker', 'B'}
@@ -1011,42 +1819,721 @@ def apply_shoe_rules(rounds: List[Round], tail: Optional[List[Card]]) -> Tuple[L
             if isinstance(first_res, str) and first_res.strip() in banker_aliases and tail_idx not in s_idx:
                 s_idx.append(tail_idx)
         try:
-            signal_locked = enforce_suit_distribution(views, SIGNAL_SUIT, s_idx)
+            signal_locked = enforce_suit_distribution(views, signal_suit, s_idx)
         except RuntimeError:
-            signal_locked = _ensure_signal_presence(views, SIGNAL_SUIT, s_idx)
+            signal_locked = _ensure_signal_presence(views, signal_suit, s_idx)
         locked_ids.update(signal_locked)
-    if TIE_SIGNAL_SUIT:
-        tie_locked = enforce_tie_signal(views, TIE_SIGNAL_SUIT)
+    if tie_suit:
+        tie_locked = enforce_tie_signal(views, tie_suit)
         locked_ids.update(tie_locked)
-        balance_non_tie_suits(views, TIE_SIGNAL_SUIT, locked_ids, LATE_BALANCE_DIFF)
+        balance_non_tie_suits(views, tie_suit, locked_ids, balance_diff)
     balanced = late_balance(
         views,
         locked_ids,
-        LATE_BALANCE_DIFF,
-        SIGNAL_SUIT if HEART_SIGNAL_ENABLED else None,
-        TIE_SIGNAL_SUIT
+        balance_diff,
+        signal_suit if HEART_SIGNAL_ENABLED else None,
+        tie_suit
     )
     if not balanced:
         raise RuntimeError("Late suit balance failed")
     if COLOR_RULE_ENABLED:
         _apply_color_rule_for_shoe(views, tail)
-    if TIE_SIGNAL_SUIT:
-        validate_tie_signal(views, TIE_SIGNAL_SUIT)
+    if tie_suit:
+        validate_tie_signal(views, tie_suit)
     if HEART_SIGNAL_ENABLED and s_idx:
         # 驗證：每個 S_idx 局至少含一張訊號花色，否則視為失敗
         missing = [
             idx for idx in s_idx
-            if not any(card.suit == SIGNAL_SUIT for card in views[idx].cards)
+            if not any(card.suit == signal_suit for card in views[idx].cards)
         ]
         if missing:
             raise RuntimeError(f"Signal suit missing in S_idx rounds: {missing}")
     return rounds, tail
 
+def copy_shoe(rounds: List[Round], tail: Optional[List[Card]], deck: List[Card]) -> Tuple[List[Round], List[Card], List[Card]]:
+    """逐張複製牌靴，同一張牌（pos）在 rounds / tail / deck 中對應同一個副本。
+    apply_shoe_rules 會就地改花色與顏色，失敗時要保留原牌就先在副本上套用。"""
+    copies = {c.pos: Card(c.rank, c.suit, c.pos, c.color) for c in deck}
+    return ([Round(r.start_index, [copies[c.pos] for c in r.cards], r.result, r.sensitive) for r in rounds],
+            [copies[c.pos] for c in (tail or [])], [copies[c.pos] for c in deck])
+
+@dataclass
+class RuledShoe:
+    """generate_ruled_shoe 的結果。partial=True 表示時間預算用盡，coverage 為敏感局張數比例；
+    rules_error 不為 None 時規則沒有套用成功，牌面為原始花色。完整結果帶 gen_key（種子重建用）。"""
+    rounds: List[Round]
+    tail: List[Card]
+    deck: List[Card]
+    elapsed_ms: float
+    partial: bool = False
+    coverage: float = 1.0
+    attempts: int = 0
+    rules_error: Optional[str] = None
+    gen_key: Optional[dict] = None
+
+def generate_ruled_shoe(*, deadline_ms: Optional[float] = None, progress: Optional[ProgressCallback] = None) -> RuledShoe:
+    """生成全敏感牌靴並套用規則；規則失敗就重新生成，最多 MAX_RULE_RETRY 次，生成與規則重試共用 deadline_ms 預算。
+    規則一律在副本上套用，失敗時原牌花色不變。預算用盡時回傳 partial 結果：生成中用盡取 GenerationDeadline
+    的最佳部分結果（規則套不上就保留原花色）；規則重試中用盡取最近一副全敏感、但規則未套用的牌。
+    連部分結果都沒有時拋出 GenerationDeadline，規則重試用盡拋出 RuntimeError。
+    progress 除了生成的 attempt 事件，還會收到 rule_retry 與 generate / rules 的 phase 耗時事件。"""
+    def emit_phase(phase: str, since: float) -> float:
+        now = time.perf_counter()
+        if progress is not None:
+            progress({'type': 'phase', 'phase': phase, 'ms': round((now - since) * 1000, 1)})
+        return now
+
+    started = time.perf_counter()
+    last_error: Optional[BaseException] = None
+    unruled: Optional[Tuple[List[Round], List[Card], List[Card]]] = None  # 最近一副規則套用失敗的牌（原花色）
+    for retry in range(MAX_RULE_RETRY):
+        if retry and progress is not None:
+            progress({'type': 'rule_retry', 'retry': retry, 'reason': str(last_error)})
+        remaining = None
+        if deadline_ms is not None:
+            remaining = deadline_ms - (time.perf_counter() - started) * 1000
+            if retry and remaining <= 0:
+                rounds, tail, deck = unruled
+                return RuledShoe(rounds, tail, deck, (time.perf_counter() - started) * 1000, partial=True,
+                                 attempts=retry, rules_error=str(last_error))
+        phase_started = time.perf_counter()
+        try:
+            rounds, tail, deck = generate_all_sensitive_shoe_or_retry(
+                max_attempts=MAX_ATTEMPTS, min_tail_stop=setting('MIN_TAIL_STOP'),
+                multi_pass_min_cards=setting('MULTI_PASS_MIN_CARDS'), deadline_ms=remaining, progress=progress)
+        except GenerationDeadline as exc:
+            if not exc.deck:
+                raise
+            rule_rounds, rule_tail, rule_deck = copy_shoe(exc.rounds, exc.leftover, exc.deck)
+            try:
+                rule_rounds, rule_tail = apply_shoe_rules(rule_rounds, rule_tail)
+            except (RuntimeError, AssertionError) as rule_exc:
+                return RuledShoe(exc.rounds, exc.leftover, exc.deck, exc.elapsed_ms, partial=True,
+                                 coverage=exc.coverage, attempts=exc.attempts, rules_error=str(rule_exc))
+            return RuledShoe(rule_rounds, rule_tail, rule_deck, exc.elapsed_ms, partial=True,
+                             coverage=exc.coverage, attempts=exc.attempts)
+        gen_key = last_generation_key()
+        phase_started = emit_phase('generate', phase_started)
+        rule_rounds, rule_tail, rule_deck = copy_shoe(rounds, tail, deck)
+        try:
+            rule_rounds, rule_tail = apply_shoe_rules(rule_rounds, rule_tail)
+        except (RuntimeError, AssertionError) as exc:
+            # enforce_suit_distribution 以 assert 回報配額失敗，視同規則套用失敗
+            last_error = exc
+            unruled = (rounds, tail, deck)
+            continue
+        emit_phase('rules', phase_started)
+        return RuledShoe(rule_rounds, rule_tail, rule_deck, (time.perf_counter() - started) * 1000, gen_key=gen_key)
+    raise RuntimeError(str(last_error) if last_error else 'unknown')
+
+# =========================
+# 掃描索引：(莊點, 閒點, 用張) -> 局位置
+# =========================
+ScanKey = Tuple[int, int, int]
+
+def build_scan_index(rounds: List[Round], tail: Optional[List[Card]]) -> Dict[ScanKey, List[int]]:
+    """依 B 順序（尾局最後）建立掃描索引，值為局的序號（0 起算）。
+    用張 0 代表不限張數，因此每局同時登記在 (莊, 閒, 張數) 與 (莊, 閒, 0)。
+    """
+    seqs = [r.cards for r in sorted(rounds, key=lambda x: x.start_index)]
+    if tail:
+        seqs.append(tail)
+    index: Dict[ScanKey, List[int]] = collections.defaultdict(list)
+    for i, cards in enumerate(seqs):
+        pts = _seq_points(cards)
+        if pts is None:
+            continue
+        bpt, ppt = pts
+        index[(bpt, ppt, len(cards))].append(i)
+        index[(bpt, ppt, 0)].append(i)
+    return dict(index)
+
+# =========================
+# 緊湊編碼（牌靴 <-> bytes）
+# =========================
+# 格式：表頭 <版本, 牌靴張數, 局數, 尾局張數>，接著
+#   1) 牌靴每張 1 byte：低 6 bit = 點牌索引*4 + 花色索引，高 2 bit = 顏色（0 無 / 1 紅 / 2 黑）
+#   2) 每局 1 byte：張數，最高位 = 敏感旗標
+#   3) 每局的 start_index，uint16（版本 2 起；版本 1 以首張 pos 代替）
+#   4) B 順序（各局依序 + 尾局）每張牌在牌靴中的 pos，uint16
+_SHOE_CODEC_VERSION = 2
+_SHOE_HEADER = struct.Struct('<BHHH')
+_COLOR_TO_CODE = {'R': 1, 'B': 2}
+_CODE_TO_COLOR = {0: None, 1: 'R', 2: 'B'}
+
+def encode_shoe(rounds: List[Round], tail: Optional[List[Card]], deck: List[Card]) -> bytes:
+    """把套用規則後的牌靴壓成 bytes（保留花色、顏色與 B 順序局界）。"""
+    ordered = sorted(rounds, key=lambda x: x.start_index)
+    tail = tail or []
+    pos_to_idx = {c.pos: i for i, c in enumerate(deck)}
+    seq = [c for r in ordered for c in r.cards] + list(tail)
+    out = bytearray(_SHOE_HEADER.pack(_SHOE_CODEC_VERSION, len(deck), len(ordered), len(tail)))
+    out += bytes(
+        (RANKS.index(c.rank) * 4 + SUITS.index(c.suit)) | (_COLOR_TO_CODE.get(c.color, 0) << 6)
+        for c in deck
+    )
+    out += bytes(len(r.cards) | (0x80 if r.sensitive else 0) for r in ordered)
+    out += struct.pack(f'<{len(ordered)}H', *(r.start_index for r in ordered))
+    out += struct.pack(f'<{len(seq)}H', *(pos_to_idx[c.pos] for c in seq))
+    return bytes(out)
+
+def decode_shoe(blob: bytes) -> Tuple[List[Round], List[Card], List[Card]]:
+    """encode_shoe 的反向操作，回傳 (敏感局、尾局、牌靴)；局與尾局共用牌靴中的 Card 物件。"""
+    version, n_deck, n_rounds, n_tail = _SHOE_HEADER.unpack_from(blob, 0)
+    if version not in (1, _SHOE_CODEC_VERSION):
+        raise ValueError(f"不支援的牌靴編碼版本：{version}")
+    off = _SHOE_HEADER.size
+    deck: List[Card] = []
+    for i, b in enumerate(blob[off:off + n_deck]):
+        code = b & 0x3F
+        deck.append(Card(RANKS[code // 4], SUITS[code % 4], i, _CODE_TO_COLOR[b >> 6]))
+    off += n_deck
+    sizes = blob[off:off + n_rounds]
+    off += n_rounds
+    starts: Optional[Tuple[int, ...]] = None
+    if version >= 2:
+        starts = struct.unpack_from(f'<{n_rounds}H', blob, off)
+        off += 2 * n_rounds
+    n_seq = sum(s & 0x7F for s in sizes) + n_tail
+    seq = [deck[i] for i in struct.unpack_from(f'<{n_seq}H', blob, off)]
+    rounds: List[Round] = []
+    i = 0
+    for n, s in enumerate(sizes):
+        k = s & 0x7F
+        cards = seq[i:i + k]
+        start = starts[n] if starts is not None else cards[0].pos
+        rounds.append(Round(start, cards, _seq_result(cards) or '', bool(s & 0x80)))
+        i += k
+    return rounds, seq[i:], deck
+
+# =========================
+# 多候選生成（切牌穩健度排序）
+# =========================
+# 各目標的排序鍵（越小越好）；分數欄位見 score_shoe_cuts
+CANDIDATE_OBJECTIVES: Dict[str, Callable[[dict], float]] = {
+    'min_avg_hit': lambda s: s['avg_hit'],          # 切牌後平均幾張內遇到敏感局
+    'min_avg_rounds': lambda s: s['avg_rounds'],    # 切牌後平均幾局內遇到敏感局
+    'min_p95_hit': lambda s: s['p95_hit'],          # 最差 5% 切點的命中張數
+    'max_hit_rate': lambda s: -s['hit_rate'],       # 有命中的切點比例
+}
+_CANDIDATE_EXECUTOR = None
+
+def _candidate_job(spec: dict) -> Optional[dict]:
+    """產生單一候選牌靴（生成 + 規則）；設定全部由 spec 帶入（settings 為 settings_for / current_settings 的結果），
+    只在本執行緒的 generation_settings 區塊內生效。
+    回傳 {blob, seed, attempt, config_hash}，時間預算或規則重試用盡時回傳 None。"""
+    warm_pattern_tables()  # spawn 出來的行程第一次執行時從落地快取讀表
+    started = time.perf_counter()
+    for retry in range(spec.get('rule_retries', 10)):
+        remaining = None
+        if spec.get('deadline_ms') is not None:
+            remaining = spec['deadline_ms'] - (time.perf_counter() - started) * 1000
+            if retry and remaining <= 0:
+                return None
+        with generation_settings({**spec['settings'], 'SEED': spec['seed'] + retry * 2**32}):
+            try:
+                rounds, tail, deck = generate_all_sensitive_shoe_or_retry(
+                    max_attempts=MAX_ATTEMPTS, min_tail_stop=setting('MIN_TAIL_STOP'),
+                    multi_pass_min_cards=setting('MULTI_PASS_MIN_CARDS'), deadline_ms=remaining)
+            except GenerationDeadline:
+                return None
+            try:
+                rounds, tail = apply_shoe_rules(rounds, tail)
+            except RuntimeError:
+                continue
+        return {'blob': encode_shoe(rounds, tail, deck), **last_generation_key()}
+    return None
+
+def _p95(hits) -> float:
+    """命中張數的第 95 百分位，取最近秩（排序後第 round(0.95·(n-1)) 個，必為實際出現的值）；
+    numpy 與逐副兩條計分路徑共用，分數不因環境而異。沒有命中時回傳 0。"""
+    ordered = sorted(hits)
+    if not ordered:
+        return 0.0
+    return float(ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))])
+
+def score_shoe_cuts(shoes: List[Tuple[List[Round], List[Card], List[Card]]]) -> List[dict]:
+    """對多副牌做全切點分析，回傳每副的 {avg_hit, avg_rounds, p95_hit, hit_rate}（p95_hit 見 _p95）。
+    有 numpy 時一次批次計算，否則逐副 simulate_all_cuts。"""
+    if not shoes:
+        return []
+    if np is not None and len({len(deck) for _, _, deck in shoes}) == 1:
+        points, marked, pos, _ = batch_cut_inputs([(r, t) for r, t, _ in shoes])
+        stats = simulate_all_cuts_batch(points, marked, pos)
+        out = []
+        for n in range(len(shoes)):
+            hits = stats.hit_at[n][stats.hit_at[n] > 0]
+            out.append({
+                'avg_hit': float(stats.avg_hit[n]), 'avg_rounds': float(stats.avg_rounds[n]),
+                'p95_hit': _p95(hits.tolist()),
+                'hit_rate': float(hits.size / stats.hit_at.shape[1]),
+            })
+        return out
+    out = []
+    for rounds, tail, deck in shoes:
+        marked = {r.cards[0].pos for r in rounds}
+        if tail:
+            marked.add(tail[0].pos)
+        rows, avg_hit, avg_rounds = simulate_all_cuts(deck, marked, use_b_order=True, rounds=rounds, tail=tail)
+        hits = [row[1] for row in rows if row[1] != -1]
+        out.append({
+            'avg_hit': avg_hit, 'avg_rounds': avg_rounds,
+            'p95_hit': _p95(hits),
+            'hit_rate': len(hits) / len(rows) if rows else 0.0,
+        })
+    return out
+
+def _candidate_executor():
+    """多候選生成共用的行程池（延遲建立）；用 spawn 避免在多執行緒的伺服器行程中 fork。"""
+    global _CANDIDATE_EXECUTOR
+    if _CANDIDATE_EXECUTOR is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _CANDIDATE_EXECUTOR = ProcessPoolExecutor(
+            max_workers=CANDIDATE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _CANDIDATE_EXECUTOR
+
+def generate_parallel_shoes(k: int, *, deadline_ms: Optional[float] = None,
+                            signal_suit: Optional[str] = None, tie_suit: Optional[str] = None,
+                            num_decks: Optional[int] = None, executor=None) -> List[Tuple[int, dict, Tuple[List[Round], List[Card], List[Card]]]]:
+    """以一批平行工作產生 k 副互不相同的牌靴（各用不同種子），回傳成功者的
+    [(序號, {seed, attempt, config_hash}, (rounds, tail, deck))]，依序號排列；失敗的不列入。
+    signal_suit 省略時沿用目前生效的設定（current_settings），否則依該花色組合取調參結果（settings_for）；
+    num_decks 省略時沿用目前生效的副數。
+    executor 省略時用共用的候選行程池（CANDIDATE_WORKERS 個行程；只有 1 個時依序產生）；
+    工作一律在其他行程執行，呼叫端的全域設定不受影響。"""
+    settings = current_settings() if signal_suit is None else settings_for(signal_suit, tie_suit)
+    if num_decks:
+        settings['NUM_DECKS'] = num_decks
+    seed = setting('SEED')
+    base_seed = seed if seed is not None else time.time_ns() % 2**48
+    specs = [{'settings': settings, 'seed': base_seed + i * 2**40, 'deadline_ms': deadline_ms} for i in range(k)]
+    if executor is None:
+        executor = _candidate_executor()
+    results = list(executor.map(_candidate_job, specs))
+    return [(i, {name: res[name] for name in ('seed', 'attempt', 'config_hash')}, decode_shoe(res['blob']))
+            for i, res in enumerate(results) if res is not None]
+
+def generate_ranked_candidates(k: int, *, objective: Optional[str] = None, deadline_ms: Optional[float] = None,
+                               signal_suit: Optional[str] = None, tie_suit: Optional[str] = None,
+                               num_decks: Optional[int] = None, executor=None) -> Tuple[Tuple[List[Round], List[Card], List[Card]], dict, List[dict]]:
+    """平行產生 k 副候選牌靴（generate_parallel_shoes），依 objective 以切牌分析排序，
+    回傳 (最佳 (rounds, tail, deck), 最佳的生成鍵, 全部分數)。
+    分數依候選序號排列，每筆含 seed / attempt / score / chosen；成功的候選為 0 時拋出 RuntimeError。"""
+    objective = objective or CANDIDATE_OBJECTIVE
+    if objective not in CANDIDATE_OBJECTIVES:
+        raise ValueError(f"未知的排序目標：{objective}（可用：{', '.join(CANDIDATE_OBJECTIVES)}）")
+    built = generate_parallel_shoes(k, deadline_ms=deadline_ms, signal_suit=signal_suit, tie_suit=tie_suit,
+                                    num_decks=num_decks, executor=executor)
+    if not built:
+        raise RuntimeError(f"{k} 副候選牌靴都未能在限制內完成")
+    key = CANDIDATE_OBJECTIVES[objective]
+    scores = []
+    for (i, res, _), score in zip(built, score_shoe_cuts([shoe for _, _, shoe in built])):
+        scores.append({'candidate': i, 'seed': res['seed'], 'attempt': res['attempt'],
+                       **{name: round(val, 4) for name, val in score.items()}, 'score': round(key(score), 4)})
+    best = min(range(len(built)), key=lambda n: scores[n]['score'])
+    for n, entry in enumerate(scores):
+        entry['chosen'] = n == best
+    _, gen_key, best_shoe = built[best]
+    return best_shoe, gen_key, scores
+
+# =========================
+# 批次模式（逐鞋落地 + 檢查點）
+# =========================
+CHECKPOINT_FILE = 'checkpoint.json'
+
+def _batch_seed(base_seed: int, shoe_idx: int, retry: int) -> int:
+    """每副牌（與其規則重試）各自的基準種子；間隔 2**32，嘗試序號不會跨到別副牌。"""
+    return base_seed + (shoe_idx * 64 + retry) * 2**32
+
+def _load_checkpoint(out_dir: str) -> Optional[dict]:
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_checkpoint(out_dir: str, state: dict) -> None:
+    """先寫暫存檔再 os.replace，中斷時不會留下寫一半的檢查點。"""
+    path = os.path.join(out_dir, CHECKPOINT_FILE)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+def generate_batch_shoe(shoe_idx: int, base_seed: int, out_dir: str, settings: dict) -> dict:
+    """產生單副牌、計算切牌統計並立即寫出三個 CSV，回傳寫進檢查點的摘要。
+    settings 為 run_batch 當下的 current_settings()（副數、花色、調參值），隨每個工作帶到子行程，
+    不依賴 fork 繼承的全域變數（spawn 時也正確）；參數都可 pickle，可直接交給子行程執行。"""
+    with generation_settings(settings):
+        return _batch_shoe(shoe_idx, base_seed, out_dir)
+
+def _batch_shoe(shoe_idx: int, base_seed: int, out_dir: str) -> dict:
+    warm_pattern_tables()
+    for retry in range(64):
+        with generation_settings({'SEED': _batch_seed(base_seed, shoe_idx, retry)}):
+            rounds, tail, deck = generate_all_sensitive_shoe_or_retry(
+                max_attempts=MAX_ATTEMPTS,
+                min_tail_stop=setting('MIN_TAIL_STOP'),
+                multi_pass_min_cards=setting('MULTI_PASS_MIN_CARDS'),
+            )
+        try:
+            rounds, tail = apply_shoe_rules(rounds, tail)
+        except RuntimeError:
+            continue
+        break
+    else:
+        raise RuntimeError(f"第 {shoe_idx} 副牌規則套用連續失敗")
+    gen_key = last_generation_key()
+    marked = {r.cards[0].pos for r in rounds}
+    if tail:
+        marked.add(tail[0].pos)
+    rows, avg_hit, avg_rounds = simulate_all_cuts(deck, marked, use_b_order=True, rounds=rounds, tail=tail)
+    shoe = ShoeResult(shoe_index=shoe_idx, rounds=rounds, tail=tail, deck=deck)
+    ts = f"shoe{shoe_idx:05d}"
+    export_rounds([shoe], ts, out_dir=out_dir)
+    export_vertical([shoe], ts, out_dir=out_dir)
+    export_cut_hits([CutSimulationResult(shoe_index=shoe_idx, rows=rows, avg_hit=avg_hit, avg_rounds=avg_rounds)], ts, out_dir=out_dir)
+    return {
+        'seed': gen_key['seed'], 'attempt': gen_key['attempt'], 'rounds': len(rounds), 'tail': len(tail),
+        'avg_hit': round(avg_hit, 4), 'avg_rounds': round(avg_rounds, 4),
+    }
+
+def run_batch(out_dir: str, num_shoes: int, *, workers: int = 1, seed: Optional[int] = None) -> dict:
+    """批次產生 num_shoes 副牌，每副完成就落地並更新檢查點；回傳最終檢查點內容。
+    out_dir 已有檢查點時接續未完成的牌靴（設定雜湊或副數不符則拒絕，避免混入不同設定的結果）。"""
+    os.makedirs(out_dir, exist_ok=True)
+    state = _load_checkpoint(out_dir)
+    config_hash = generation_config_hash()
+    if state is None:
+        state = {
+            'num_shoes': num_shoes, 'config_hash': config_hash,
+            'base_seed': seed if seed is not None else time.time_ns() % 2**48,
+            'done': {},
+        }
+        _save_checkpoint(out_dir, state)
+    elif state['config_hash'] != config_hash or state['num_shoes'] != num_shoes:
+        raise RuntimeError(f"{out_dir} 的檢查點與目前設定不符（副數或 CONFIG 不同），請改用新的輸出資料夾")
+    pending = [i for i in range(1, num_shoes + 1) if str(i) not in state['done']]
+    if len(pending) < num_shoes:
+        print(f"[接續] 已完成 {num_shoes - len(pending)} 副，剩餘 {len(pending)} 副")
+
+    def record(idx: int, summary: dict) -> None:
+        state['done'][str(idx)] = summary
+        _save_checkpoint(out_dir, state)
+        print(f"[完成] 第 {idx} 副（{len(state['done'])}/{num_shoes}）：敏感局數={summary['rounds']}，"
+              f"平均命張={summary['avg_hit']:.3f}，平均命前局={summary['avg_rounds']:.3f}")
+
+    settings = current_settings()
+    if workers <= 1:
+        for idx in pending:
+            record(idx, generate_batch_shoe(idx, state['base_seed'], out_dir, settings))
+    else:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(generate_batch_shoe, idx, state['base_seed'], out_dir, settings): idx for idx in pending}
+            for fut in as_completed(futures):
+                record(futures[fut], fut.result())
+    return state
+
+# =========================
+# 外部牌靴驗證（匯入用）
+# =========================
+# 匯入格式：每行一副牌靴的 JSON（JSON Lines），欄位：
+#   cards       版面順序的牌面，陣列或以空白 / 逗號分隔的字串（'A♠'、'10♥'，花色也可寫 S/H/D/C）
+#   colors      每張牌的顏色，字串或陣列（R/B 或 紅/黑）；COLOR_RULE_ENABLED 時必填
+#   tail        最後幾張屬於尾局（0 或省略表示沒有尾局）
+#   signal_suit / tie_suit / num_decks / id   選填，覆寫驗證時的預設值
+# 局界不必提供：逐局依補牌規則發牌即可推得，與 B 順序版面一致。
+_SUIT_ALIASES = {**{s: s for s in SUITS}, 'S': '♠', 'H': '♥', 'D': '♦', 'C': '♣'}
+_COLOR_ALIASES = {'R': 'R', 'B': 'B', 'r': 'R', 'b': 'B', '紅': 'R', '黑': 'B'}
+# 牌面字串 → (點數, 花色) 的查表（含字母花色與小寫），大量匯入時免逐張解析
+_CARD_TOKENS = {
+    f"{rank_text}{alias_text}": (rank, suit)
+    for rank in RANKS for rank_text in {rank, rank.lower()}
+    for alias, suit in _SUIT_ALIASES.items() for alias_text in {alias, alias.lower()}
+}
+_COLOR_PATTERNS = (('B', 'B', 'B', 'R'), ('R', 'R', 'R', 'B'))  # 與 _apply_color_rule_for_shoe 相同
+_COLOR_HEADS = {pat[:k] for pat in _COLOR_PATTERNS for k in range(1, 5)}  # 局不足四張時比對前綴
+VERIFY_MAX_VIOLATIONS: int = 20  # 單副牌靴最多列出的違規筆數（總數另計）
+
+class ShoeFormatError(ValueError):
+    """匯入資料的格式錯誤（牌面、顏色或欄位無法解析）。"""
+
+def parse_card(token: str) -> Tuple[str, str]:
+    """'10♥' / '10H' / 'a♠' → (點數, 花色)；無法解析時拋出 ShoeFormatError。"""
+    token = token.strip()
+    if token in _CARD_TOKENS:
+        return _CARD_TOKENS[token]
+    rank, suit = token[:-1].upper(), _SUIT_ALIASES.get(token[-1:].upper())
+    if suit is None or rank not in CARD_VALUES:
+        raise ShoeFormatError(f"無法解析的牌面：{token!r}")
+    return rank, suit
+
+def _split_field(value, name: str) -> List[str]:
+    if isinstance(value, str):
+        text = value.replace(',', ' ')
+        return text.split() if name == 'cards' or ' ' in text.strip() else list(text.strip())
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    raise ShoeFormatError(f"{name} 必須是字串或陣列")
+
+def parse_shoe_record(record: dict) -> Tuple[List[Tuple[str, str]], Optional[List[str]]]:
+    """把單副匯入紀錄轉成 ([(點數, 花色)...], 顏色或 None)。"""
+    if not isinstance(record, dict) or 'cards' not in record:
+        raise ShoeFormatError("紀錄缺少 cards 欄位")
+    table = _CARD_TOKENS
+    cards = [table.get(tok) or parse_card(tok) for tok in _split_field(record['cards'], 'cards')]
+    colors = None
+    if record.get('colors'):
+        colors = [_COLOR_ALIASES.get(tok) for tok in _split_field(record['colors'], 'colors')]
+        if None in colors:
+            bad = next(tok for tok in _split_field(record['colors'], 'colors') if tok not in _COLOR_ALIASES)
+            raise ShoeFormatError(f"無法解析的顏色：{bad!r}")
+        if len(colors) != len(cards):
+            raise ShoeFormatError(f"colors 有 {len(colors)} 個，與 {len(cards)} 張牌不符")
+    return cards, colors
+
+@functools.lru_cache(maxsize=1 << 16)
+def _deal_window(window: Tuple[int, ...]) -> Tuple[Optional[str], int, bool]:
+    """從版面某一位置起的（最多 6 張）點數發一局，回傳 (結果, 用張, 是否敏感)；牌不夠時結果為 None。"""
+    dealt = _deal_points(window)
+    if dealt is None:
+        return None, 0, False
+    res, used = dealt
+    return res, used, _is_sensitive_points(window[:used])
+
+def verify_shoe(cards: List[Tuple[str, str]], colors: Optional[List[str]] = None, *, tail_len: int = 0,
+                signal_suit: Optional[str] = None, tie_suit: Optional[str] = None,
+                num_decks: Optional[int] = None, balance_diff: Optional[int] = None) -> dict:
+    """以單次線性掃描檢查牌靴是否符合生成流程的全部規則，回傳
+    {ok, cards, rounds, signal_suit, tie_suit, violations: [{rule, round?, detail}], violation_count, sizes}。
+
+    檢查項目（對應 apply_shoe_rules 與生成條件）：
+    - coverage：張數為 num_decks × 52，且每個點數各 4 × num_decks 張
+    - incomplete / sensitive：逐局發牌，每一局（含尾局）都是 P1↔B1 交換下的敏感局
+    - tail：tail_len 與最後一局的張數相符
+    - signal：S_idx（下一局為莊的局；首局為莊時含尾局）至少有一張訊號花色
+    - tie / tie_outside：下一局為和的局全為和局花色，其餘局不得出現（validate_tie_signal）
+    - balance：排除訊號與和局花色後，各花色張數差 ≤ balance_diff
+    - color / color_quota：每局前四張為黑黑黑紅或紅紅紅黑，紅黑總數為一半 / 一半（有尾局時容許偏差尾局張數）
+    signal_suit 省略時用 SIGNAL_SUIT；tie_suit 省略表示不檢查和局花色；num_decks 省略時用 NUM_DECKS；
+    balance_diff 省略時用輸出規格的預設值（_TUNING_DEFAULTS，調參只會收緊），不受調參或其他請求的設定影響。"""
+    signal_suit = signal_suit or setting('SIGNAL_SUIT')
+    num_decks = num_decks or setting('NUM_DECKS')
+    if balance_diff is None:
+        balance_diff = _TUNING_DEFAULTS['LATE_BALANCE_DIFF']
+    check_signal = HEART_SIGNAL_ENABLED and bool(signal_suit)
+    violations: List[dict] = []
+    count = [0]
+
+    def fail(rule: str, detail: str, round_idx: Optional[int] = None) -> None:
+        count[0] += 1
+        if len(violations) < VERIFY_MAX_VIOLATIONS:
+            item = {'rule': rule, 'detail': detail}
+            if round_idx is not None:
+                item['round'] = round_idx
+            violations.append(item)
+
+    n = len(cards)
+    pts = [CARD_VALUES[rank] for rank, _ in cards]
+    rank_counts: collections.Counter = collections.Counter()
+    suit_counts: collections.Counter = collections.Counter()
+    for (rank, suit), k in collections.Counter(cards).items():
+        rank_counts[rank] += k
+        suit_counts[suit] += k
+    if n != num_decks * 52:
+        fail('coverage', f"張數 {n}，應為 {num_decks * 52}（{num_decks} 副）")
+    bad_ranks = [f"{r}:{rank_counts.get(r, 0)}" for r in RANKS if rank_counts.get(r, 0) != 4 * num_decks]
+    if bad_ranks:
+        fail('coverage', f"點數張數不符（每種應為 {4 * num_decks}）：{', '.join(bad_ranks)}")
+    if COLOR_RULE_ENABLED and colors is None:
+        fail('color', "缺少 colors（顏色規則已啟用）")
+
+    sizes: List[int] = []
+    first_res: Optional[str] = None
+    prev: Optional[Tuple[bool, bool, bool]] = None  # 前一局的 (有訊號花色, 全為和局花色, 含和局花色)
+    i = 0
+    while i < n:
+        r = len(sizes)
+        res, used, sensitive = _deal_window(tuple(pts[i:i + 6]))
+        if res is None:
+            fail('incomplete', f"剩下 {n - i} 張不足以發完一局", r)
+            break
+        if not sensitive:
+            fail('sensitive', f"{''.join(rank + suit for rank, suit in cards[i:i + used])} 不是敏感局", r)
+        suits = [suit for _, suit in cards[i:i + used]]
+        cur = (signal_suit in suits, bool(tie_suit) and all(s == tie_suit for s in suits),
+               bool(tie_suit) and tie_suit in suits)
+        if prev is not None:
+            # 本局結果決定前一局是否屬於 S_idx / 和局訊號局
+            if check_signal and res == '莊' and not prev[0]:
+                fail('signal', f"下一局為莊，但本局沒有訊號花色 {signal_suit}", r - 1)
+            if tie_suit:
+                if _is_tie_result(res) and not prev[1]:
+                    fail('tie', f"下一局為和，但本局不全是和局花色 {tie_suit}", r - 1)
+                elif not _is_tie_result(res) and prev[2]:
+                    fail('tie_outside', f"和局花色 {tie_suit} 出現在非和局訊號局", r - 1)
+        if colors is not None:
+            head = tuple(colors[i:i + min(4, used)])
+            if head not in _COLOR_HEADS:
+                fail('color', f"前四張顏色 {''.join(head)} 不是 BBBR / RRRB", r)
+        if first_res is None:
+            first_res = res
+        sizes.append(used)
+        prev = cur
+        i += used
+
+    if prev is not None:
+        last = len(sizes) - 1
+        if tie_suit and prev[2]:
+            fail('tie_outside', f"和局花色 {tie_suit} 出現在非和局訊號局", last)
+        if tail_len:
+            if sizes[-1] != tail_len:
+                fail('tail', f"尾局應為 {tail_len} 張，最後一局實際為 {sizes[-1]} 張", last)
+            elif check_signal and first_res == '莊' and not prev[0]:
+                fail('signal', f"首局為莊，但尾局沒有訊號花色 {signal_suit}", last)
+    excluded = {s for s in (signal_suit if check_signal else None, tie_suit) if s}
+    balanced = [suit_counts.get(s, 0) for s in SUITS if s not in excluded]
+    if len(balanced) >= 2 and max(balanced) - min(balanced) > balance_diff:
+        dist = ', '.join(f"{s}:{suit_counts.get(s, 0)}" for s in SUITS if s not in excluded)
+        fail('balance', f"花色差 {max(balanced) - min(balanced)} > {balance_diff}（{dist}）")
+    if colors is not None:
+        # apply_shoe_rules 上色時尾局會重複計入配額，有尾局的牌靴紅黑數最多偏差尾局張數
+        red = colors.count('R')
+        if abs(red - n // 2) > (tail_len if sizes and sizes[-1] == tail_len else 0):
+            fail('color_quota', f"紅 {red} / 黑 {n - red}，應為 {n // 2} / {n - n // 2}")
+    return {
+        'ok': not count[0], 'cards': n, 'rounds': len(sizes), 'signal_suit': signal_suit, 'tie_suit': tie_suit,
+        'violations': violations, 'violation_count': count[0], 'sizes': sizes,
+    }
+
+def verify_record(record: dict, *, signal_suit: Optional[str] = None, tie_suit: Optional[str] = None,
+                  num_decks: Optional[int] = None, balance_diff: Optional[int] = None) -> dict:
+    """驗證單筆匯入紀錄；紀錄中的 signal_suit / tie_suit / num_decks 優先於參數。格式錯誤記為 format 違規。"""
+    try:
+        cards, colors = parse_shoe_record(record)
+        signal = record.get('signal_suit') or signal_suit
+        tie = record.get('tie_suit', tie_suit)
+        out = verify_shoe(
+            cards, colors, tail_len=int(record.get('tail') or 0),
+            signal_suit=_SUIT_ALIASES.get(str(signal).upper(), signal) if signal else None,
+            tie_suit=_SUIT_ALIASES.get(str(tie).upper(), tie) if tie else None,
+            num_decks=int(record.get('num_decks') or 0) or num_decks,
+            balance_diff=balance_diff,
+        )
+    except (ShoeFormatError, ValueError, TypeError) as exc:
+        out = {'ok': False, 'cards': 0, 'rounds': 0, 'sizes': [],
+               'violations': [{'rule': 'format', 'detail': str(exc)}], 'violation_count': 1}
+    if isinstance(record, dict) and 'id' in record:
+        out['id'] = record['id']
+    return out
+
+def imported_shoe(record: dict, sizes: List[int]) -> Tuple[List[Round], List[Card], List[Card]]:
+    """把已通過驗證的紀錄組成 (rounds, tail, deck)，可直接 encode_shoe；牌靴順序即版面順序。"""
+    cards, colors = parse_shoe_record(record)
+    deck = [Card(rank, suit, pos, colors[pos] if colors else None) for pos, (rank, suit) in enumerate(cards)]
+    tail_len = int(record.get('tail') or 0)
+    rounds: List[Round] = []
+    i = 0
+    for size in sizes[:len(sizes) - 1] if tail_len else sizes:
+        seq = deck[i:i + size]
+        rounds.append(Round(i, seq, _seq_result(seq) or '', True))
+        i += size
+    return rounds, deck[i:], deck
+
+def verify_line(line, **defaults) -> Tuple[Optional[dict], dict]:
+    """驗證 JSON Lines 的一行（str 或 bytes），回傳 (紀錄, 結果)；JSON 無法解析時紀錄為 None。"""
+    try:
+        record = json.loads(line)
+    except ValueError as exc:
+        return None, {'ok': False, 'cards': 0, 'rounds': 0, 'sizes': [],
+                      'violations': [{'rule': 'format', 'detail': f"JSON 解析失敗：{exc}"}], 'violation_count': 1}
+    return record, verify_record(record, **defaults)
+
+def verify_stream(lines, **defaults):
+    """逐行驗證 JSON Lines，每副牌靴產出一筆結果（附 1 起算的 index）；空行略過。"""
+    index = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        index += 1
+        _, out = verify_line(line, **defaults)
+        out['index'] = index
+        yield out
+
+def shoe_record(rounds: List[Round], tail: Optional[List[Card]], **extra) -> dict:
+    """把牌靴轉成匯入格式的紀錄（verify_record 的反向），方便匯出後再驗證。"""
+    seq = [c for r in sorted(rounds, key=lambda x: x.start_index) for c in r.cards] + list(tail or [])
+    record = {'cards': ' '.join(c.short() for c in seq), 'tail': len(tail or []), **extra}
+    if all(c.color for c in seq):
+        record['colors'] = ''.join(c.color for c in seq)
+    return record
+
 # =========================
 # main
 # =========================
 if __name__ == '__main__':
-    print("[開始] 目標：整靴 416/416 皆為敏感局（允許尾段 4/5/6 自動排列）")
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    parser = argparse.ArgumentParser(description="產生整靴全敏感的百家樂牌靴")
+    parser.add_argument('--decks', type=int, default=NUM_DECKS, help=f"牌靴副數（1..{MAX_NUM_DECKS}，預設 NUM_DECKS）")
+    parser.add_argument('--batch', metavar='OUT_DIR', help="批次模式：逐鞋寫出 CSV 並記錄檢查點，可中斷後接續")
+    parser.add_argument('--shoes', type=int, default=NUM_SHOES, help="批次模式的牌靴數（預設 NUM_SHOES）")
+    parser.add_argument('--workers', type=int, default=1, help="批次模式的平行生成行程數")
+    parser.add_argument('--seed', type=int, default=SEED, help="批次模式 / 調參的基準種子（接續時沿用檢查點內的種子）")
+    parser.add_argument('--autotune', action='store_true', help="調參模式：量測參數格點並把最快的一組寫進 TUNING_PATH")
+    parser.add_argument('--verify', metavar='FILE', help="驗證模式：逐行檢查 JSON Lines 匯入檔中的牌靴（- 表示標準輸入）")
+    parser.add_argument('--signal', default=SIGNAL_SUIT, help="調參 / 驗證的訊號花色（♠♥♦♣ 或 S/H/D/C）")
+    parser.add_argument('--tie', default=None, help="調參 / 驗證的和局花色（省略表示未設定）")
+    parser.add_argument('--samples', type=int, default=20, help="調參時每組參數的種子數")
+    args = parser.parse_args()
+    if not 1 <= args.decks <= MAX_NUM_DECKS:
+        parser.error(f"--decks 必須在 1..{MAX_NUM_DECKS}")
+    NUM_DECKS = args.decks
+    if args.autotune:
+        letters = dict(zip('SHDC', SUITS))
+        signal = letters.get(args.signal.upper(), args.signal)
+        tie = letters.get(args.tie.upper(), args.tie) if args.tie else None
+        entry = autotune(signal, tie, samples=args.samples, seed=args.seed if args.seed is not None else 1)
+        base = entry['baseline']
+        print(f"[調參完成] {signal}|{tie or ''} -> {entry['params']}：每秒 {base['shoes_per_sec']:.3f} → {entry['shoes_per_sec']:.3f}，"
+              f"成功率 {base['success_rate']:.0%} → {entry['success_rate']:.0%}，已寫入 {TUNING_PATH}")
+        raise SystemExit(0)
+    if args.verify:
+        import sys
+        letters = dict(zip('SHDC', SUITS))
+        source = sys.stdin if args.verify == '-' else open(args.verify, encoding='utf-8-sig')
+        started, total, failed = time.perf_counter(), 0, 0
+        with source:
+            for out in verify_stream(source, signal_suit=letters.get(args.signal.upper(), args.signal),
+                                     tie_suit=letters.get(args.tie.upper(), args.tie) if args.tie else None,
+                                     num_decks=args.decks):
+                total += 1
+                if out['ok']:
+                    continue
+                failed += 1
+                label = f"#{out['index']}" + (f"（id={out['id']}）" if 'id' in out else '')
+                print(f"[不符] {label}：{out['violation_count']} 項")
+                for v in out['violations']:
+                    where = f" 第 {v['round'] + 1} 局" if 'round' in v else ''
+                    print(f"    {v['rule']}{where}：{v['detail']}")
+        elapsed = time.perf_counter() - started
+        print(f"[驗證完成] {total} 副，通過 {total - failed}，不符 {failed}；"
+              f"{elapsed:.2f} 秒（每秒 {total / elapsed if elapsed else 0:.0f} 副）")
+        raise SystemExit(1 if failed else 0)
+    apply_tuning()
+    if args.batch:
+        try:
+            run_batch(args.batch, args.shoes, workers=args.workers, seed=args.seed)
+        except KeyboardInterrupt:
+            print("\n[中斷] 已完成的牌靴都已寫入檢查點，重新執行相同指令即可接續。")
+        except RuntimeError as e:
+            print("[失敗]", e)
+        raise SystemExit(0)
+
+    print(f"[開始] 目標：整靴 {shoe_size()}/{shoe_size()} 皆為敏感局（允許尾段 4/5/6 自動排列）")
     shoe_results: List[ShoeResult] = []
     cut_stats: List[CutSimulationResult] = []
     try:
@@ -1067,17 +2554,34 @@ if __name__ == '__main__':
                 print(f"retry shoe {shoe_idx} post-processing failed: {e}, retrying...")
                 continue
 
-            print(f"[成功] 敏感局數={len(rounds)}，尾局={len(tail)} 張，覆蓋牌數={total_cards}/416，切牌命中敏感機率約 {len(starts)}/416 = {len(starts)/416:.2%}")
-
-            marked = {r.cards[0].pos for r in rounds}
-            if tail:
-                marked.add(tail[0].pos)
-            rows, avg_hit, avg_rounds = simulate_all_cuts(deck, marked, use_b_order=True, rounds=rounds, tail=tail)
-            print(f"[切牌統計] 平均命張={avg_hit:.3f}，平均命前局={avg_rounds:.3f}")
+            print(f"[成功] 敏感局數={len(rounds)}，尾局={len(tail)} 張，覆蓋牌數={total_cards}/{len(deck)}，切牌命中敏感機率約 {len(starts)}/{len(deck)} = {len(starts)/len(deck):.2%}")
 
             shoe_results.append(ShoeResult(shoe_index=shoe_idx, rounds=rounds, tail=tail, deck=deck))
-            cut_stats.append(CutSimulationResult(shoe_index=shoe_idx, rows=rows, avg_hit=avg_hit, avg_rounds=avg_rounds))
+            if not (BATCH_CUT_STATS and np is not None):
+                marked = {r.cards[0].pos for r in rounds}
+                if tail:
+                    marked.add(tail[0].pos)
+                rows, avg_hit, avg_rounds = simulate_all_cuts(deck, marked, use_b_order=True, rounds=rounds, tail=tail)
+                print(f"[切牌統計] 平均命張={avg_hit:.3f}，平均命前局={avg_rounds:.3f}")
+                cut_stats.append(CutSimulationResult(shoe_index=shoe_idx, rows=rows, avg_hit=avg_hit, avg_rounds=avg_rounds))
             shoe_idx += 1
+
+        if BATCH_CUT_STATS and np is not None and shoe_results:
+            points, marked_mask, pos, seqs = batch_cut_inputs([(s.rounds, s.tail) for s in shoe_results])
+            batch = simulate_all_cuts_batch(points, marked_mask, pos)
+            for n, shoe in enumerate(shoe_results):
+                avg_hit, avg_rounds = float(batch.avg_hit[n]), float(batch.avg_rounds[n])
+                print(f"[切牌統計] 第 {shoe.shoe_index} 副：平均命張={avg_hit:.3f}，平均命前局={avg_rounds:.3f}")
+                cut_stats.append(CutSimulationResult(
+                    shoe_index=shoe.shoe_index, rows=cut_batch_rows(batch, n, seqs[n]),
+                    avg_hit=avg_hit, avg_rounds=avg_rounds,
+                ))
+            summary = batch.summary
+            print(f"[切牌分布] {summary['shoes']} 副 / {summary['cuts']} 切點，命中率={summary['hit_rate']:.2%}，"
+                  f"平均命張={summary['avg_hit_mean']:.3f}，平均命前局={summary['avg_rounds_mean']:.3f}")
+            if 'hit_at_percentiles' in summary:
+                pct = ', '.join(f"p{p}={v:.1f}" for p, v in summary['hit_at_percentiles'].items())
+                print(f"[切牌分布] 命張百分位：{pct}")
     except RuntimeError as e:
         print("[失敗]", e)
     else:
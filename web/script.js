@@ -1,4 +1,5 @@
 const API_BASE = window.location.origin;
+const GENERATE_DEADLINE_MS = 15000;
 
 const STATE = {
   rounds: [],
@@ -608,6 +609,44 @@ function applyGenerateResponse(data) {
   if (tables) tables.style.display = 'grid';
 }
 
+// 以 WebSocket 取得生成進度，回合分批送達時先行渲染；連線失敗時由呼叫端改用 POST
+function generateViaSocket(payload) {
+  return new Promise((resolve, reject) => {
+    const ws = new WebSocket(`${API_BASE.replace(/^http/, 'ws')}/ws/generate`);
+    const info = $('genInfo');
+    const rounds = [];
+    let received = false;
+    ws.onopen = () => ws.send(JSON.stringify(payload));
+    ws.onmessage = (event) => {
+      received = true;
+      const msg = JSON.parse(event.data);
+      if (msg.type === 'attempt' && info) {
+        const reason = msg.ok ? '' : ` (${msg.reason})`;
+        info.textContent = `\u5617\u8a66 #${msg.attempt}${reason}\uff0c${Math.round(msg.elapsed_ms)} ms`;
+      } else if (msg.type === 'rule_retry' && info) {
+        info.textContent = `\u898f\u5247\u91cd\u8a66 ${msg.retry}`;
+      } else if (msg.type === 'rounds') {
+        rounds.push(...msg.rounds);
+        renderRounds(rounds);
+        const tables = $('tables');
+        if (tables) tables.style.display = 'grid';
+      } else if (msg.type === 'done') {
+        if (info) info.textContent = '';
+        resolve({ ...msg, rounds });
+      } else if (msg.type === 'error') {
+        if (info) info.textContent = '';
+        resolve(msg);
+      }
+    };
+    ws.onerror = () => {
+      if (!received) reject(new Error('websocket unavailable'));
+    };
+    ws.onclose = () => {
+      if (!received) reject(new Error('websocket closed'));
+    };
+  });
+}
+
 async function generateShoe() {
   const btn = $('btnGen');
   const spinner = $('spinGen');
@@ -618,12 +657,19 @@ async function generateShoe() {
       num_shoes: Number($('numShoes').value),
       signal_suit: $('signalSuit').value,
       tie_signal_suit: $('tieSuit').value || null,
+      num_decks: Number($('numDecks').value) || null,
+      deadline_ms: GENERATE_DEADLINE_MS,
     };
-    const data = await fetchJson(`${API_BASE}/api/generate_shoe`, {
-      method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify(payload),
-    });
+    let data;
+    try {
+      data = await generateViaSocket(payload);
+    } catch (err) {
+      data = await fetchJson(`${API_BASE}/api/generate_shoe`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(payload),
+      });
+    }
     if (data.error) {
       toast(`\u5275\u5efa\u5931\u6557\uff1a${data.detail || data.error}`);
       return;
@@ -631,6 +677,11 @@ async function generateShoe() {
     applyGenerateResponse(data);
     const count = (data.rounds || []).length;
     const fb = data.meta && data.meta.fallback ? `\uff08fallback: ${data.meta.fallback}\uff09` : '';
+    if (data.partial) {
+      const coverage = (data.meta.coverage * 100).toFixed(1);
+      toast(`\u90e8\u5206\u7d50\u679c\uff0c\u8986\u84cb\u7387 ${coverage}%\uff0c\u5171 ${count} \u5c40`);
+      return;
+    }
     toast(`\u724c\u9774\u5df2\u5b8c\u6210\uff0c\u5171 ${count} \u5c40${fb}`);
   } catch (err) {
     console.error(err);